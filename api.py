@@ -1,25 +1,131 @@
+import asyncio
 import json
+import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
 import shortuuid
 import socket
 
 
-class API:
-    def __init__(self, host="http://127.0.0.1", port="5000"):
+class ReportJournal:
+    """
+    Append-only local spool of block status reports that the scheduler hasn't acknowledged yet.
+
+    Every report is written (and flushed) here before it is queued for sending, and an ack line is written once the
+    scheduler has accepted it, so reports survive a crash or restart of the worker and are replayed when it starts
+    again. Without a path the journal only lives in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        if path is not None:
+            pending = self.pending()
+            # rewrite the journal with just the unacknowledged reports so it doesn't grow forever
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                for report in pending:
+                    f.write(json.dumps(report) + "\n")
+            os.replace(tmp_path, path)
+            self.file = open(path, "a")
+
+    def pending(self):
+        """
+        Gets the reports in the journal that were never acknowledged, in the order they were made
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return []
+        reports = {}
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn last line from a crash
+                    continue
+                if "ack" in entry:
+                    for uuid in entry["ack"]:
+                        reports.pop(uuid, None)
+                else:
+                    reports.pop(entry["uuid"], None)
+                    reports[entry["uuid"]] = entry
+        return list(reports.values())
+
+    def _write(self, entries):
+        if self.file is None:
+            return
+        with self.lock:
+            for entry in entries:
+                self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def append(self, report):
+        self._write([report])
+
+    def ack(self, uuids):
+        self._write([{"ack": list(uuids)}])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def split_reports(reports):
+    """
+    Splits reports into the bodies of one complete and one failed call
+    """
+    complete = {"ids": [], "durations": [], "bytes": []}
+    failed = {"ids": []}
+    for report in reports:
+        if report["status"] == "complete":
+            complete["ids"].append(report["uuid"])
+            complete["durations"].append(report.get("duration") or 0.0)
+            complete["bytes"].append(report.get("bytes") or 0)
+        else:
+            failed["ids"].append(report["uuid"])
+    return complete, failed
+
+
+class _BaseAPI:
+    def __init__(
+        self,
+        host="http://127.0.0.1",
+        port="5000",
+        journal_path=None,
+        flush_interval=5.0,
+        max_batch=500,
+        timeout=30.0,
+    ):
         self.host = host
         self.port = port
         BASE = f"{self.host}:{self.port}"
         self.GET_BLOCK = f"{BASE}/blocks/get"
         self.GET_BLOCK_COUNT = f"{BASE}/blocks/count"
         self.GLOBAL_PROGRESS = f"{BASE}/blocks/progress"
+        self.BLOCK_STATS = f"{BASE}/blocks/stats"
         self.BLOCK_IN_PROGRESS = f"{BASE}/blocks/in_progress"
         self.BLOCK_COMPLETE = f"{BASE}/blocks/complete"
         self.BLOCK_FAILED = f"{BASE}/blocks/failed"
+        self.BLOCK_HEARTBEAT = f"{BASE}/blocks/heartbeat"
+        self.INGEST_CRAWLS = f"{BASE}/crawls/ingest"
         self.WORKER_ID = None
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "application/json",
         }
+        self.timeout = timeout
+        # batched status reports: sent every `flush_interval` seconds or once `max_batch` are queued
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.journal = ReportJournal(journal_path)
+        self.pending_reports = self.journal.pending()
+        self.reports_lock = threading.Lock()
 
     def worker_id(self):
         if self.WORKER_ID is None:
@@ -31,53 +137,336 @@ class API:
             self.WORKER_ID = f"{usr}-{shortuuid.uuid()}"
         return self.WORKER_ID
 
-    def get_available_blocks(self, n):
-        response = requests.get(
-            f"{self.GET_BLOCK}/?worker_id='{self.worker_id()}'&n={n}"
-        )
+    def _queue_report(self, report):
+        self.journal.append(report)
+        with self.reports_lock:
+            self.pending_reports.append(report)
+            return len(self.pending_reports)
+
+    def _take_reports(self):
+        with self.reports_lock:
+            reports = self.pending_reports[: self.max_batch]
+            self.pending_reports = self.pending_reports[self.max_batch:]
+            return reports
+
+    def _requeue_reports(self, reports):
+        with self.reports_lock:
+            self.pending_reports = reports + self.pending_reports
+
+    @staticmethod
+    def _ok(response):
+        return response.get("message", "") != "database error"
+
+
+class API(_BaseAPI):
+    """
+    Blocking scheduler client with a persistent connection pool.
+
+    Completed and failed blocks can be reported with `report_complete` / `report_failed`, which return immediately:
+    the reports are journaled and sent in batches from a background thread, retried until the scheduler
+    acknowledges them, and replayed from the journal if the worker restarts before that.
+    """
+
+    def __init__(self, *args, pool_size=16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_size = pool_size
+        self._session_pid = None
+        self.reporter = None
+        self.reporter_wakeup = threading.Event()
+        self.closed = False
+
+    def session(self):
+        # sessions aren't safe to share across a fork, so a forked child gets its own connection pool
+        if self._session_pid != os.getpid():
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self._session.mount("http://", adapter)
+            self._session.mount("https://", adapter)
+            self._session_pid = os.getpid()
+        return self._session
+
+    def get_available_blocks(self, n, slots=None):
+        params = {"worker_id": self.worker_id(), "n": n}
+        if slots is not None:
+            params["slots"] = slots
+        response = self.session().get(self.GET_BLOCK, params=params, timeout=self.timeout)
         return response.json()
 
     def get_block_count(self):
-        response = requests.get(self.GET_BLOCK_COUNT)
+        response = self.session().get(self.GET_BLOCK_COUNT, timeout=self.timeout)
         return response.json().get("count", response.json())
 
     def get_global_progress(self):
-        response = requests.get(self.GLOBAL_PROGRESS)
+        response = self.session().get(self.GLOBAL_PROGRESS, timeout=self.timeout)
         return response.json().get("progress", response.json())
 
+    def get_stats(self):
+        response = self.session().get(self.BLOCK_STATS, timeout=self.timeout)
+        return response.json()
+
+    def _put(self, url, body, params=None):
+        response = self.session().put(
+            url, params=params, json=body, headers=self.headers, timeout=self.timeout
+        )
+        return response.json()
+
     def mark_block_in_progress(self, block_id):
         if isinstance(block_id, str):
             block_id = block_id.split(",")
-        response = requests.put(
-            f"{self.BLOCK_IN_PROGRESS}/?worker_id='{self.worker_id()}'",
-            json={"ids": block_id},
-            headers=self.headers,
+        return self._put(
+            f"{self.BLOCK_IN_PROGRESS}/", {"ids": block_id}, params={"worker_id": self.worker_id()}
         )
-        return response.json()
 
-    def mark_block_complete(self, block_id):
+    def mark_block_complete(self, block_id, durations=None, sizes=None):
+        # durations (seconds) and sizes (bytes) per block feed the scheduler's throughput estimate for this worker
         if isinstance(block_id, str):
             block_id = block_id.split(",")
-        response = requests.put(
-            f"{self.BLOCK_COMPLETE}/", json={"ids": block_id}, headers=self.headers
-        )
-        return response.json()
+        body = {"ids": block_id}
+        if durations is not None:
+            body["durations"] = durations
+        if sizes is not None:
+            body["bytes"] = sizes
+        return self._put(f"{self.BLOCK_COMPLETE}/", body, params={"worker_id": self.worker_id()})
 
     def mark_block_failed(self, block_id):
         if isinstance(block_id, str):
             block_id = block_id.split(",")
-        response = requests.put(
-            f"{self.BLOCK_FAILED}/", json={"ids": block_id}, headers=self.headers
+        return self._put(f"{self.BLOCK_FAILED}/", {"ids": block_id}, params={"worker_id": self.worker_id()})
+
+    def heartbeat(self, block_id):
+        if isinstance(block_id, str):
+            block_id = block_id.split(",")
+        return self._put(f"{self.BLOCK_HEARTBEAT}/", {"ids": block_id}, params={"worker_id": self.worker_id()})
+
+    def ingest_crawls(self, manifests):
+        return self._put(f"{self.INGEST_CRAWLS}/", {"manifests": manifests})
+
+    # batched reporting
+
+    def report_complete(self, block_id, duration=None, size=None):
+        self._report({"uuid": block_id, "status": "complete", "duration": duration, "bytes": size})
+
+    def report_failed(self, block_id):
+        self._report({"uuid": block_id, "status": "failed"})
+
+    def _report(self, report):
+        self.start_reporter()
+        if self._queue_report(report) >= self.max_batch:
+            self.reporter_wakeup.set()
+
+    def start_reporter(self):
+        if self.reporter is None or not self.reporter.is_alive():
+            self.reporter = threading.Thread(target=self._report_loop, name="API reporter", daemon=True)
+            self.reporter.start()
+
+    def _send_reports(self, reports):
+        complete, failed = split_reports(reports)
+        if complete["ids"] and not self._ok(self.mark_block_complete(**_complete_kwargs(complete))):
+            return False
+        if failed["ids"] and not self._ok(self.mark_block_failed(failed["ids"])):
+            # the completions went through, only the failures need sending again
+            self.journal.ack(complete["ids"])
+            self._requeue_reports([r for r in reports if r["status"] != "complete"])
+            return None
+        return True
+
+    def flush(self):
+        """
+        Sends all queued reports now, returns False if the scheduler couldn't be reached (they stay queued)
+        """
+        while True:
+            reports = self._take_reports()
+            if not reports:
+                return True
+            try:
+                sent = self._send_reports(reports)
+            except Exception as e:
+                print(f"Failed to send {len(reports)} block reports, retrying later: {e}")
+                sent = False
+            if sent is None:
+                return False
+            if not sent:
+                self._requeue_reports(reports)
+                return False
+            self.journal.ack([r["uuid"] for r in reports])
+
+    def _report_loop(self):
+        backoff = self.flush_interval
+        while not self.closed:
+            self.reporter_wakeup.wait(backoff)
+            self.reporter_wakeup.clear()
+            if self.flush():
+                backoff = self.flush_interval
+            else:
+                # scheduler is down or struggling, back off (up to 5 minutes) instead of hammering it
+                backoff = min(backoff * 2, 300)
+
+    def close(self):
+        """
+        Tries to send everything still queued and stops the reporter (unsent reports stay in the journal)
+        """
+        self.closed = True
+        self.reporter_wakeup.set()
+        if self.reporter is not None:
+            self.reporter.join()
+        self.flush()
+        self.journal.close()
+
+
+class AsyncAPI(_BaseAPI):
+    """
+    asyncio version of API for callers running an event loop, built on an httpx connection pool.
+
+    Reports queued with `report_complete` / `report_failed` are sent by a background task started with
+    `start_reporter` (or `async with AsyncAPI(...)`), with the same journaling and retries as API.
+    """
+
+    def __init__(self, *args, pool_size=100, client=None, **kwargs):
+        import httpx
+
+        super().__init__(*args, **kwargs)
+        # many AsyncAPIs in one process (e.g. simulated workers) can share a `client` and its connection pool
+        self.owns_client = client is None
+        self.client = client or httpx.AsyncClient(
+            timeout=self.timeout, limits=httpx.Limits(max_connections=pool_size), headers=self.headers
         )
+        self.reporter = None
+        self.reporter_wakeup = asyncio.Event()
+        self.closed = False
+
+    async def __aenter__(self):
+        self.start_reporter()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def get_available_blocks(self, n, slots=None):
+        params = {"worker_id": self.worker_id(), "n": n}
+        if slots is not None:
+            params["slots"] = slots
+        response = await self.client.get(self.GET_BLOCK, params=params)
+        return response.json()
+
+    async def get_block_count(self):
+        response = await self.client.get(self.GET_BLOCK_COUNT)
+        return response.json().get("count", response.json())
+
+    async def get_global_progress(self):
+        response = await self.client.get(self.GLOBAL_PROGRESS)
+        return response.json().get("progress", response.json())
+
+    async def get_stats(self):
+        response = await self.client.get(self.BLOCK_STATS)
         return response.json()
 
+    async def _put(self, url, body, params=None):
+        response = await self.client.put(url, params=params, json=body)
+        return response.json()
+
+    async def mark_block_complete(self, block_id, durations=None, sizes=None):
+        body = {"ids": list(block_id)}
+        if durations is not None:
+            body["durations"] = durations
+        if sizes is not None:
+            body["bytes"] = sizes
+        return await self._put(f"{self.BLOCK_COMPLETE}/", body, params={"worker_id": self.worker_id()})
+
+    async def mark_block_failed(self, block_id):
+        return await self._put(
+            f"{self.BLOCK_FAILED}/", {"ids": list(block_id)}, params={"worker_id": self.worker_id()}
+        )
+
+    async def heartbeat(self, block_id):
+        return await self._put(
+            f"{self.BLOCK_HEARTBEAT}/", {"ids": list(block_id)}, params={"worker_id": self.worker_id()}
+        )
+
+    # batched reporting
+
+    def report_complete(self, block_id, duration=None, size=None):
+        self._report({"uuid": block_id, "status": "complete", "duration": duration, "bytes": size})
+
+    def report_failed(self, block_id):
+        self._report({"uuid": block_id, "status": "failed"})
+
+    def _report(self, report):
+        if self._queue_report(report) >= self.max_batch:
+            self.reporter_wakeup.set()
+
+    def start_reporter(self):
+        if self.reporter is None or self.reporter.done():
+            self.reporter = asyncio.ensure_future(self._report_loop())
+
+    async def _send_reports(self, reports):
+        complete, failed = split_reports(reports)
+        if complete["ids"] and not self._ok(await self.mark_block_complete(**_complete_kwargs(complete))):
+            return False
+        if failed["ids"] and not self._ok(await self.mark_block_failed(failed["ids"])):
+            self.journal.ack(complete["ids"])
+            self._requeue_reports([r for r in reports if r["status"] != "complete"])
+            return None
+        return True
+
+    async def flush(self):
+        """
+        Sends all queued reports now, returns False if the scheduler couldn't be reached (they stay queued)
+        """
+        while True:
+            reports = self._take_reports()
+            if not reports:
+                return True
+            try:
+                sent = await self._send_reports(reports)
+            except Exception as e:
+                print(f"Failed to send {len(reports)} block reports, retrying later: {e}")
+                sent = False
+            if sent is None:
+                return False
+            if not sent:
+                self._requeue_reports(reports)
+                return False
+            self.journal.ack([r["uuid"] for r in reports])
+
+    async def _report_loop(self):
+        backoff = self.flush_interval
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.reporter_wakeup.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            self.reporter_wakeup.clear()
+            if await self.flush():
+                backoff = self.flush_interval
+            else:
+                backoff = min(backoff * 2, 300)
+
+    async def close(self):
+        self.closed = True
+        self.reporter_wakeup.set()
+        if self.reporter is not None:
+            await self.reporter
+        await self.flush()
+        self.journal.close()
+        if self.owns_client:
+            await self.client.aclose()
+
+
+def _complete_kwargs(complete):
+    return {"block_id": complete["ids"], "durations": complete["durations"], "sizes": complete["bytes"]}
+
 
 def test():
+    # smoke test against a scheduler on localhost, see bench_scheduler.py for load testing
     api = API()
     for _ in range(100):
         print(_)
-        url, uuid = api.get_available_block().values()
-        api.mark_block_complete(uuid)
+        blocks = api.get_available_blocks(1)
+        if isinstance(blocks, dict):
+            print(blocks)
+            break
+        api.report_complete(blocks[0]["uuid"])
+    api.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# adjusts how many blocks a worker processes at once, from its network ingress, cpu use and block throughput
+import threading
+import time
+
+from metrics import Counter, Gauge
+
+TARGET = Gauge("worker_autotune_concurrency", "Blocks the autotuner lets the worker process at once")
+BLOCKS_PER_HOUR = Gauge("worker_autotune_blocks_per_hour", "Blocks finished per hour over the last autotune window")
+INGRESS = Gauge("worker_autotune_ingress_bytes_per_second", "Network bytes received per second over the last window")
+CPU = Gauge("worker_autotune_cpu_utilisation", "Fraction of cpu time busy over the last window (all cores)")
+LATENCY = Gauge("worker_autotune_block_seconds", "Mean seconds per block finished over the last window")
+DECISIONS = Counter("worker_autotune_decisions_total", "Autotune decisions", labels=["action"])
+
+
+def read_rx_bytes(path="/proc/net/dev"):
+    """
+    Gets the bytes received so far on every interface but loopback
+    """
+    total = 0
+    with open(path) as f:
+        # two header lines, then "<interface>: <rx bytes> <rx packets> ..."
+        for line in f.readlines()[2:]:
+            interface, _, counters = line.partition(":")
+            if interface.strip() != "lo":
+                total += int(counters.split()[0])
+    return total
+
+
+def read_cpu_times(path="/proc/stat"):
+    """
+    Gets (busy, total) cpu time so far, summed over all cores, in clock ticks
+    """
+    with open(path) as f:
+        # cpu  user nice system idle iowait irq softirq steal ...
+        times = [int(value) for value in f.readline().split()[1:9]]
+    idle = times[3] + times[4]
+    return sum(times) - idle, sum(times)
+
+
+class Autotuner:
+    """
+    Hill-climbs the number of blocks processed at once toward the most blocks per hour.
+
+    Every `interval` seconds (once at least `min_blocks` blocks have finished) it compares the blocks/hour of the
+    window with the previous one: while throughput improves by more than `tolerance` it keeps stepping the same way,
+    and when it doesn't it turns around, so the target settles around the best concurrency and follows it as the
+    bottleneck moves. If the cpus are saturated (above `cpu_high`) the target is cut multiplicatively instead, as more
+    blocks at once only thrash. The target always stays within [`minimum`, `maximum`], and every change is passed to
+    `on_change(target)`.
+    """
+
+    def __init__(
+        self, minimum, maximum, start=None, interval=300, min_blocks=4, tolerance=0.05, cpu_high=0.95,
+        decrease=0.75, on_change=None,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = min(max(start or minimum, minimum), maximum)
+        self.interval = interval
+        self.min_blocks = min_blocks
+        self.tolerance = tolerance
+        self.cpu_high = cpu_high
+        self.decrease = decrease
+        self.on_change = on_change
+        # +1 while adding blocks improves throughput, -1 while removing them does
+        self.direction = 1
+        self.last_rate = None
+        self.lock = threading.Lock()
+        self._reset_window()
+        TARGET.set(self.target)
+
+    def _reset_window(self):
+        self.window_start = time.time()
+        self.window_rx = read_rx_bytes()
+        self.window_cpu = read_cpu_times()
+        self.window_blocks = 0
+        self.window_block_seconds = 0.0
+
+    def block_done(self, seconds):
+        """
+        Counts a finished block toward the current window
+        """
+        with self.lock:
+            self.window_blocks += 1
+            self.window_block_seconds += seconds
+
+    def sample(self):
+        """
+        Gets the window's measurements, or None if it's too early to judge it
+        """
+        elapsed = time.time() - self.window_start
+        with self.lock:
+            blocks, block_seconds = self.window_blocks, self.window_block_seconds
+        if elapsed < self.interval or blocks < self.min_blocks:
+            return None
+        busy, total = read_cpu_times()
+        cpu_ticks = total - self.window_cpu[1]
+        return {
+            "blocks_per_hour": blocks / elapsed * 3600,
+            "ingress": (read_rx_bytes() - self.window_rx) / elapsed,
+            "cpu": (busy - self.window_cpu[0]) / cpu_ticks if cpu_ticks else 0.0,
+            "latency": block_seconds / blocks,
+        }
+
+    def decide(self, sample):
+        """
+        Gets (new target, action, reason) for a window's measurements
+        """
+        rate = sample["blocks_per_hour"]
+        if sample["cpu"] >= self.cpu_high and self.target > self.minimum:
+            self.direction = -1
+            target = min(int(self.target * self.decrease), self.target - 1)
+            return max(target, self.minimum), "decrease", f"cpu saturated ({sample['cpu']:.0%})"
+        if self.last_rate is None:
+            reason = "first window, probing"
+        elif rate > self.last_rate * (1 + self.tolerance):
+            reason = f"throughput up from {self.last_rate:.0f} blocks/hour"
+        else:
+            self.direction = -self.direction
+            reason = f"throughput not up from {self.last_rate:.0f} blocks/hour, turning around"
+        target = min(max(self.target + self.direction, self.minimum), self.maximum)
+        if target == self.target:
+            # at a bound, try the other way next time
+            self.direction = -self.direction
+            return target, "hold", f"{reason}, at the {'upper' if target == self.maximum else 'lower'} bound"
+        return target, "increase" if target > self.target else "decrease", reason
+
+    def step(self):
+        """
+        Judges the current window if it's complete, changing the target if needed, returns the sample or None
+        """
+        sample = self.sample()
+        if sample is None:
+            return None
+        BLOCKS_PER_HOUR.set(sample["blocks_per_hour"])
+        INGRESS.set(sample["ingress"])
+        CPU.set(sample["cpu"])
+        LATENCY.set(sample["latency"])
+        target, action, reason = self.decide(sample)
+        DECISIONS.inc(action=action)
+        print(
+            f"Autotune: {sample['blocks_per_hour']:.0f} blocks/hour, {sample['ingress'] / 2 ** 20:.1f} MB/s in, "
+            f"cpu {sample['cpu']:.0%}, {sample['latency']:.0f}s per block at {self.target} blocks - {action} to "
+            f"{target} ({reason})"
+        )
+        self.last_rate = sample["blocks_per_hour"]
+        if target != self.target:
+            self.target = target
+            TARGET.set(target)
+            if self.on_change is not None:
+                self.on_change(target)
+        self._reset_window()
+        return sample
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(min(self.interval, 10))
+                try:
+                    self.step()
+                except Exception as e:
+                    print(f"Autotune failed: {e}")
+
+        threading.Thread(target=run, name="autotune", daemon=True).start()
+        return self
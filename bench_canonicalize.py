@@ -0,0 +1,195 @@
+# micro-benchmark of image link canonicalization, on the links of real filter output (or a synthetic mix of them)
+import argparse
+import json
+import random
+from time import perf_counter
+from urllib.parse import urlparse, urljoin
+
+from canonicalize import (
+    Canonicalizer, canonicalize_flickr, canonicalize_wikimedia, canonicalize_wp, canonicalize_ytimg,
+)
+from compression import open_reader
+
+RULES = [
+    ("flickr.com", canonicalize_flickr),
+    ("staticflickr.com", canonicalize_flickr),
+    ("img.youtube.com", canonicalize_ytimg),
+    ("ytimg.com", canonicalize_ytimg),
+    ("wp.com", canonicalize_wp),
+    ("upload.wikimedia.org", canonicalize_wikimedia),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark image link canonicalization")
+    parser.add_argument(
+        "inputs", nargs="*", help="filter output files (.jsonl.wat.gz), synthetic pages are used if none are given"
+    )
+    parser.add_argument("--pages", type=int, default=50000, help="pages read (or generated)")
+    parser.add_argument(
+        "--extra_rules", type=int, nargs="+", default=[0, 1000],
+        help="numbers of extra (never matching) CDN rules to register, to show they don't slow down the common path",
+    )
+    return parser.parse_args()
+
+
+def real_pages(paths, limit):
+    # (page url, [image hrefs]) of the links dump_urls would canonicalize
+    pages = []
+    for path in paths:
+        with open_reader(path) as f:
+            for line in f:
+                try:
+                    p = json.loads(line)
+                    links = p["Envelope"]["Payload-Metadata"]["HTTP-Response-Metadata"]["HTML-Metadata"]["Links"]
+                    base = urlparse(p["Envelope"]["WARC-Header-Metadata"]["WARC-Target-URI"])
+                    base = base._replace(query="").geturl()
+                except (ValueError, KeyError):
+                    continue
+                hrefs = [
+                    link["url"] for link in links
+                    if "alt" in link and len(link["alt"]) > 10 and link["url"].startswith("http")
+                    and "creativecommons" not in link["url"]
+                ]
+                pages.append((base, hrefs))
+                if len(pages) == limit:
+                    return pages
+    return pages
+
+
+def synthetic_pages(n, seed=0):
+    # site-local images (some repeated across a site's pages, e.g logos), and a long tail of CDN / hosting links
+    rng = random.Random(seed)
+    cdn = [
+        lambda: f"https://live.staticflickr.com/{rng.randrange(99)}/{rng.randrange(10 ** 9)}_{rng.choice('mzbq')}.jpg",
+        lambda: f"https://i.ytimg.com/vi/{rng.randrange(10 ** 8)}/hqdefault.jpg",
+        lambda: f"https://i{rng.randrange(3)}.wp.com/site{rng.randrange(5000)}.com/img/{rng.randrange(10 ** 6)}.jpg",
+        lambda: f"https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/{rng.randrange(10 ** 6)}.jpg/220px-x.jpg",
+        lambda: f"https://cdn{rng.randrange(50)}.example-cdn.net/assets/{rng.randrange(10 ** 7)}.png",
+    ]
+    pages = []
+    for i in range(n):
+        site = int(rng.paretovariate(1.2)) % 20000
+        base = f"https://www.site{site}.com/posts/{i}"
+        hrefs = []
+        for j in range(rng.randrange(1, 30)):
+            r = rng.random()
+            if r < 0.3:
+                hrefs.append(f"https://www.site{site}.com/theme/logo{rng.randrange(3)}.png")
+            elif r < 0.7:
+                hrefs.append(f"https://www.site{site}.com/uploads/{rng.randrange(10 ** 7)}.jpg")
+            else:
+                hrefs.append(rng.choice(cdn)())
+        pages.append((base, hrefs))
+    return pages
+
+
+def legacy_canonicalize_url(url):
+    # canonicalize_url before the engine: a substring scan of the special cases for every link
+    parsed = urlparse(url)
+    hostname = parsed.netloc
+
+    special_cases = {
+        "flickr.com": canonicalize_flickr,
+        "img.youtube.com": canonicalize_ytimg,
+        "ytimg.com": canonicalize_ytimg,
+        "wp.com": canonicalize_wp,
+        "upload.wikimedia.org": canonicalize_wikimedia
+    }
+
+    for name, fn in special_cases.items():
+        if name in hostname:
+            return fn(parsed).geturl()
+
+    return parsed.geturl()
+
+
+def legacy(pages):
+    urls = []
+    for base, hrefs in pages:
+        for href in hrefs:
+            try:
+                urls.append(legacy_canonicalize_url(urljoin(base, href)))
+            except Exception:
+                urls.append(None)
+    return urls
+
+
+def canonicalizer(extra_rules, cache_size=None):
+    engine = Canonicalizer() if cache_size is None else Canonicalizer(cache_size)
+    for host, fn in RULES:
+        engine.add_rule(host, fn)
+    for i in range(extra_rules):
+        engine.add_rule(f"cdn{i}.images-{i % 7}.net", canonicalize_wp)
+    return engine
+
+
+def uncached(engine):
+    def run(pages):
+        urls = []
+        for base, hrefs in pages:
+            for href in hrefs:
+                try:
+                    urls.append(engine.canonicalize(urljoin(base, href)))
+                except Exception:
+                    urls.append(None)
+        return urls
+    return run
+
+
+def per_link(engine):
+    def run(pages):
+        urls = []
+        for base, hrefs in pages:
+            for href in hrefs:
+                try:
+                    urls.append(engine.resolve(base, href))
+                except Exception:
+                    urls.append(None)
+        return urls
+    return run
+
+
+def batched(engine):
+    def run(pages):
+        urls = []
+        for base, hrefs in pages:
+            urls.extend(engine.resolve_links(base, hrefs))
+        return urls
+    return run
+
+
+def main():
+    args = parse_args()
+    pages = real_pages(args.inputs, args.pages) if args.inputs else synthetic_pages(args.pages)
+    n_links = sum(len(hrefs) for _, hrefs in pages)
+    print(f"{len(pages)} pages, {n_links} image links, {len({h for _, hrefs in pages for h in hrefs})} distinct")
+
+    start = perf_counter()
+    expected = legacy(pages)
+    legacy_seconds = perf_counter() - start
+    print(f"{'legacy (urljoin + substring scan)':<44} {n_links / legacy_seconds:10.0f} links/s")
+
+    for extra_rules in args.extra_rules:
+        modes = (
+            ("canonicalize(urljoin())", uncached),
+            ("resolve() per link", per_link),
+            ("resolve_links() per page", batched),
+        )
+        for name, make in modes:
+            engine = canonicalizer(extra_rules)
+            start = perf_counter()
+            urls = make(engine)(pages)
+            seconds = perf_counter() - start
+            info = engine.cache_info()
+            hit_rate = info.hits / max(1, info.hits + info.misses)
+            differ = sum(a != b for a, b in zip(urls, expected))
+            print(
+                f"{f'{name} (+{extra_rules} rules)':<44} {n_links / seconds:10.0f} links/s, "
+                f"x{legacy_seconds / seconds:.2f}, {hit_rate:.0%} cache hits (links not on the fast path), "
+                f"{differ} urls differ from legacy"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+# benchmark records/s of decoding and encoding the stages' jsonl records with each JSON backend, against the per-line
+# json.loads / json.dumps(...).encode() the stages used before
+import argparse
+import io
+import json
+import random
+from time import perf_counter
+
+import codec
+from codec import Codec
+from compression import open_reader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the JSON backends on jsonl records")
+    parser.add_argument(
+        "inputs", nargs="*",
+        help="compressed jsonl files, e.g filter output or deduped urls (`<hash> ` prefixes are dropped), synthetic "
+             "image-level records are used if none are given",
+    )
+    parser.add_argument("--records", type=int, default=200000, help="records read (or generated)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per mode, the best is reported")
+    return parser.parse_args()
+
+
+def synthetic_lines(n, seed=0):
+    # image-level records the way dump_urls and sort_dedup write them, with some non-ascii text
+    rng = random.Random(seed)
+    words = ["photo", "image", "of", "the", "a", "beautiful", "city", "Straße", "日本", "view", "from", "café", "night"]
+    lines = []
+    for i in range(n):
+        site = rng.randrange(10000)
+        record = {
+            "path": "IMG@/src",
+            "url": f"https://site{site}.example.com/images/{rng.randrange(10 ** 9)}.jpg",
+            "alt": [" ".join(rng.choices(words, k=rng.randrange(3, 12))) for _ in range(rng.randrange(1, 3))],
+            "page_meta": [" ".join(rng.choices(words, k=rng.randrange(5, 30))) for _ in range(rng.randrange(0, 4))],
+            "licenses": ["https://creativecommons.org/licenses/by-sa/4.0/"],
+            "page_url": [f"https://site{site}.example.com/page/{rng.randrange(10 ** 6)}"],
+            "count": rng.randrange(1, 5),
+            "hash": f"{rng.getrandbits(128):032x}",
+        }
+        lines.append(json.dumps(record).encode() + b"\n")
+    return lines
+
+
+def file_lines(paths, limit):
+    lines = []
+    for path in paths:
+        with open_reader(path) as f:
+            for line in f:
+                if line[:33].endswith(b" ") and not line.startswith(b"{"):
+                    line = line[33:]
+                lines.append(line)
+                if len(lines) == limit:
+                    return lines
+    return lines
+
+
+def legacy_decode(data):
+    records = []
+    for line in io.BytesIO(data):
+        try:
+            records.append(json.loads(line))
+        except:
+            pass
+    return records
+
+
+def legacy_encode(records):
+    out = io.BytesIO()
+    for record in records:
+        out.write(json.dumps(record).encode())
+        out.write(b"\n")
+    return out.getvalue()
+
+
+def codec_decode(backend):
+    def run(data):
+        return list(Codec(backend).records(io.BytesIO(data)))
+    return run
+
+
+def codec_encode(backend):
+    def run(records):
+        c = Codec(backend)
+        out = io.BytesIO()
+        for record in records:
+            out.write(c.dump_line(record))
+        return out.getvalue()
+    return run
+
+
+def best_of(repeat, fn, arg):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        result = fn(arg)
+        seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def main():
+    args = parse_args()
+    lines = file_lines(args.inputs, args.records) if args.inputs else synthetic_lines(args.records)
+    data = b"".join(lines)
+    print(f"{len(lines)} records, {len(data) / 2 ** 20:.1f} MB, backends available: {sorted(codec.BACKENDS)}")
+
+    legacy_seconds, expected = best_of(args.repeat, legacy_decode, data)
+    print(f"{'decode, legacy (json.loads per line)':<40} {len(lines) / legacy_seconds:10.0f} records/s")
+    for backend in sorted(codec.BACKENDS):
+        seconds, records = best_of(args.repeat, codec_decode(backend), data)
+        print(
+            f"{f'decode, {backend} (batched)':<40} {len(lines) / seconds:10.0f} records/s, "
+            f"x{legacy_seconds / seconds:.2f}, {'same' if records == expected else 'DIFFERENT'} records"
+        )
+
+    legacy_seconds, _ = best_of(args.repeat, legacy_encode, expected)
+    print(f"{'encode, legacy (json.dumps().encode())':<40} {len(expected) / legacy_seconds:10.0f} records/s")
+    for backend in sorted(codec.BACKENDS):
+        seconds, out = best_of(args.repeat, codec_encode(backend), expected)
+        # whatever one backend writes, the other reads back the same
+        same = all(json.loads(line) == record for line, record in zip(out.splitlines(), expected))
+        print(
+            f"{f'encode, {backend}':<40} {len(expected) / seconds:10.0f} records/s, "
+            f"x{legacy_seconds / seconds:.2f}, {len(out) / len(data):.2f}x the bytes, "
+            f"{'same' if same else 'DIFFERENT'} records when read back"
+        )
+
+
+if __name__ == "__main__":
+    main()
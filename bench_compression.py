@@ -0,0 +1,119 @@
+# benchmark the SHARD_COMPRESSION settings on the stages' shards: cpu seconds to compress and decompress, wall time and
+# compressed size of each, as a table, next to the size the binary shard format's blocks come to with each codec
+import argparse
+import io
+import os
+import tempfile
+from time import perf_counter, process_time
+
+import bench_codec
+import bench_dump_urls
+from binshard import BinaryShardWriter
+from codec import Codec
+from compression import Compression, open_reader, zstandard
+
+SPECS = ["gzip:1", "gzip:3", "gzip:6", "gzip:9", "pgzip:6", "zstd:1", "zstd:3", "zstd:9", "zstd:19"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark the shard compression codecs and levels")
+    parser.add_argument(
+        "inputs", nargs="*",
+        help="shards (any compression) whose decompressed bytes are benchmarked, e.g filter output and deduped urls. "
+             "Synthetic page-level and image-level records are used if none are given",
+    )
+    parser.add_argument("--specs", nargs="+", default=None, help=f"SHARD_COMPRESSION settings, default {SPECS}")
+    parser.add_argument("--pages", type=int, default=5000, help="synthetic filter output pages")
+    parser.add_argument("--records", type=int, default=100000, help="synthetic image-level records")
+    parser.add_argument("--binary", action="store_true", help="also report binary shard sizes (image-level records)")
+    return parser.parse_args()
+
+
+def synthetic_inputs(pages, records):
+    # filter output (page-level records) and dump_urls / sort_dedup output (image-level records)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "pages.jsonl.wat.gz")
+        bench_dump_urls.synthetic_block(path, pages, 20)
+        with open_reader(path) as f:
+            page_data = f.read()
+    image_data = b"".join(bench_codec.synthetic_lines(records))
+    return {"pages (synthetic)": page_data, "images (synthetic)": image_data}
+
+
+def file_inputs(paths):
+    inputs = {}
+    for path in paths:
+        with open_reader(path) as f:
+            inputs[os.path.basename(path)] = f.read()
+    return inputs
+
+
+def compress(compression, data):
+    out = io.BytesIO()
+    writer = compression.writer(out)
+    # written the way the stages write, a line or so at a time
+    for i in range(0, len(data), 1 << 16):
+        writer.write(data[i:i + (1 << 16)])
+    writer.close()
+    return out.getvalue()
+
+
+def measure(compression, data):
+    start, cpu_start = perf_counter(), process_time()
+    compressed = compress(compression, data)
+    wall, cpu = perf_counter() - start, process_time() - cpu_start
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(compressed)
+        f.flush()
+        start, cpu_start = perf_counter(), process_time()
+        with open_reader(f.name) as reader:
+            same = reader.read() == data
+        read_wall, read_cpu = perf_counter() - start, process_time() - cpu_start
+    return len(compressed), cpu, wall, read_cpu, read_wall, same
+
+
+def binary_size(compression, data):
+    # image-level records as a binary shard, with the same codec and level for its blocks. None for records without
+    # a hash (page-level ones), which aren't written as binary shards
+    codec = Codec()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = BinaryShardWriter(os.path.join(tmp_dir, "x.ccr"), compression=compression)
+        for line in data.splitlines():
+            if not line.startswith(b"{"):
+                line = line.partition(b" ")[2]
+            record = codec.loads(line)
+            if "hash" not in record:
+                return None
+            h = bytes.fromhex(record.pop("hash"))
+            writer.write_record(h, codec.dumps(record))
+        _, _, _, size, _ = writer.close()
+    return size
+
+
+def main():
+    args = parse_args()
+    specs = args.specs or [s for s in SPECS if zstandard is not None or not s.startswith("zstd")]
+    inputs = file_inputs(args.inputs) if args.inputs else synthetic_inputs(args.pages, args.records)
+
+    for name, data in inputs.items():
+        mb = len(data) / 2 ** 20
+        print(f"\n{name}: {mb:.1f} MB")
+        header = f"{'setting':<12} {'size MB':>8} {'ratio':>6} {'comp cpu s':>10} {'comp MB/s':>9} {'comp wall s':>11} "
+        header += f"{'dec cpu s':>9} {'dec MB/s':>8}"
+        if args.binary:
+            header += f" {'binary MB':>9}"
+        print(header)
+        for spec in specs:
+            compression = Compression.parse(spec)
+            size, cpu, wall, read_cpu, read_wall, same = measure(compression, data)
+            row = f"{spec:<12} {size / 2 ** 20:8.2f} {len(data) / size:6.2f} {cpu:10.2f} {mb / wall:9.1f} {wall:11.2f} "
+            row += f"{read_cpu:9.2f} {mb / read_wall:8.1f}"
+            if args.binary:
+                size = binary_size(compression, data)
+                row += f" {'-':>9}" if size is None else f" {size / 2 ** 20:9.2f}"
+            print(row + ("" if same else "  DIFFERENT when read back"))
+
+
+if __name__ == "__main__":
+    main()
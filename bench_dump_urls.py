@@ -0,0 +1,201 @@
+# benchmark peak memory and time of dump_urls' aggregation, against the implementation it replaced
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+from time import perf_counter
+from urllib.parse import urlparse, urljoin
+
+import dump_urls
+from canonicalize import canonicalize_url
+from codec import Codec
+from compression import open_reader
+from shards import ShardWriter
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark peak RSS of dump_urls' per-block aggregation")
+    parser.add_argument(
+        "inputs", nargs="*", help="filter output files (.jsonl.wat.gz), a synthetic one is generated if none are given"
+    )
+    parser.add_argument("--pages", type=int, default=200000, help="pages in the synthetic file")
+    parser.add_argument("--images_per_page", type=int, default=20)
+    parser.add_argument(
+        "--max_mb", type=int, nargs="+", default=[64], help="memory caps to run the streaming aggregation with"
+    )
+    parser.add_argument("--tmp_dir", type=str, default=None)
+    return parser.parse_args()
+
+
+def synthetic_block(path, pages, images_per_page, seed=0):
+    # sites with a shared title and license, a few images (logos etc) repeated across a site's pages
+    rng = random.Random(seed)
+    licenses = [f"https://creativecommons.org/licenses/{kind}/4.0/" for kind in ("by", "by-sa", "by-nc", "by-nd")]
+    with gzip.open(path, "wt", compresslevel=1) as f:
+        for i in range(pages):
+            site = rng.randrange(pages // 20 + 1)
+            links = [{"path": "A@/href", "url": licenses[site % len(licenses)]}]
+            for j in range(images_per_page):
+                image = rng.randrange(5) if j < 2 else rng.randrange(10 ** 9)
+                links.append({
+                    "path": "IMG@/src",
+                    "url": f"https://site{site}.example.com/images/{image}.jpg",
+                    "alt": f"a picture of thing number {image} on site {site}",
+                })
+            head = {"Title": f"Site {site} - page {i}", "Metas": [{"content": f"the description of site {site}"}]}
+            record = {"Envelope": {
+                "Payload-Metadata": {"HTTP-Response-Metadata": {"HTML-Metadata": {"Links": links, "Head": head}}},
+                "WARC-Header-Metadata": {"WARC-Target-URI": f"https://site{site}.example.com/page/{i}?ref=x"},
+            }}
+            f.write(json.dumps(record) + "\n")
+
+
+def legacy_dump_url_from_file(fname, oname):
+    # dump_url_from_file before streaming aggregation: every image as a dict with its own sets, deduped at the end
+    f = gzip.open(fname, 'rb')
+    fo = gzip.open(oname, 'wb', compresslevel=6)
+    all_images = []
+
+    for i in f:
+        page_meta = []
+        licenses = set()
+        images = []
+        try:
+            p = json.loads(i)
+        except:
+            continue
+        html_meta = p["Envelope"]["Payload-Metadata"]["HTTP-Response-Metadata"]["HTML-Metadata"]
+        links = html_meta["Links"]
+        target_url = urlparse(p['Envelope']['WARC-Header-Metadata']['WARC-Target-URI'])
+        target_path = target_url._replace(query="").geturl()
+
+        try:
+            if "Head" in html_meta:
+                if "Title" in html_meta["Head"]:
+                    page_meta.append(html_meta["Head"]["Title"])
+                if "Metas" in html_meta["Head"]:
+                    for m in html_meta["Head"]["Metas"]:
+                        if "content" in m:
+                            page_meta.append(m["content"])
+        except:
+            pass
+
+        for img in links:
+            try:
+                if len(images) > 100:
+                    break
+                if "creativecommons" in img["url"]:
+                    licenses.add(img["url"])
+                else:
+                    if "alt" in img and len(img["alt"]) > 10 and img["url"].startswith("http"):
+                        img["url"] = canonicalize_url(urljoin(target_path, img["url"]))
+                        images.append(img)
+            except:
+                pass
+
+        for img in images:
+            img["page_meta"] = set([img["alt"]] + page_meta)
+            img["licenses"] = licenses
+            img["alt"] = {img["alt"]}
+            img["page_url"] = {target_path}
+            all_images.append(img)
+
+    deduped_images = {}
+    for img in all_images:
+        existing = deduped_images.get(img["url"], img)
+
+        def get_or_update(key):
+            e = existing.get(key, set())
+            e.update(img[key])
+            return e
+
+        existing["alt"] = get_or_update("alt")
+        existing["page_meta"] = get_or_update("page_meta")
+        existing["licenses"] = get_or_update("licenses")
+        existing["page_url"] = get_or_update("page_url")
+        existing["count"] = existing.get("count", 0) + 1
+
+        existing["page_meta"].difference_update(existing["alt"])
+
+        deduped_images[img["url"]] = existing
+
+    for img in deduped_images.values():
+        img["alt"] = list(img["alt"])
+        img["page_meta"] = list(img["page_meta"])
+        img["licenses"] = list(img["licenses"])
+        img["page_url"] = list(img["page_url"])
+
+        h = hashlib.md5(img["url"].encode('utf-8')).hexdigest()
+        img["hash"] = h
+        fo.write(h.encode())
+        fo.write(b" ")
+
+        fo.write(json.dumps(img).encode())
+        fo.write(b"\n")
+    fo.close()
+
+
+def streaming_dump(fname, oname, max_bytes, tmp_dir):
+    with open_reader(fname) as f:
+        aggregator = dump_urls.aggregate_lines(f, max_bytes, tmp_dir)
+    runs = len(aggregator.runs) if aggregator.runs is not None else 0
+    with ShardWriter(oname) as writer:
+        dump_urls.write_images(aggregator, writer, Codec())
+    return runs
+
+
+def measure(mode, path, max_mb, tmp_dir, results):
+    # runs in a fresh process, so its peak RSS is its own
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as out_dir:
+        out_path = os.path.join(out_dir, "out.jsonl.gz")
+        start = perf_counter()
+        runs = 0
+        if mode == "legacy":
+            legacy_dump_url_from_file(path, out_path)
+        elif mode == "streaming":
+            runs = streaming_dump(path, out_path, max_mb << 20, tmp_dir)
+        seconds = perf_counter() - start
+    # kilobytes on linux
+    results.put((seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, runs))
+
+
+def run(mode, path, max_mb=None, tmp_dir=None):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=measure, args=(mode, path, max_mb, tmp_dir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        paths = args.inputs
+        if not paths:
+            paths = [os.path.join(tmp_dir, "synthetic.jsonl.wat.gz")]
+            synthetic_block(paths[0], args.pages, args.images_per_page)
+        # the interpreter and imports alone
+        _, base_mb, _ = run("idle", paths[0])
+        print(f"baseline process: {base_mb:.0f} MB peak RSS")
+        for path in paths:
+            print(f"\n{path} ({os.path.getsize(path) / 2 ** 20:.1f} MB)")
+            # the streaming aggregation without a cap (1 TB), and with each of --max_mb
+            modes = [("legacy", None), ("streaming", 1 << 20)] + [("streaming", max_mb) for max_mb in args.max_mb]
+            for mode, max_mb in modes:
+                seconds, peak_mb, runs = run(mode, path, max_mb, args.tmp_dir)
+                label = mode if mode == "legacy" else f"{mode} (--max_mb {max_mb})" if max_mb < 1 << 20 else f"{mode} (no cap)"
+                print(
+                    f"{label:<32} {seconds:7.1f}s  peak RSS {peak_mb:7.0f} MB ({peak_mb - base_mb:+.0f} MB)"
+                    f"{f', {runs} runs spilled' if runs else ''}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# benchmark commoncrawl_filter on local WAT files (e.g a spool or mirror), without the scheduler or S3
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from bench_leases import percentile
+from filter_server import FILTER_BIN, FilterServer, filter_options
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark commoncrawl_filter_bin on local WAT files")
+    parser.add_argument("inputs", nargs="+", help="WAT files, or directories to search for *.wat.gz")
+    parser.add_argument("--bin", type=str, default=FILTER_BIN)
+    parser.add_argument("--processes", type=int, default=1, help="blocks filtered at once")
+    parser.add_argument("--repeat", type=int, default=1, help="times to filter every file")
+    parser.add_argument("--threads", type=int, default=1, help="threads the filter parses each block with")
+    parser.add_argument("--unordered", action="store_true", help="let the filter write records out of order")
+    parser.add_argument(
+        "--modes", nargs="+", choices=["spawn", "server"], default=["spawn", "server"],
+        help="a new filter process per block, and/or one long-running filter (--server) per process",
+    )
+    return parser.parse_args()
+
+
+def find_wats(inputs):
+    paths = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                paths.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(".wat.gz"))
+        else:
+            paths.append(path)
+    return paths
+
+
+def filter_block(binary, path, out_dir, server=None, options=()):
+    out_path = os.path.join(out_dir, os.path.basename(path).replace(".warc.wat.gz", ".jsonl.wat.gz"))
+    start = perf_counter()
+    if server is not None:
+        stats = server.filter(path, out_path)
+    else:
+        stdout = subprocess.run([binary, *options, path, out_path], stdout=subprocess.PIPE, check=True).stdout
+        stats = {}
+        for line in stdout.decode(errors="replace").splitlines():
+            if line.startswith("{"):
+                stats = json.loads(line)
+    seconds = perf_counter() - start
+    stats.setdefault("bytes_in", os.path.getsize(path))
+    return seconds, stats
+
+
+def run(args, paths, mode):
+    # every thread of the pool gets its own filter server in server mode
+    local = threading.local()
+    servers = []
+    options = filter_options(args.threads, not args.unordered)
+
+    def filter_path(path):
+        if mode == "server" and not hasattr(local, "server"):
+            local.server = FilterServer(args.bin, args=options).start()
+            servers.append(local.server)
+        return filter_block(args.bin, path, out_dir, getattr(local, "server", None), options)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = perf_counter()
+        try:
+            with ThreadPoolExecutor(args.processes) as executor:
+                results = list(executor.map(filter_path, paths))
+        finally:
+            for server in servers:
+                server.close()
+        return perf_counter() - start, results
+
+
+def report(args, mode, wall_seconds, results):
+    seconds = [block_seconds for block_seconds, _ in results]
+    total = lambda key: sum(stats.get(key, 0) for _, stats in results)
+    print(
+        f"\n{mode}: {len(results)} blocks in {wall_seconds:.1f}s with {args.processes} processes x {args.threads} "
+        f"threads"
+    )
+    print(
+        f"per block: p50 {percentile(seconds, 0.5):.2f}s, p99 {percentile(seconds, 0.99):.2f}s, "
+        f"{3600 / (sum(seconds) / len(seconds)) / args.threads:.0f} blocks/hour per core"
+    )
+    print(
+        f"throughput: {len(results) / wall_seconds * 3600:.0f} blocks/hour, "
+        f"{total('bytes_in') / wall_seconds / 2 ** 20:.1f} MB/s in ({total('bytes_raw') / wall_seconds / 2 ** 20:.1f} "
+        f"MB/s decompressed), {total('bytes_out') / wall_seconds / 2 ** 20:.2f} MB/s out, "
+        f"{total('records') / wall_seconds:.0f} records/s"
+    )
+    if total("records"):
+        print(f"kept {total('kept')} of {total('records')} records ({total('kept') / total('records'):.2%})")
+
+
+def main():
+    args = parse_args()
+    paths = find_wats(args.inputs) * args.repeat
+    if not paths:
+        raise SystemExit("no WAT files found")
+    for mode in args.modes:
+        report(args, mode, *run(args, paths, mode))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmark block leasing latency on a large synthetic block table at different stages of completion
+import argparse
+import os
+import sqlite3
+import tempfile
+from time import perf_counter
+
+from db import DB, BlockStatus
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Benchmark DB.get_available_blocks on a synthetic block table")
+    parser.add_argument("--blocks", type=int, default=10_000_000, help="number of synthetic blocks")
+    parser.add_argument("--lease_size", type=int, default=40, help="blocks per lease (processes * 5)")
+    parser.add_argument("--leases", type=int, default=200, help="leases to time per completion level")
+    parser.add_argument("--completion", type=float, nargs="+", default=[0.0, 0.5, 0.99])
+    parser.add_argument("--path", type=str, default=None, help="db path (default: a temp file)")
+    return parser.parse_args()
+
+
+def fill_blocks(path, n_blocks):
+    con = sqlite3.connect(path)
+    con.execute("DROP TABLE IF EXISTS blocks")
+    con.execute(
+        "CREATE TABLE blocks "
+        "(url TEXT, uuid TEXT, status INTEGER, worker_id TEXT, last_updated INTEGER, lease_expires INTEGER)"
+    )
+    con.execute(
+        """
+        WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < ?)
+        INSERT INTO blocks SELECT
+            'crawl-data/CC-MAIN-2021-04/segments/0/wat/CC-MAIN-' || printf('%08d', i) || '.warc.wat.gz',
+            printf('%022d', i), 0, 'N/A', 0, NULL
+        FROM seq
+        """,
+        (n_blocks,),
+    )
+    con.commit()
+    con.close()
+
+
+def set_completion(db, fraction):
+    # mark the first `fraction` of the table completed - the worst case for a scan, since every lease has to
+    # skip over the completed prefix
+    n_completed = int(len(db) * fraction)
+    db.con.execute(
+        "UPDATE blocks SET status = CASE WHEN rowid <= ? THEN ? ELSE ? END",
+        (n_completed, int(BlockStatus.COMPLETED), int(BlockStatus.AVAILABLE)),
+    )
+    db.con.commit()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def time_leases(db, lease_size, n_leases):
+    # through the timer decorator, so the latencies include what recording the query histogram costs the scheduler
+    latencies = []
+    for _ in range(n_leases):
+        start = perf_counter()
+        blocks = db.get_available_blocks(lease_size, worker_id="bench")
+        latencies.append(perf_counter() - start)
+        assert len(blocks) == lease_size, "ran out of available blocks - use fewer leases or a lower completion"
+    return latencies
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = args.path or os.path.join(tmp_dir, "blocks.sql")
+
+        start = perf_counter()
+        fill_blocks(path, args.blocks)
+        print(f"filled {args.blocks} blocks in {perf_counter() - start:.1f}s")
+
+        db = DB(path=path)
+
+        print(f"{'completion':>10} {'p50 (ms)':>10} {'p99 (ms)':>10} {'max (ms)':>10}")
+        for fraction in args.completion:
+            set_completion(db, fraction)
+            latencies = time_leases(db, args.lease_size, args.leases)
+            print(
+                f"{fraction:>10.0%} {percentile(latencies, 0.5) * 1000:>10.2f} "
+                f"{percentile(latencies, 0.99) * 1000:>10.2f} {max(latencies) * 1000:>10.2f}"
+            )
+
+        db.con.close()
@@ -0,0 +1,237 @@
+# load test the scheduler with a fleet of simulated workers against a synthetic block table
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from time import perf_counter
+
+import httpx
+
+import api
+from bench_leases import fill_blocks, percentile
+
+OPS = ["lease", "heartbeat", "complete", "failed"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        "Run scheduler.py on localhost and measure request latency under a fleet of simulated workers"
+    )
+    parser.add_argument("--blocks", type=int, default=1_000_000, help="number of synthetic blocks")
+    parser.add_argument("--workers", type=int, default=2000, help="simulated workers")
+    parser.add_argument("--clients", type=int, default=None, help="load generator processes (default: cpu count)")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run the fleet for")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds over which workers start")
+    parser.add_argument("--slots", type=int, default=8, help="blocks each worker processes at once")
+    parser.add_argument("--block_seconds", type=float, default=5, help="mean simulated seconds per block")
+    parser.add_argument("--heartbeat_interval", type=float, default=10, help="seconds between heartbeats")
+    parser.add_argument("--flush_interval", type=float, default=2, help="seconds between batched reports")
+    parser.add_argument("--fail_rate", type=float, default=0.05, help="fraction of blocks reported failed")
+    parser.add_argument("--connections", type=int, default=100, help="http connections per load generator")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--path", type=str, default=None, help="directory for the block DB (default: a temp dir)")
+    args = parser.parse_args()
+    if args.clients is None:
+        args.clients = multiprocessing.cpu_count()
+    return args
+
+
+class TimedAPI(api.AsyncAPI):
+    """
+    AsyncAPI that records the latency of every call (and any error) by operation
+    """
+
+    def __init__(self, latencies, errors, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = latencies
+        self.errors = errors
+
+    async def _timed(self, op, coro):
+        start = perf_counter()
+        try:
+            response = await coro
+        except Exception:
+            self.errors[op] += 1
+            raise
+        finally:
+            self.latencies[op].append(perf_counter() - start)
+        if isinstance(response, dict) and response.get("message") == "database error":
+            self.errors[op] += 1
+        return response
+
+    async def get_available_blocks(self, n, slots=None):
+        return await self._timed("lease", super().get_available_blocks(n, slots))
+
+    async def _put(self, url, body, params=None):
+        op = url.rstrip("/").rsplit("/", 1)[-1]
+        return await self._timed(op, super()._put(url, body, params))
+
+
+async def _heartbeats(worker, block_ids, interval, aborted):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            response = await worker.heartbeat(block_ids)
+            aborted.update(response.get("abort", []))
+        except Exception:
+            pass
+
+
+async def simulate_worker(worker, args, deadline, counts):
+    # same loop as download_cc.process_wats, with sleeps in place of the filter
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    while time.time() < deadline:
+        try:
+            blocks = await worker.get_available_blocks(args.slots * 5, slots=args.slots)
+        except Exception:
+            await asyncio.sleep(1)
+            continue
+        if isinstance(blocks, dict):
+            counts["idle"] += 1
+            await asyncio.sleep(1)
+            continue
+        counts["leased"] += len(blocks)
+        aborted = set()
+        block_ids = [block["uuid"] for block in blocks]
+        heartbeats = asyncio.ensure_future(_heartbeats(worker, block_ids, args.heartbeat_interval, aborted))
+        try:
+            for i in range(0, len(blocks), args.slots):
+                duration = random.expovariate(1 / args.block_seconds)
+                await asyncio.sleep(duration)
+                for block_id in block_ids[i:i + args.slots]:
+                    if block_id in aborted:
+                        counts["aborted"] += 1
+                    elif random.random() < args.fail_rate:
+                        worker.report_failed(block_id)
+                        counts["failed"] += 1
+                    else:
+                        worker.report_complete(block_id, duration, random.randint(1 << 20, 1 << 24))
+                        counts["completed"] += 1
+        finally:
+            heartbeats.cancel()
+
+
+async def _run_fleet(args, n_workers, deadline):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    counts = defaultdict(int)
+    async with httpx.AsyncClient(
+        timeout=60, limits=httpx.Limits(max_connections=args.connections, max_keepalive_connections=args.connections)
+    ) as client:
+        workers = [
+            TimedAPI(
+                latencies, errors, port=str(args.port), client=client, flush_interval=args.flush_interval
+            )
+            for _ in range(n_workers)
+        ]
+        for worker in workers:
+            worker.start_reporter()
+        fleet = [asyncio.ensure_future(simulate_worker(worker, args, deadline, counts)) for worker in workers]
+        # workers stop leasing at the deadline, blocks still being "processed" then are abandoned
+        _, running = await asyncio.wait(fleet, timeout=max(deadline - time.time(), 0))
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        await asyncio.gather(*(worker.close() for worker in workers))
+    return dict(latencies), dict(errors), dict(counts)
+
+
+def run_fleet(n_workers, args, deadline):
+    return asyncio.run(_run_fleet(args, n_workers, deadline))
+
+
+def start_scheduler(workdir, port):
+    # runs in `workdir` so scheduler.py picks up the synthetic blocks.sql, its output goes to scheduler.log
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    log = open(os.path.join(workdir, "scheduler.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "scheduler:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    for _ in range(600):
+        if server.poll() is not None:
+            raise RuntimeError(f"scheduler exited, see {log.name}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/blocks/count").raise_for_status()
+            return server
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("scheduler didn't start within a minute")
+
+
+def report(args, elapsed, latencies, errors, counts, before, after):
+    total = sum(len(values) for values in latencies.values())
+    print(f"\n{args.workers} workers for {elapsed:.0f}s, {total / elapsed:.0f} requests/s")
+    print(f"{'op':<10} {'calls':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>7}")
+    for op in OPS:
+        values = latencies.get(op)
+        if not values:
+            continue
+        print(
+            f"{op:<10} {len(values):>8} {len(values) / elapsed:>8.1f} {percentile(values, 0.5) * 1000:>8.1f} "
+            f"{percentile(values, 0.99) * 1000:>8.1f} {max(values) * 1000:>8.1f} {errors.get(op, 0):>7}"
+        )
+    print(
+        f"blocks: {counts.get('leased', 0)} leased, {counts.get('completed', 0)} completed, "
+        f"{counts.get('failed', 0)} failed, {counts.get('aborted', 0)} aborted, {counts.get('idle', 0)} empty leases"
+    )
+    print(f"scheduler: {after['completed'] - before['completed']} blocks completed")
+    writer = {key: after["writer"][key] - before["writer"][key] for key in after["writer"]}
+    calls = max(writer["calls"], 1)
+    print(
+        f"db writer: {writer['calls']} calls in {writer['batches']} transactions "
+        f"({writer['calls'] / max(writer['batches'], 1):.1f} calls each), "
+        f"busy {writer['busy_seconds'] / elapsed:.0%} of the time, "
+        f"mean queue wait {writer['queue_seconds'] / calls * 1000:.1f} ms, "
+        f"max {after['writer']['max_queue_seconds'] * 1000:.1f} ms, "
+        f"{writer['locked_errors']} locked errors"
+    )
+
+
+def main():
+    args = parse_args()
+    workdir = args.path or tempfile.mkdtemp(prefix="bench_scheduler_")
+    os.makedirs(workdir, exist_ok=True)
+    db_path = os.path.join(workdir, "blocks.sql")
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    print(f"Creating {args.blocks} synthetic blocks in {db_path}")
+    fill_blocks(db_path, args.blocks)
+    server = start_scheduler(workdir, args.port)
+    try:
+        scheduler = api.API(port=str(args.port))
+        before = scheduler.get_stats()
+        start = time.time()
+        deadline = start + args.duration
+        # split the fleet over several processes so the load generator isn't the bottleneck
+        shares = [args.workers // args.clients + (i < args.workers % args.clients) for i in range(args.clients)]
+        with multiprocessing.Pool(args.clients) as pool:
+            results = pool.starmap(run_fleet, [(share, args, deadline) for share in shares if share])
+        elapsed = time.time() - start
+        after = scheduler.get_stats()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    counts = defaultdict(int)
+    for fleet_latencies, fleet_errors, fleet_counts in results:
+        for op, values in fleet_latencies.items():
+            latencies[op].extend(values)
+        for op, n in fleet_errors.items():
+            errors[op] += n
+        for key, n in fleet_counts.items():
+            counts[key] += n
+    report(args, elapsed, latencies, errors, counts, before, after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+# compact binary url / dedup shards: records keyed by their 16 byte url hash, in zlib compressed blocks with an index
+# of each block's hash range, read through mmap so records can be routed and merged by hash without decoding them
+#
+# layout: MAGIC and a byte for how blocks are compressed (BLOCK_CODECS), then blocks, then the index (INDEX_ENTRY per
+# block), then FOOTER. A block is a run of records, each a 16 byte hash, a u32 payload length and the payload,
+# compressed together. The payload is the record's json without
+# its "hash" field, which readers add back from the binary hash (repeating it costs more than a tenth of the size)
+import argparse
+import mmap
+import os
+import struct
+import zlib
+from glob import glob
+from multiprocessing import Pool, set_start_method
+from pathlib import Path
+
+from tqdm import tqdm
+
+from codec import Codec
+from compression import Compression, open_reader, zstandard
+from shards import Manifest, ShardWriter, _HashingFile, commit, complete_inputs, discard, temp_path
+
+MAGIC = b"CCRB"
+# block compression: zlib for gzip and pgzip, or zstd, per the SHARD_COMPRESSION setting
+ZLIB_BLOCKS = 1
+ZSTD_BLOCKS = 2
+BLOCK_CODECS = {"gzip": ZLIB_BLOCKS, "pgzip": ZLIB_BLOCKS, "zstd": ZSTD_BLOCKS}
+SUFFIX = ".ccr"
+HASH_BYTES = 16
+RECORD_HEADER = struct.Struct("<16sI")
+# offset, compressed bytes, raw bytes, records, first hash, last hash
+INDEX_ENTRY = struct.Struct("<QIII16s16s")
+# index offset, blocks, records, magic
+FOOTER = struct.Struct("<QIQ4s")
+# raw bytes of records compressed together
+BLOCK_BYTES = 1 << 20
+
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def binary_path(path):
+    """
+    Gets the name a jsonl shard at `path` has as a binary shard, e.g x.jsonl.wat.gz -> x.ccr
+    """
+    for ext in (".gz", ".wat", ".jsonl"):
+        if path.endswith(ext):
+            path = path[:-len(ext)]
+    return path + SUFFIX
+
+
+class BinaryShardWriter:
+    """
+    Writes a binary shard under a temporary name, the same way (and with the same commit / discard / context manager
+    behaviour) as shards.ShardWriter writes a jsonl one
+    """
+
+    def __init__(self, path, manifest=None, level=None, block_bytes=BLOCK_BYTES, compression=None):
+        self.path = path
+        self.manifest = manifest
+        self.tmp_path = temp_path(path)
+        self.compression = Compression.from_env(level) if compression is None else compression
+        self.codec = BLOCK_CODECS[self.compression.name]
+        if self.codec == ZSTD_BLOCKS:
+            self.compress = zstandard.ZstdCompressor(level=self.compression.level).compress
+        else:
+            self.compress = lambda data: zlib.compress(data, self.compression.level)
+        self.block_bytes = block_bytes
+        self.records = 0
+        self.raw = open(self.tmp_path, "wb")
+        self.hashing = _HashingFile(self.raw)
+        self.hashing.write(MAGIC + bytes([self.codec]))
+        self.index = []
+        self.block = []
+        self.block_size = 0
+        self.block_hashes = None
+        self.closed = False
+
+    def write_record(self, h, payload):
+        """
+        Adds a record with the 16 byte hash `h` and the json `payload` (without a newline, or a "hash" field)
+        """
+        self.block.append(RECORD_HEADER.pack(h, len(payload)))
+        self.block.append(payload)
+        self.block_size += RECORD_HEADER.size + len(payload)
+        if self.block_hashes is None:
+            self.block_hashes = [h, h, 0]
+        else:
+            # not necessarily sorted, so the range is a min and max
+            self.block_hashes[0] = min(self.block_hashes[0], h)
+            self.block_hashes[1] = max(self.block_hashes[1], h)
+        self.block_hashes[2] += 1
+        self.records += 1
+        if self.block_size >= self.block_bytes:
+            self._flush()
+
+    def _flush(self):
+        if not self.block:
+            return
+        data = self.compress(b"".join(self.block))
+        first, last, n = self.block_hashes
+        self.index.append(INDEX_ENTRY.pack(self.hashing.size, len(data), self.block_size, n, first, last))
+        self.hashing.write(data)
+        self.block = []
+        self.block_size = 0
+        self.block_hashes = None
+
+    def close(self):
+        """
+        Finishes the temporary file, returns (tmp path, path, records, bytes, md5)
+        """
+        if not self.closed:
+            self._flush()
+            index_offset = self.hashing.size
+            self.hashing.write(b"".join(self.index))
+            self.hashing.write(FOOTER.pack(index_offset, len(self.index), self.records, MAGIC))
+            self.raw.close()
+            self.closed = True
+        return self.tmp_path, self.path, self.records, self.hashing.size, self.hashing.md5.hexdigest()
+
+    def commit(self):
+        tmp_path, path, records, size, md5 = self.close()
+        return commit(tmp_path, path, records, self.manifest, size, md5)
+
+    def discard(self):
+        self.close()
+        discard(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+class BinaryShard:
+    """
+    A memory-mapped binary shard. `index` holds (offset, compressed bytes, raw bytes, records, first hash, last hash)
+    per block, so readers can skip the blocks outside a hash range without decompressing them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC or len(self.mm) < len(MAGIC) + 1 + FOOTER.size:
+            self.mm.close()
+            raise ValueError(f"{path} isn't a binary shard")
+        index_offset, blocks, self.n_records, magic = FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{path} is cut short")
+        self.codec = self.mm[len(MAGIC)]
+        if self.codec == ZSTD_BLOCKS:
+            if zstandard is None:
+                self.mm.close()
+                raise ValueError(f"{path} has zstd compressed blocks, reading it needs the zstandard package")
+            self.decompress = zstandard.ZstdDecompressor().decompress
+        else:
+            self.decompress = zlib.decompress
+        self.index = [INDEX_ENTRY.unpack_from(self.mm, index_offset + i * INDEX_ENTRY.size) for i in range(blocks)]
+
+    def __len__(self):
+        return self.n_records
+
+    def block(self, i):
+        offset, size, raw_size, _, _, _ = self.index[i]
+        if self.codec == ZSTD_BLOCKS:
+            return self.decompress(self.mm[offset:offset + size], max_output_size=raw_size)
+        return self.decompress(self.mm[offset:offset + size], bufsize=raw_size)
+
+    def records(self, lo=None, hi=None, blocks=None):
+        """
+        Yields (hash, payload) of the records, only those with lo <= hash <= hi if given (blocks whose range is
+        outside are skipped), and only those in the range of block numbers `blocks` if given
+        """
+        unpack = RECORD_HEADER.unpack_from
+        header = RECORD_HEADER.size
+        for i, (_, _, _, _, first, last) in enumerate(self.index):
+            if blocks is not None and i not in blocks:
+                continue
+            if (lo is not None and last < lo) or (hi is not None and first > hi):
+                continue
+            data = self.block(i)
+            pos = 0
+            while pos < len(data):
+                h, n = unpack(data, pos)
+                pos += header
+                if (lo is None or h >= lo) and (hi is None or h <= hi):
+                    yield h, data[pos:pos + n]
+                pos += n
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def with_hash(h, payload):
+    """
+    Gets a binary record's json with its "hash" field
+    """
+    return payload[:-1] + b',"hash":"' + h.hex().encode() + b'"}'
+
+
+def hashed_lines(path):
+    """
+    Yields (hash, payload) of the records of a jsonl shard, `<hash> <json>` lines (dump_urls' output) or plain ones
+    """
+    codec = Codec()
+    with open_reader(path) as f:
+        for lines in codec.batches(f):
+            for line in lines:
+                if not line.startswith(b"{"):
+                    line = line.partition(b" ")[2]
+                record = codec.loads(line)
+                h = bytes.fromhex(record.pop("hash"))
+                yield h, codec.dumps(record)
+
+
+def read_hashed(path, blocks=None):
+    """
+    Yields (hash, payload) of the records of a binary or jsonl shard (only the range of block numbers `blocks` of a
+    binary one, if given)
+    """
+    if is_binary(path):
+        with BinaryShard(path) as shard:
+            yield from shard.records(blocks=blocks)
+    else:
+        yield from hashed_lines(path)
+
+
+def hash_bucket(h, levels):
+    """
+    Gets the bucket of the 16 byte hash `h` among 16 ** `levels`, by its first `levels` hex digits
+    """
+    return int.from_bytes(h[:(levels + 1) // 2], "big") >> (4 * (levels % 2))
+
+
+def read_records(path, codec):
+    """
+    Yields the decoded records of a binary or jsonl shard
+    """
+    if is_binary(path):
+        with BinaryShard(path) as shard:
+            for h, payload in shard.records():
+                codec.counts["records"] += 1
+                record = codec.loads(payload)
+                record["hash"] = h.hex()
+                yield record
+    else:
+        yield from codec.read_jsonl(path)
+
+
+def to_binary(in_path, out_path, manifest=None):
+    """
+    Converts the jsonl shard `in_path` to a binary one, returns its records
+    """
+    with BinaryShardWriter(out_path, manifest) as writer:
+        for h, payload in hashed_lines(in_path):
+            writer.write_record(h, payload)
+    return writer.records
+
+
+def to_jsonl(in_path, out_path, manifest=None, hashed=False):
+    """
+    Converts the binary shard `in_path` to jsonl, as `<hash> <json>` lines like dump_urls writes if `hashed`
+    """
+    with ShardWriter(out_path, manifest) as writer, BinaryShard(in_path) as shard:
+        for h, payload in shard.records():
+            line = with_hash(h, payload) + b"\n"
+            writer.write(h.hex().encode() + b" " + line if hashed else line)
+    return writer.records
+
+
+def convert(x):
+    direction, in_path, out_path, out_dir, hashed = x
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(out_dir)
+    if direction == "to_bin":
+        return to_binary(in_path, out_path, manifest)
+    return to_jsonl(in_path, out_path, manifest, hashed)
+
+
+def output_name(in_path, input_dir, output_dir, direction):
+    path = in_path.replace(input_dir, output_dir, 1)
+    if direction == "to_bin":
+        return binary_path(path)
+    return path[:-len(SUFFIX)] + ".jsonl.gz" if path.endswith(SUFFIX) else path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Convert a stage's shards between jsonl.gz and the binary format")
+    parser.add_argument("direction", choices=["to_bin", "to_jsonl"])
+    parser.add_argument("threads", type=int)
+    parser.add_argument("input_dir", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument(
+        "--hashed", action="store_true", help="write `<hash> <json>` lines, like dump_urls (to_jsonl of its output)"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    set_start_method("spawn")
+    args = parse_args()
+
+    # complete shards in the other format, and only those not converted by an earlier run
+    input_files = [
+        i for i in complete_inputs(args.input_dir, glob(f"{args.input_dir}/**/*", recursive=True))
+        if os.path.isfile(i) and not i.endswith("manifest.jsonl") and is_binary(i) == (args.direction == "to_jsonl")
+    ]
+    output_files = [output_name(i, args.input_dir, args.output_dir, args.direction) for i in input_files]
+    done = set(Manifest(args.output_dir).complete(output_files))
+    todo = [(i, o) for i, o in zip(input_files, output_files) if o not in done]
+
+    p = Pool(args.threads)
+    tasks = [(args.direction, i, o, args.output_dir, args.hashed) for i, o in todo]
+    records = list(tqdm(p.imap_unordered(convert, tasks), total=len(tasks), desc=args.direction))
+    print(f"{len(records)} shards, {sum(records)} records converted")
@@ -0,0 +1,195 @@
+# image url canonicalization: site specific rules (replace thumbnails, get full res images, skip proxies etc) looked up
+# by host through a reversed-domain trie, with the results of hot links cached
+import re
+from functools import lru_cache
+from urllib.parse import urlparse, urljoin
+
+# resolved links kept in the cache, and hosts whose rule is kept
+CACHE_SIZE = 1 << 16
+HOST_CACHE_SIZE = 1 << 14
+# absolute links that urljoin and urlparse(...).geturl() leave exactly as they are: a lowercase http(s) scheme, a plain
+# host (and port), and no params, empty query or fragment, whitespace or control characters. Without a rule for their
+# host these are already canonical, which is most links
+SIMPLE_URL_RE = re.compile(
+    r"https?://([A-Za-z0-9.-]+)(?::\d+)?"
+    r"(?:/[^?#;\x00-\x20\x7f]*)?(?:\?[^#\x00-\x20\x7f]+)?(?:#[^\x00-\x20\x7f]+)?\Z"
+)
+
+
+def canonicalize_wikimedia(url):
+    path = url.path.split("/")
+
+    if "thumb" in path:
+        path = path[:-1]
+        path.remove("thumb")
+
+    path = "/".join(path)
+
+    return url._replace(path=path, scheme="http", params='', query='', fragment='')
+
+
+def canonicalize_wp(url):
+    target_url = url.path[1:]
+    return urlparse(target_url)
+
+
+def canonicalize_ytimg(url):
+    path = url.path
+    larger_suffixes = {"sddefault",  # 640
+                       "maxresdefault",  # original
+                       }
+
+    *path, fname = path.split("/")
+    option, _ = fname.split(".")
+
+    if option not in larger_suffixes:
+        option = "0"
+
+    fname = f"{option}.jpg"
+    path = "/".join(path + [fname])
+
+    return url._replace(path=path, netloc="i.ytimg.com", scheme="http", params='', query='', fragment='')
+
+
+# replace all suffixes with default (500x500) unless its larger
+def canonicalize_flickr(url):
+    path = url.path
+
+    larger_suffixes = {"z",  # 640
+                       "c",  # 800
+                       "b",  # 1024
+                       }
+
+    path, ext = path.split(".")
+    if path[-2] == "_":
+        if path[-1] not in larger_suffixes:
+            path = path[:-2]
+
+    return url._replace(path=f"{path}.{ext}", scheme="http", params='', query='', fragment='')
+
+
+# keys of a trie node holding its rules, next to the child labels
+_SUFFIX = object()
+_EXACT = object()
+
+
+class HostTrie:
+    """
+    Rules keyed by reversed domain labels (com -> flickr -> ...), so looking a host up costs one dict lookup per label
+    it shares with a registered domain - usually one or two - however many rules there are. A suffix rule for
+    `flickr.com` matches flickr.com and any subdomain, an exact rule only the host itself; the most specific match wins.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, host, rule, suffix=True):
+        node = self.root
+        for label in reversed(host.lower().strip(".").split(".")):
+            node = node.setdefault(label, {})
+        node[_SUFFIX if suffix else _EXACT] = rule
+
+    def find(self, host):
+        node = self.root
+        rule = None
+        labels = host.split(".")
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.get(labels[i])
+            if node is None:
+                return rule
+            rule = node.get(_SUFFIX, rule)
+        return node.get(_EXACT, rule)
+
+
+def _host(netloc):
+    # host part of a netloc, without credentials or port
+    if "@" in netloc:
+        netloc = netloc.rpartition("@")[2]
+    if ":" in netloc and not netloc.endswith("]"):
+        netloc = netloc.rpartition(":")[0]
+    return netloc.lower()
+
+
+def _has_host(href):
+    # whether an http(s) link has a host of its own, e.g not http:///path
+    rest = href.partition("://")[2]
+    return bool(rest) and rest[0] not in "/?#"
+
+
+class Canonicalizer:
+    """
+    Canonicalizes image urls with the rule registered for their host (see `add_rule`), leaving other urls as
+    urlparse normalizes them. Links that are already canonical (see SIMPLE_URL_RE) are returned without parsing them.
+
+    `resolve(base, href)` joins a link to the page it's on and canonicalizes it, caching the last `cache_size` results.
+    An absolute href joins the same way against any page with the same scheme, so the cache is keyed on just the
+    scheme for those - the same CDN image linked from a million pages is one entry.
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.rules = HostTrie()
+        self.rule_for = lru_cache(HOST_CACHE_SIZE)(self._rule_for)
+        self._resolve_cached = lru_cache(cache_size)(self._resolve)
+
+    def add_rule(self, host, fn, suffix=True):
+        """
+        Canonicalizes the urls on `host` (and its subdomains if `suffix`) with `fn(parsed url) -> parsed url`
+        """
+        self.rules.add(host, fn, suffix)
+        self.rule_for.cache_clear()
+        self._resolve_cached.cache_clear()
+
+    def _rule_for(self, netloc):
+        return self.rules.find(_host(netloc))
+
+    def canonicalize(self, url):
+        parsed = urlparse(url)
+        fn = self.rule_for(parsed.netloc)
+        if fn is not None:
+            return fn(parsed).geturl()
+        return parsed.geturl()
+
+    def _resolve(self, base, href):
+        return self.canonicalize(urljoin(base, href))
+
+    def resolve(self, base, href):
+        """
+        Gets the canonical url of the link `href` on the page at `base`
+        """
+        simple = SIMPLE_URL_RE.match(href)
+        if simple is not None and self.rule_for(simple.group(1)) is None:
+            return href
+        if href.startswith(("http://", "https://")) and _has_host(href) and "://" in base:
+            # only the base's scheme matters for an href with its own scheme and host
+            base = base.partition(":")[0].lower() + "://"
+        return self._resolve_cached(base, href)
+
+    def resolve_links(self, base, hrefs):
+        """
+        Gets the canonical urls of a page's links, None for links that can't be canonicalized
+        """
+        resolve = self.resolve
+        urls = []
+        for href in hrefs:
+            try:
+                urls.append(resolve(base, href))
+            except Exception:
+                urls.append(None)
+        return urls
+
+    def cache_info(self):
+        return self._resolve_cached.cache_info()
+
+
+CANONICALIZER = Canonicalizer()
+CANONICALIZER.add_rule("flickr.com", canonicalize_flickr)
+CANONICALIZER.add_rule("staticflickr.com", canonicalize_flickr)
+CANONICALIZER.add_rule("img.youtube.com", canonicalize_ytimg)
+CANONICALIZER.add_rule("ytimg.com", canonicalize_ytimg)
+CANONICALIZER.add_rule("wp.com", canonicalize_wp)
+CANONICALIZER.add_rule("upload.wikimedia.org", canonicalize_wikimedia)
+
+
+# replace thumbnails, try to get full res images, skip proxies etc
+def canonicalize_url(url):
+    return CANONICALIZER.canonicalize(url)
@@ -0,0 +1,161 @@
+# json encoding and decoding of the stages' jsonl records, through orjson when it's installed and the standard library
+# otherwise. JSON_BACKEND (stdlib or orjson) picks one explicitly, and carries over to pool processes
+import json
+import os
+from collections import Counter
+
+from compression import READ_ERRORS, open_reader
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENV_VAR = "JSON_BACKEND"
+# roughly how many bytes of lines are read and decoded at a time
+BATCH_BYTES = 1 << 20
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj).encode()
+
+
+class StdlibBackend:
+    name = "stdlib"
+    loads = staticmethod(json.loads)
+    dumps = staticmethod(_stdlib_dumps)
+
+
+class OrjsonBackend:
+    name = "orjson"
+    # the library's own functions, not wrappers, so a record costs a single call
+    loads = staticmethod(orjson.loads) if orjson is not None else None
+    dumps = staticmethod(orjson.dumps) if orjson is not None else None
+
+
+BACKENDS = {"stdlib": StdlibBackend}
+if orjson is not None:
+    BACKENDS["orjson"] = OrjsonBackend
+
+
+def default_backend():
+    name = os.environ.get(ENV_VAR)
+    if name:
+        if name not in BACKENDS:
+            raise ValueError(f"{ENV_VAR}={name} isn't available, the JSON backends here are {sorted(BACKENDS)}")
+        return name
+    return "orjson" if "orjson" in BACKENDS else "stdlib"
+
+
+class Codec:
+    """
+    Decodes and encodes jsonl records (bytes in, bytes out) with a backend from BACKENDS, counting what it does in
+    `counts`: records decoded and encoded, lines that aren't valid JSON (`errors`, skipped), inputs cut short
+    (`truncated`) and records the backend rejected but the standard library took (`fallbacks`) - orjson is stricter
+    about NaN, lone surrogates and non-string keys, so those still go through the same as before. (It does read
+    integers over 64 bits as floats, which none of the stages' records have.)
+
+    Both backends read anything either writes. Output is the same JSON up to whitespace and escaping (orjson writes
+    compact utf-8, the standard library ", " separators and \\u escapes).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = BACKENDS[backend or default_backend()]
+        self.name = self.backend.name
+        self.counts = Counter()
+
+    def loads(self, data):
+        """
+        Decodes one record, raises ValueError if it isn't valid JSON
+        """
+        try:
+            return self.backend.loads(data)
+        except ValueError:
+            if self.backend is StdlibBackend:
+                raise
+        record = json.loads(data)
+        self.counts["fallbacks"] += 1
+        return record
+
+    def dumps(self, obj):
+        try:
+            return self.backend.dumps(obj)
+        except TypeError:
+            if self.backend is StdlibBackend:
+                raise
+        self.counts["fallbacks"] += 1
+        return _stdlib_dumps(obj)
+
+    def dump_line(self, obj):
+        """
+        Encodes one record as a jsonl line (with its newline)
+        """
+        self.counts["encoded"] += 1
+        return self.dumps(obj) + b"\n"
+
+    def decode_batch(self, lines):
+        """
+        Decodes a list of lines, skipping (and counting) those that aren't valid JSON
+        """
+        loads = self.backend.loads
+        try:
+            records = [loads(line) for line in lines]
+        except ValueError:
+            # only batches with a bad line go line by line
+            records = []
+            for line in lines:
+                try:
+                    records.append(self.loads(line))
+                except ValueError:
+                    self.counts["errors"] += 1
+        self.counts["records"] += len(records)
+        return records
+
+    def batches(self, f, partial=False):
+        """
+        Yields lists of the lines of the binary file `f`, about BATCH_BYTES at a time. With `partial`, an input that's
+        cut short (a truncated or corrupt compressed file) ends at the last complete batch and is counted as `truncated`,
+        otherwise the error is raised
+        """
+        while True:
+            try:
+                lines = f.readlines(BATCH_BYTES)
+            except READ_ERRORS:
+                if not partial:
+                    raise
+                self.counts["truncated"] += 1
+                return
+            if not lines:
+                return
+            yield lines
+
+    def records(self, f, partial=False):
+        """
+        Yields the records of the jsonl file `f`, decoded a batch at a time
+        """
+        for lines in self.batches(f, partial):
+            yield from self.decode_batch(lines)
+
+    def read_jsonl(self, path, partial=False):
+        """
+        Yields the records of the (gzip or zstd compressed) jsonl file at `path`
+        """
+        with open_reader(path) as f:
+            yield from self.records(f, partial)
+
+
+def summarize(counts):
+    """
+    Describes the combined `counts` of several codecs (e.g returned by pool processes) for a stage's final report
+    """
+    total = Counter()
+    for c in counts:
+        total.update(c or {})
+    summary = f"{total['records']} records read, {total['errors']} invalid lines skipped"
+    summary += f", {total['truncated']} inputs cut short"
+    if total["encoded"]:
+        summary += f", {total['encoded']} records written"
+    # whatever else the stage counted, e.g records it couldn't process
+    for key in sorted(set(total) - {"records", "errors", "truncated", "encoded"}):
+        summary += f", {total[key]} {key.replace('_', ' ')}"
+    return summary
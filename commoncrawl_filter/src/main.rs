@@ -1,7 +1,13 @@
 use warc::WarcReader;
 use std::str;
-use std::fs::OpenOptions;
-use std::io::{BufReader, Write};
+use std::fs::{File, OpenOptions};
+use std::io::{BufRead, BufWriter, Read, Write};
+use std::collections::BTreeMap;
+use std::mem;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::mpsc;
+use std::sync::{Arc, Mutex};
+use std::thread;
 use flate2::read::MultiGzDecoder;
 use flate2::write::GzEncoder;
 #[macro_use]
@@ -140,55 +146,421 @@ struct Wrapper {
     envelope: Envelope
 }
 
-fn main() -> Result<(), std::io::Error> {
-    let args: Vec<String> = env::args().collect();
+// counts the bytes read from / written to the wrapped reader or writer
+struct Counting<T> {
+    inner: T,
+    count: Arc<AtomicU64>
+}
 
-    assert_eq!(args.len(), 3, "please call commoncrawl_filter <input url> <output_path>");
+impl<T> Counting<T> {
+    fn new(inner: T) -> (Counting<T>, Arc<AtomicU64>) {
+        let count = Arc::new(AtomicU64::new(0));
+        (Counting { inner, count: count.clone() }, count)
+    }
+}
 
-    // let mut file = OpenOptions::new().read(true).open("CC-MAIN-20210115134101-20210115164101-00000.warc.wat.gz")?;
-    // "http://commoncrawl.s3.amazonaws.com/crawl-data/CC-MAIN-2021-04/segments/1610703495901.0/wat/CC-MAIN-20210115134101-20210115164101-00000.warc.wat.gz"
-    let response = ureq::get(&args[1]).call().unwrap();
-    let file = response.into_reader();
+impl<R: Read> Read for Counting<R> {
+    fn read(&mut self, buf: &mut [u8]) -> std::io::Result<usize> {
+        let n = self.inner.read(buf)?;
+        self.count.fetch_add(n as u64, Ordering::Relaxed);
+        Ok(n)
+    }
+}
 
-    let gz = MultiGzDecoder::new(file);
-    let text = BufReader::with_capacity(1024*1024*16, gz);
-    let file = WarcReader::new(text);
+impl<W: Write> Write for Counting<W> {
+    fn write(&mut self, buf: &[u8]) -> std::io::Result<usize> {
+        let n = self.inner.write(buf)?;
+        self.count.fetch_add(n as u64, Ordering::Relaxed);
+        Ok(n)
+    }
 
-    // CC-MAIN-20210115134101-20210115164101-00000.warc.wat.jsonl.gz
-    let outfile = OpenOptions::new().create(true).write(true).truncate(true).open(&args[2])?;
-    let mut outfile_writer = GzEncoder::new(outfile, Compression::new(3));
+    fn flush(&mut self) -> std::io::Result<()> {
+        self.inner.flush()
+    }
+}
+
+// a BufReader over a caller-owned buffer, so one 16MiB buffer can be reused for every block in server mode
+struct SharedBufReader<'a, R> {
+    inner: R,
+    buf: &'a mut [u8],
+    pos: usize,
+    cap: usize
+}
+
+impl<'a, R: Read> SharedBufReader<'a, R> {
+    fn new(inner: R, buf: &'a mut [u8]) -> SharedBufReader<'a, R> {
+        SharedBufReader { inner, buf, pos: 0, cap: 0 }
+    }
+}
+
+impl<'a, R: Read> Read for SharedBufReader<'a, R> {
+    fn read(&mut self, out: &mut [u8]) -> std::io::Result<usize> {
+        let n = {
+            let available = self.fill_buf()?;
+            let n = available.len().min(out.len());
+            out[..n].copy_from_slice(&available[..n]);
+            n
+        };
+        self.consume(n);
+        Ok(n)
+    }
+}
+
+impl<'a, R: Read> BufRead for SharedBufReader<'a, R> {
+    fn fill_buf(&mut self) -> std::io::Result<&[u8]> {
+        if self.pos >= self.cap {
+            self.cap = self.inner.read(self.buf)?;
+            self.pos = 0;
+        }
+        Ok(&self.buf[self.pos..self.cap])
+    }
+
+    fn consume(&mut self, amt: usize) {
+        self.pos = (self.pos + amt).min(self.cap);
+    }
+}
+
+struct Stats {
+    records: u64,
+    kept: u64,
+    errors: u64,
+    bytes_in: u64,
+    // decompressed bytes in
+    bytes_raw: u64,
+    bytes_out: u64
+}
+
+impl Stats {
+    fn to_json(&self) -> serde_json::Value {
+        serde_json::json!({
+            "records": self.records,
+            "kept": self.kept,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_raw": self.bytes_raw,
+            "bytes_out": self.bytes_out
+        })
+    }
+}
+
+// blocks can be read straight from S3, or from a local (e.g spooled) copy
+fn open_input(agent: &ureq::Agent, input: &str) -> Result<Box<dyn Read + Send>, String> {
+    if input.starts_with("http://") || input.starts_with("https://") {
+        let response = agent.get(input).call().map_err(|e| format!("{}: {}", input, e))?;
+        Ok(Box::new(response.into_reader()))
+    } else {
+        let path = input.strip_prefix("file://").unwrap_or(input);
+        Ok(Box::new(File::open(path).map_err(|e| format!("{}: {}", path, e))?))
+    }
+}
+
+struct Options {
+    // parse/filter worker threads per block, 1 does everything on the calling thread
+    threads: usize,
+    // with several threads, write records in input order (otherwise in whatever order batches finish)
+    ordered: bool,
+    // write plain jsonl rather than compressed, e.g into a pipe read by the worker
+    raw: bool,
+    // how the output is compressed otherwise
+    compression: OutputCompression
+}
+
+#[derive(Debug, Clone, Copy, PartialEq)]
+enum OutputCompression {
+    Gzip(u32),
+    Zstd(i32)
+}
+
+impl OutputCompression {
+    // parses the pipeline's SHARD_COMPRESSION setting, e.g "gzip:6" or "zstd:3" ("pgzip" is plain gzip here, blocks
+    // are already parsed on several threads)
+    fn parse(spec: &str) -> Option<OutputCompression> {
+        let mut parts = spec.trim().split(':');
+        let name = parts.next()?;
+        let level = parts.next().filter(|l| !l.is_empty());
+        match name {
+            "gzip" | "pgzip" => Some(OutputCompression::Gzip(level.map_or(Some(6), |l| l.parse().ok())?)),
+            "zstd" => Some(OutputCompression::Zstd(level.map_or(Some(3), |l| l.parse().ok())?)),
+            _ => None
+        }
+    }
+
+    // gzip level 3 unless SHARD_COMPRESSION says otherwise
+    fn from_env() -> OutputCompression {
+        match env::var("SHARD_COMPRESSION") {
+            Ok(spec) if !spec.trim().is_empty() => {
+                OutputCompression::parse(&spec).expect("SHARD_COMPRESSION should be gzip, pgzip or zstd[:level]")
+            },
+            _ => OutputCompression::Gzip(3)
+        }
+    }
+}
+
+// records handed to a worker thread at a time
+const BATCH_RECORDS: usize = 256;
+
+// returns the filtered json line for a record worth keeping, None otherwise
+fn filter_record(body: &[u8]) -> Result<Option<String>, String> {
+    let has_img = twoway::find_bytes(body, b"IMG@/").is_some();
+    let has_alt = twoway::find_bytes(body, b"\"alt\":").is_some();
+    let has_cc = twoway::find_bytes(body, b"creativecommons.org").is_some();
+
+    let process_more = has_alt && has_img && has_cc;
+    if !process_more {
+        return Ok(None);
+    }
 
+    let mut w: Wrapper = serde_json::from_slice(body).map_err(|e| e.to_string())?;
+    w.envelope.payload.response.response.filter();
+
+    serde_json::to_string(&w).map(Some).map_err(|e| e.to_string())
+}
+
+fn write_line<W: Write>(out: &mut W, line: &str) -> Result<(), String> {
+    out.write_all(line.as_bytes()).map_err(|e| e.to_string())?;
+    out.write_all(b"\n").map_err(|e| e.to_string())
+}
+
+// filters every record on the calling thread, returns (records, kept, unreadable records)
+fn filter_serial<R: BufRead, W: Write>(records: WarcReader<R>, out: &mut W) -> Result<(u64, u64, u64), String> {
     let mut count = 0;
     let mut has_both = 0;
-    for record in file {
+    let mut errors = 0;
+    for record in records {
         count += 1;
         match record {
-            Err(err) => println!("ERROR: {}\r\n", err),
+            Err(err) => {
+                errors += 1;
+                eprintln!("ERROR: {}\r\n", err)
+            },
             Ok(record) => {
-                let has_img = twoway::find_bytes(&record.body, b"IMG@/").is_some();
-                let has_alt = twoway::find_bytes(&record.body, b"\"alt\":").is_some();
-                let has_cc = twoway::find_bytes(&record.body, b"creativecommons.org").is_some();
+                if let Some(line) = filter_record(&record.body)? {
+                    has_both += 1;
+                    write_line(out, &line)?;
+                }
+            }
+        }
+    }
+    Ok((count, has_both, errors))
+}
 
-                let process_more = has_alt && has_img && has_cc;
+// a reader thread (decompression and WARC parsing) sends batches of records to `threads` workers (json parsing and
+// filtering), and the calling thread writes their output, in input order if `ordered`
+fn filter_parallel<R: BufRead + Send, W: Write>(
+    records: WarcReader<R>, out: &mut W, threads: usize, ordered: bool
+) -> Result<(u64, u64, u64), String> {
+    let (batch_tx, batch_rx) = mpsc::sync_channel::<(usize, Vec<Vec<u8>>)>(threads * 2);
+    let batch_rx = Arc::new(Mutex::new(batch_rx));
+    let (out_tx, out_rx) = mpsc::sync_channel::<(usize, Result<Vec<String>, String>)>(threads * 2);
 
-                if process_more {
-                    has_both += 1;
+    thread::scope(|scope| {
+        let reader = scope.spawn(move || {
+            let mut count = 0;
+            let mut errors = 0;
+            let mut index = 0;
+            let mut batch = Vec::with_capacity(BATCH_RECORDS);
+            for record in records {
+                count += 1;
+                match record {
+                    Err(err) => {
+                        errors += 1;
+                        eprintln!("ERROR: {}\r\n", err)
+                    },
+                    Ok(record) => {
+                        batch.push(record.body);
+                        if batch.len() == BATCH_RECORDS {
+                            let full = mem::replace(&mut batch, Vec::with_capacity(BATCH_RECORDS));
+                            if batch_tx.send((index, full)).is_err() {
+                                // the writer gave up on this block
+                                return (count, errors);
+                            }
+                            index += 1;
+                        }
+                    }
+                }
+            }
+            if !batch.is_empty() {
+                let _ = batch_tx.send((index, batch));
+            }
+            (count, errors)
+        });
 
-                    let mut w: Wrapper = serde_json::from_slice(&record.body).unwrap();
-                    w.envelope.payload.response.response.filter();
+        for _ in 0..threads {
+            let batch_rx = batch_rx.clone();
+            let out_tx = out_tx.clone();
+            scope.spawn(move || loop {
+                let next = batch_rx.lock().unwrap().recv();
+                let (index, batch) = match next {
+                    Ok(next) => next,
+                    Err(_) => break
+                };
+                let lines = batch.iter().filter_map(|body| filter_record(body).transpose()).collect();
+                if out_tx.send((index, lines)).is_err() {
+                    break;
+                }
+            });
+        }
+        // so the channels close once the reader and the workers are done
+        drop(batch_rx);
+        drop(out_tx);
 
-                    let output = serde_json::to_string(&w).unwrap();
-                    outfile_writer.write(output.as_bytes()).unwrap();
-                    outfile_writer.write(b"\n").unwrap();
+        let mut result = Ok(0);
+        let mut pending = BTreeMap::new();
+        let mut next = 0;
+        for (index, lines) in out_rx.iter() {
+            let lines = match lines {
+                Ok(lines) => lines,
+                Err(err) => {
+                    result = Err(err);
+                    break;
+                }
+            };
+            if ordered {
+                pending.insert(index, lines);
+            } else {
+                pending.insert(next, lines);
+            }
+            while let Some(lines) = pending.remove(&next) {
+                // stops at the first line that can't be written, the rest of the output is lost anyway
+                let written = lines.iter().try_for_each(|line| write_line(out, line));
+                result = written.and(result).map(|kept| kept + lines.len() as u64);
+                next += 1;
+                if result.is_err() {
+                    break;
                 }
             }
+            if result.is_err() {
+                break;
+            }
         }
+        // stops the workers and the reader early if we broke out on an error
+        drop(out_rx);
+        let (count, errors) = reader.join().unwrap();
+        result.map(|kept| (count, kept, errors))
+    })
+}
+
+fn filter_records<R: BufRead + Send, W: Write>(
+    records: WarcReader<R>, out: &mut W, options: &Options
+) -> Result<(u64, u64, u64), String> {
+    if options.threads > 1 {
+        filter_parallel(records, out, options.threads, options.ordered)
+    } else {
+        filter_serial(records, out)
     }
+}
+
+// filters the WAT at `input` into the compressed (or with `raw`, plain) jsonl file `output`, reading through `buf`
+fn process_block(
+    agent: &ureq::Agent, input: &str, output: &str, buf: &mut [u8], options: &Options
+) -> Result<Stats, String> {
+    let (file, bytes_in) = Counting::new(open_input(agent, input)?);
 
-    outfile_writer.finish().unwrap();
+    let (gz, bytes_raw) = Counting::new(MultiGzDecoder::new(file));
+    let text = SharedBufReader::new(gz, buf);
+    let file = WarcReader::new(text);
+
+    // CC-MAIN-20210115134101-20210115164101-00000.warc.wat.jsonl.gz
+    let outfile = OpenOptions::new().create(true).write(true).truncate(true).open(output)
+        .map_err(|e| format!("{}: {}", output, e))?;
+    let (outfile, bytes_out) = Counting::new(outfile);
+
+    let (count, has_both, errors) = if options.raw {
+        let mut outfile_writer = BufWriter::with_capacity(1 << 16, outfile);
+        let counts = filter_records(file, &mut outfile_writer, options)?;
+        outfile_writer.flush().map_err(|e| e.to_string())?;
+        counts
+    } else {
+        match options.compression {
+            OutputCompression::Gzip(level) => {
+                let mut outfile_writer = GzEncoder::new(outfile, Compression::new(level));
+                let counts = filter_records(file, &mut outfile_writer, options)?;
+                outfile_writer.finish().map_err(|e| e.to_string())?;
+                counts
+            },
+            OutputCompression::Zstd(level) => {
+                let mut outfile_writer = zstd::Encoder::new(outfile, level).map_err(|e| e.to_string())?;
+                let counts = filter_records(file, &mut outfile_writer, options)?;
+                outfile_writer.finish().map_err(|e| e.to_string())?;
+                counts
+            }
+        }
+    };
+
+    Ok(Stats {
+        records: count,
+        kept: has_both,
+        errors,
+        bytes_in: bytes_in.load(Ordering::Relaxed),
+        bytes_raw: bytes_raw.load(Ordering::Relaxed),
+        bytes_out: bytes_out.load(Ordering::Relaxed)
+    })
+}
+
+// server mode: reads "<input url or path>\t<output path>" lines from stdin and writes one json line per block to
+// stdout once it's done, reusing the http agent (and its connections) and the read buffer across blocks
+fn serve(agent: &ureq::Agent, buf: &mut [u8], options: &Options) -> Result<(), std::io::Error> {
+    let stdin = std::io::stdin();
+    let stdout = std::io::stdout();
+    for line in stdin.lock().lines() {
+        let line = line?;
+        if line.trim().is_empty() {
+            continue;
+        }
+        let mut parts = line.splitn(2, '\t');
+        let input = parts.next().unwrap_or("");
+        let output = parts.next().unwrap_or("");
+        let mut result = match process_block(agent, input, output, buf, options) {
+            Ok(stats) => {
+                let mut result = stats.to_json();
+                result["ok"] = serde_json::json!(true);
+                result
+            },
+            Err(err) => serde_json::json!({"ok": false, "error": err})
+        };
+        result["input"] = serde_json::json!(input);
+        let mut stdout = stdout.lock();
+        writeln!(stdout, "{}", result)?;
+        stdout.flush()?;
+    }
+    Ok(())
+}
+
+const USAGE: &str = "please call commoncrawl_filter [--threads N] [--unordered] [--raw] [--compression SPEC] \
+                     <input url or path> <output_path> or commoncrawl_filter [--threads N] [--unordered] [--raw] \
+                     [--compression SPEC] --server";
+
+fn main() -> Result<(), std::io::Error> {
+    let mut options = Options { threads: 1, ordered: true, raw: false, compression: OutputCompression::from_env() };
+    let mut server = false;
+    let mut args: Vec<String> = Vec::new();
+    let mut argv = env::args().skip(1);
+    while let Some(arg) = argv.next() {
+        match arg.as_str() {
+            "--server" => server = true,
+            "--unordered" => options.ordered = false,
+            "--raw" => options.raw = true,
+            "--threads" => options.threads = argv.next().and_then(|n| n.parse().ok()).expect(USAGE),
+            "--compression" => {
+                options.compression = argv.next().and_then(|spec| OutputCompression::parse(&spec)).expect(USAGE)
+            },
+            _ => args.push(arg)
+        }
+    }
+    let agent = ureq::agent();
+    let mut buf = vec![0u8; 1024*1024*16];
+
+    if server {
+        return serve(&agent, &mut buf, &options);
+    }
+
+    assert_eq!(args.len(), 2, "{}", USAGE);
+
+    // "http://commoncrawl.s3.amazonaws.com/crawl-data/CC-MAIN-2021-04/segments/1610703495901.0/wat/CC-MAIN-20210115134101-20210115164101-00000.warc.wat.gz"
+    let stats = process_block(&agent, &args[0], &args[1], &mut buf, &options).unwrap();
 
-    // println!("Total records: {}", count);
-    // println!("Has cc img: {}", has_both);
+    // stats for the worker's metrics, the only thing written to stdout
+    println!("{}", stats.to_json());
 
     Ok(())
 }
@@ -0,0 +1,161 @@
+# the compression every stage writes its shards with, set once for a whole run by SHARD_COMPRESSION (read by the python
+# stages, their pool processes and the filter and img_dl binaries alike): "gzip", "pgzip" (gzip compressed on several
+# threads, as concatenated members any gzip reader takes) or "zstd" (needs the zstandard package), with an optional
+# level and threads (pgzip's, or zstd's workers) - e.g "gzip:6", "pgzip:6:8", "zstd:3". Readers tell the formats apart
+# by their magic bytes, so shards written with different settings can be read side by side
+import gzip
+import io
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENV_VAR = "SHARD_COMPRESSION"
+CODECS = ("gzip", "pgzip", "zstd")
+DEFAULT_LEVELS = {"gzip": 6, "pgzip": 6, "zstd": 3}
+DEFAULT_THREADS = 4
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# raw bytes compressed as one gzip member by pgzip
+MEMBER_BYTES = 1 << 20
+# what reading a compressed input that's cut short or corrupt raises part way through
+READ_ERRORS = (EOFError, zlib.error, gzip.BadGzipFile) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class Compression:
+    """
+    A parsed compression setting: `name` (one of CODECS), `level`, and `threads` (compression threads, for pgzip and
+    zstd)
+    """
+
+    def __init__(self, name="gzip", level=None, threads=None):
+        if name not in CODECS:
+            raise ValueError(f"unknown compression {name}, use one of {CODECS}")
+        if name == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.name = name
+        self.level = DEFAULT_LEVELS[name] if level is None else level
+        self.threads = threads
+
+    @classmethod
+    def parse(cls, spec):
+        name, *rest = spec.strip().split(":")
+        level = int(rest[0]) if rest and rest[0] else None
+        threads = int(rest[1]) if len(rest) > 1 and rest[1] else None
+        return cls(name, level, threads)
+
+    @classmethod
+    def from_env(cls, level=None):
+        """
+        Gets the setting from SHARD_COMPRESSION (gzip if unset). `level` is used when the setting doesn't give one,
+        e.g for stages that compress their output harder than the others
+        """
+        spec = os.environ.get(ENV_VAR, "")
+        if not spec:
+            return cls("gzip", level)
+        compression = cls.parse(spec)
+        if level is not None and ":" not in spec:
+            compression.level = level
+        return compression
+
+    def __repr__(self):
+        if self.threads is not None:
+            return f"{self.name}:{self.level}:{self.threads}"
+        return f"{self.name}:{self.level}"
+
+    def writer(self, f):
+        """
+        Wraps the binary file `f` in a compressing writer, whose close() finishes the stream but leaves `f` open
+        """
+        if self.name == "zstd":
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=self.threads or 0)
+            return compressor.stream_writer(f, closefd=False)
+        if self.name == "pgzip":
+            return ParallelGzipWriter(f, self.level, self.threads or DEFAULT_THREADS)
+        # no timestamp in the gzip header, so the same records always make the same file
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=self.level, mtime=0)
+
+
+class ParallelGzipWriter:
+    """
+    Compresses MEMBER_BYTES at a time as separate gzip members on `threads` threads (zlib lets go of the GIL while it
+    compresses), writing them to `f` in order
+    """
+
+    def __init__(self, f, level, threads):
+        self.f = f
+        self.level = level
+        self.pool = ThreadPoolExecutor(threads)
+        self.pending = []
+        self.max_pending = 2 * threads
+        self.buffer = []
+        self.buffered = 0
+        self.members = 0
+        self.closed = False
+
+    def _compress(self, data):
+        return gzip.compress(data, self.level, mtime=0)
+
+    def _submit(self):
+        if not self.buffer:
+            return
+        self.pending.append(self.pool.submit(self._compress, b"".join(self.buffer)))
+        self.buffer = []
+        self.buffered = 0
+        # bounds memory, and writes members as they're done
+        while len(self.pending) > self.max_pending or (self.pending and self.pending[0].done()):
+            self.f.write(self.pending.pop(0).result())
+            self.members += 1
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= MEMBER_BYTES:
+            self._submit()
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit()
+        for member in self.pending:
+            self.f.write(member.result())
+            self.members += 1
+        if not self.members:
+            # an empty stream is still a valid (empty) gzip file
+            self.f.write(self._compress(b""))
+        self.pending = []
+        self.pool.shutdown()
+        self.closed = True
+
+
+def detect(path):
+    """
+    Gets "gzip", "zstd" or None (plain) for the file at `path`, by its magic bytes
+    """
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def open_reader(path):
+    """
+    Opens a shard for reading its decompressed bytes, whatever it was compressed with (or plain)
+    """
+    codec = detect(path)
+    if codec == "gzip":
+        return gzip.open(path, "rb")
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError(f"{path} is zstd compressed, reading it needs the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True, read_across_frames=True)
+        return io.BufferedReader(reader)
+    return open(path, "rb")
@@ -1,13 +1,28 @@
 import sqlite3
 import pandas as pd
-import random
+import asyncio
+import queue
+import re
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import Future
 from functools import wraps
 from time import time, sleep
+import itertools
 import os
 from enum import Enum
 import shortuuid
 from tqdm import tqdm
 
+from metrics import Histogram
+
+DB_QUERY_SECONDS = Histogram(
+    "scheduler_db_query_seconds",
+    "Time spent in DB methods",
+    labels=["query"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30),
+)
+
 # Enum class describing the status of a block
 class BlockStatus(int, Enum):
     AVAILABLE = 0
@@ -16,133 +31,411 @@ class BlockStatus(int, Enum):
     FAILED = 3
 
 
+# the worker_id of blocks no worker holds (never leased, or put back as available)
+NO_WORKER = "N/A"
+
+
 def timer(func):
+    # records the time spent in `func` in the DB_QUERY_SECONDS histogram
     @wraps(func)
     def _time_it(*args, **kwargs):
-        start = time()
-        try:
+        with DB_QUERY_SECONDS.time(query=func.__name__):
             return func(*args, **kwargs)
-        finally:
-            end_ = time() - start
-            print(f"Total execution time of {func.__name__}: {end_:.2f} ms")
 
     return _time_it
 
 
+CRAWL_RE = re.compile(r"CC-MAIN-\d{4}-\d{2}")
+
+
+def crawl_of(url):
+    """
+    Gets the crawl (e.g CC-MAIN-2021-04) a block url belongs to
+    """
+    match = CRAWL_RE.search(url)
+    return match.group(0) if match else "unknown"
+
+
+class BlockCounters:
+    """
+    In-memory number of blocks per status, overall and broken down by worker and by crawl, so progress can be
+    reported without counting rows in the table.
+    """
+
+    def __init__(self):
+        # counters are updated from the DB writer thread and read from request handlers
+        self.lock = threading.Lock()
+        self.status = Counter()
+        self.workers = defaultdict(Counter)
+        self.crawls = defaultdict(Counter)
+
+    def _add(self, status, worker_id, crawl, n):
+        status = BlockStatus(status)
+        self.status[status] += n
+        self.workers[worker_id][status] += n
+        self.crawls[crawl][status] += n
+
+    def add(self, status, worker_id, crawl, n=1):
+        with self.lock:
+            self._add(status, worker_id, crawl, n)
+
+    def move(self, old_status, new_status, old_worker_id, new_worker_id, crawl):
+        with self.lock:
+            self._add(old_status, old_worker_id, crawl, -1)
+            self._add(new_status, new_worker_id, crawl, 1)
+
+    def held(self, worker_id):
+        """
+        Gets the number of blocks `worker_id` has in progress
+        """
+        with self.lock:
+            counts = self.workers.get(worker_id)
+            return counts[BlockStatus.IN_PROGRESS] if counts else 0
+
+    def reconcile(self, rows):
+        """
+        Resets the counters from (status, worker_id, crawl, count) rows
+        """
+        with self.lock:
+            self.status.clear()
+            self.workers.clear()
+            self.crawls.clear()
+            for status, worker_id, crawl, count in rows:
+                self._add(status, worker_id, crawl, count)
+
+    @staticmethod
+    def _named(counts):
+        return {status.name.lower(): counts[status] for status in BlockStatus}
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self._named(self.status),
+                "workers": {
+                    worker_id: self._named(c) for worker_id, c in self.workers.items()
+                    if worker_id != NO_WORKER and any(c.values())
+                },
+                "crawls": {crawl: self._named(c) for crawl, c in self.crawls.items()},
+            }
+
+
+def block_uuid(url):
+    """
+    Gets the uuid of the block at `url` - a hash of the url, so the same block always gets the same uuid
+    """
+    return shortuuid.uuid(name=url)
+
+
+def _chunks(items, size=500):
+    # keeps IN (...) lists below SQLite's limit on the number of bound parameters
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
 class DB:
+    """
+    The block table. All writes go through `con`, which must only be used by one thread at a time (in the scheduler
+    that is the BlockWriter thread), reads from other threads use their own connection from `read_con`.
+    """
+
     def __init__(
         self,
         path="blocks.sql",
         commit_interval=1000,
         warc_urls_path="warc_urls.txt",
         timeout=30.0,
+        lease_timeout=600,
     ):
         self.path = path
         self.warc_urls_path = warc_urls_path
-        self.con = sqlite3.connect(self.path, timeout=timeout)
+        # seconds a worker holds a block without sending a heartbeat before it goes back into the pool
+        self.lease_timeout = lease_timeout
+        self.timeout = timeout
+        self.con = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self.con.create_function("crawl_of", 1, crawl_of, deterministic=True)
+        # WAL lets readers carry on while a write transaction is being committed
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self._local = threading.local()
+        # counter and length changes of the writes in the open transaction, made when it commits
+        self.uncommitted = []
         self.create_db()
+        self.migrate_db()
+        self.create_indexes()
         self.commit_interval = commit_interval
         self.counter = 0
         self.len = self.get_n_rows()
+        self.counters = BlockCounters()
+        self.reconcile_counters()
+        pending = self.pending_ingest()
+        if pending is not None:
+            # a new table, or one whose first ingest was cut short - the blocks already in are skipped
+            with open(pending, "r") as f:
+                self.ingest(tqdm(f, desc="Reading WARC urls"))
+            self.finish_ingest()
+            print("CREATED TABLE OF SIZE : ", len(self))
+
+    def read_con(self):
+        """
+        Gets the calling thread's read-only connection
+        """
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=self.timeout)
+            self._local.con = con
+        return con
 
     def _table_exists(self, table):
         cur = self.con.cursor()
-        cur.execute(
-            f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'"
-        )
+        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
         return bool(cur.fetchone())
 
+    def _column_exists(self, table, column):
+        cur = self.con.cursor()
+        cur.execute(f"PRAGMA table_info({table})")
+        return any(row[1] == column for row in cur.fetchall())
+
     def now(self):
         return pd.Timestamp.now().value // 10 ** 9
 
+    def _on_commit(self, fn, *args):
+        # the in-memory counters (and length) follow the table: a change is only made once the write is committed,
+        # and dropped if it's rolled back
+        self.uncommitted.append((fn, args))
+
+    def commit(self):
+        self.con.commit()
+        uncommitted, self.uncommitted = self.uncommitted, []
+        for fn, args in uncommitted:
+            fn(*args)
+
+    def rollback(self):
+        self.con.rollback()
+        self.uncommitted = []
+
+    def _add_rows(self, n):
+        self.len += n
+
     def __len__(self):
         return self.len
 
     @timer
     def create_db(self):
-        # create db if not exists
-        if not self._table_exists("blocks"):
-            if not os.path.exists(self.warc_urls_path):
-                print("No warc urls found - run download_warc_urls.py")
-                exit(1)
-            else:
-                with open(self.warc_urls_path, "r") as f:
-                    BLOCK_URLS = list(tqdm(f.readlines(), desc="Reading WARC urls"))
-                print(f"{len(BLOCK_URLS)} block urls loaded")
-            now = self.now()
-            BLOCKS = pd.DataFrame(
-                {
-                    "url": BLOCK_URLS,
-                    "uuid": [shortuuid.uuid() for _ in range(len(BLOCK_URLS))],
-                    "status": [BlockStatus(0) for _ in range(len(BLOCK_URLS))],
-                    "worker_id": ["N/A" for _ in range(len(BLOCK_URLS))],
-                    "last_updated": [now for _ in range(len(BLOCK_URLS))],
-                }
+        """
+        Creates the (empty) block table if it doesn't exist yet, returns whether it was created. The WARC urls to fill
+        it with are recorded as a pending ingest in the same transaction, so a crash part way through filling it is
+        picked up again on the next start rather than leaving a partial crawl
+        """
+        if self._table_exists("blocks"):
+            return False
+        if self.warc_urls_path is not None and not os.path.exists(self.warc_urls_path):
+            print("No warc urls found - run download_warc_urls.py")
+            exit(1)
+        self.con.execute("BEGIN")
+        self.con.execute(
+            "CREATE TABLE blocks "
+            "(url TEXT, uuid TEXT, status INTEGER, worker_id TEXT, last_updated INTEGER, lease_expires INTEGER)"
+        )
+        self.con.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+        if self.warc_urls_path is not None:
+            self.con.execute("INSERT INTO meta VALUES ('pending_ingest', ?)", (self.warc_urls_path,))
+        self.con.commit()
+        return True
+
+    def pending_ingest(self):
+        """
+        Gets the path of the WARC urls whose ingest into a new table hasn't finished, None if there's none (tables from
+        before the meta table were filled in one go)
+        """
+        if not self._table_exists("meta"):
+            return None
+        cur = self.con.cursor()
+        cur.execute("SELECT value FROM meta WHERE key = 'pending_ingest'")
+        row = cur.fetchone()
+        return row[0] if row else None
+
+    def finish_ingest(self):
+        self.con.execute("DELETE FROM meta WHERE key = 'pending_ingest'")
+        self.con.commit()
+
+    @timer
+    def insert_blocks(self, urls, commit=True):
+        """
+        Adds available blocks for `urls`, skipping urls that are already in the table, returns the number added
+
+        Block uuids are derived from the url, so the unique uuid index turns a repeated url into a no-op.
+        """
+        cur = self.con.cursor()
+        now = self.now()
+        rows = [(url, block_uuid(url)) for url in (url.strip() for url in urls) if url]
+        inserted = {}
+        for chunk in _chunks(rows):
+            placeholders = ",".join("?" for _ in chunk)
+            cur.execute(f"SELECT uuid FROM blocks WHERE uuid IN ({placeholders})", [uuid for _, uuid in chunk])
+            existing = {uuid for uuid, in cur.fetchall()}
+            new = {uuid: url for url, uuid in chunk if uuid not in existing and uuid not in inserted}
+            cur.executemany(
+                "INSERT OR IGNORE INTO blocks (url, uuid, status, worker_id, last_updated) VALUES (?, ?, ?, ?, ?)",
+                [(url, uuid, int(BlockStatus.AVAILABLE), NO_WORKER, now) for uuid, url in new.items()],
             )
-            # save to db
-            print("CREATED TABLE OF SIZE : ", len(BLOCKS))
-            BLOCKS.to_sql("blocks", self.con, if_exists="replace", index=False)
+            inserted.update(new)
+        for url in inserted.values():
+            self._on_commit(self.counters.add, BlockStatus.AVAILABLE, NO_WORKER, crawl_of(url))
+        self._on_commit(self._add_rows, len(inserted))
+        if commit:
+            self.commit()
+        return len(inserted)
+
+    def ingest(self, urls, chunk_size=10000):
+        """
+        Streams `urls` into the table in transactions of `chunk_size` blocks, returns the number of blocks added
+        """
+        inserted = 0
+        urls = iter(urls)
+        while True:
+            chunk = list(itertools.islice(urls, chunk_size))
+            if not chunk:
+                return inserted
+            inserted += self.insert_blocks(chunk)
 
     @timer
-    def update_status(self, uuid, status, worker_id=None, commit=False):
+    def migrate_db(self):
         """
-        Updates the status of the row with uuid `uuid` to `status`
+        Adds columns introduced after the table was created
         """
         cur = self.con.cursor()
-        worker_id_str = "" if worker_id is None else f", worker_id={worker_id}"
+        if not self._column_exists("blocks", "lease_expires"):
+            # blocks leased before leases had deadlines keep the old 24h grace period
+            cur.execute("ALTER TABLE blocks ADD COLUMN lease_expires INTEGER")
+            cur.execute(
+                "UPDATE blocks SET lease_expires = last_updated + 86400 WHERE status = ?",
+                (int(BlockStatus.IN_PROGRESS),),
+            )
+        self.con.commit()
+
+    @timer
+    def create_indexes(self):
+        """
+        Creates the indexes used to lease blocks, to look blocks up by uuid and to find expired leases (no-op if
+        they already exist)
+        """
+        cur = self.con.cursor()
+        cur.execute("CREATE INDEX IF NOT EXISTS blocks_status ON blocks (status)")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS blocks_uuid ON blocks (uuid)")
+        # only in progress blocks have a lease, so these partial indexes stay as small as the set of leased blocks
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS blocks_lease_expires ON blocks (lease_expires) "
+            f"WHERE status = {int(BlockStatus.IN_PROGRESS)}"
+        )
+        # last_updated of an in progress block is when it was leased
         cur.execute(
-            f"UPDATE blocks SET status = {status}, last_updated = {self.now()}{worker_id_str} WHERE uuid = '{uuid}'"
+            f"CREATE INDEX IF NOT EXISTS blocks_leased_at ON blocks (last_updated) "
+            f"WHERE status = {int(BlockStatus.IN_PROGRESS)}"
         )
+        self.con.commit()
+
+    def lease_expiry(self, status):
+        """
+        Gets the lease deadline for a block moved to `status` (only in progress blocks hold a lease)
+        """
+        return self.now() + self.lease_timeout if status == BlockStatus.IN_PROGRESS else None
+
+    def update_status(self, uuid, status, worker_id=None, commit=False):
+        """
+        Updates the status of the row with uuid `uuid` to `status`, committing every `commit_interval` calls if not
+        told to `commit`
+        """
         self.counter += 1
-        if (self.counter % self.commit_interval == 0) or commit:
-            self.con.commit()
+        commit = commit or self.counter % self.commit_interval == 0
+        self.update_multiple([uuid], status, worker_id=worker_id, commit=commit)
 
     @timer
     def update_multiple(self, uuids, status, worker_id=None, commit=True):
         """
-        Updates the status of the row with uuid `uuid` to `status`
+        Updates the status of all rows with uuid in `uuids` to `status`
+
+        Completed blocks stay completed: a late failure report (e.g from a speculative copy that lost the race) for a
+        block that's already done is ignored.
         """
         cur = self.con.cursor()
-        worker_id_str = "" if worker_id is None else f", worker_id={worker_id}"
-        uuids = [f"'{uuid}'" for uuid in uuids]
-        uuid_str = ",".join(uuids)
-        cur.execute(
-            f"UPDATE blocks SET status = {status}, last_updated = {self.now()}{worker_id_str} WHERE uuid in ({uuid_str})"
+        uuids = list(uuids)
+        # previous state of the rows, to keep the counters in step (a lookup through the uuid index)
+        previous = []
+        for chunk in _chunks(uuids):
+            placeholders = ",".join("?" for _ in chunk)
+            cur.execute(f"SELECT uuid, status, worker_id, url FROM blocks WHERE uuid IN ({placeholders})", chunk)
+            previous += cur.fetchall()
+        if status != BlockStatus.COMPLETED:
+            previous = [row for row in previous if row[1] != BlockStatus.COMPLETED]
+        now, lease_expires = self.now(), self.lease_expiry(status)
+        cur.executemany(
+            "UPDATE blocks SET status = ?, last_updated = ?, lease_expires = ?, worker_id = coalesce(?, worker_id) "
+            "WHERE uuid = ?",
+            [(int(status), now, lease_expires, worker_id, uuid) for uuid, *_ in previous],
         )
-        self.counter += 1
-        if (self.counter % self.commit_interval == 0) or commit:
-            self.con.commit()
+        for _, old_status, old_worker_id, url in previous:
+            self._on_commit(
+                self.counters.move, old_status, status, old_worker_id, worker_id or old_worker_id, crawl_of(url)
+            )
+        # with commit=False the caller commits (the BlockWriter, once per batch), never part way through its writes
+        if commit:
+            self.commit()
 
     @timer
     def get_status(self, uuid):
         """
         Gets the status of the row where uuid==`uuid`
         """
-        cur = self.con.cursor()
-        cur.execute(f"SELECT status FROM blocks WHERE uuid = {uuid}")
+        cur = self.read_con().cursor()
+        cur.execute("SELECT status FROM blocks WHERE uuid = ?", (uuid,))
         return cur.fetchone()[0]
 
     @timer
-    def get_available_blocks(self, n=1, worker_id=None):
+    def get_available_blocks(self, n=1, worker_id=None, commit=True):
         """
-        Gets a n blocks where status is available (or failed, since it needs to be retried)
+        Gets n blocks where status is available (or failed, since it needs to be retried) and marks them in progress
+
+        Candidates are found through the status index, so the cost doesn't depend on how much of the crawl is already
+        done, and they are claimed with a single UPDATE ... RETURNING that re-checks their status, so two concurrent
+        callers can never be handed the same block.
         """
         cur = self.con.cursor()
         # available is where status is 0 (AVAILABLE) or 3 (FAILED)
-        to_fetch = n * 2
-        random_start = random.randint(0, self.len - to_fetch)
-        # get some blocks starting from random_start
         cur.execute(
-            f"SELECT url, uuid, last_updated FROM blocks WHERE status IN (0, 3) LIMIT {random_start}, {to_fetch}"
+            "SELECT rowid, status, worker_id FROM blocks WHERE status IN (?, ?) LIMIT ?",
+            (int(BlockStatus.AVAILABLE), int(BlockStatus.FAILED), n),
+        )
+        candidates = {rowid: (status, old_worker_id) for rowid, status, old_worker_id in cur.fetchall()}
+        if not candidates:
+            return []
+        placeholders = ",".join("?" for _ in candidates)
+        cur.execute(
+            f"""
+            UPDATE blocks SET status = ?, last_updated = ?, lease_expires = ?, worker_id = coalesce(?, worker_id)
+            WHERE rowid IN ({placeholders}) AND status IN (?, ?)
+            RETURNING rowid, url, uuid, last_updated
+            """,
+            [
+                int(BlockStatus.IN_PROGRESS),
+                self.now(),
+                self.lease_expiry(BlockStatus.IN_PROGRESS),
+                worker_id,
+                *candidates,
+                int(BlockStatus.AVAILABLE),
+                int(BlockStatus.FAILED),
+            ],
         )
-        # select many then pick one to avoid overlaps between threads
-        candidates = cur.fetchmany(to_fetch)
-        blocks = random.sample(
-            candidates, min(len(candidates), n)
-        )  # time = time last updated
-        # update status to 1 (IN_PROGRESS)
-        uuids = [block[1] for block in blocks]
-        self.update_multiple(uuids, 1, worker_id=worker_id)
+        claimed = cur.fetchall()
+        blocks = []
+        for rowid, url, uuid, last_updated in claimed:
+            old_status, old_worker_id = candidates[rowid]
+            self._on_commit(
+                self.counters.move,
+                old_status, BlockStatus.IN_PROGRESS, old_worker_id, worker_id or old_worker_id, crawl_of(url),
+            )
+            blocks.append((url, uuid, last_updated))
+        if commit:
+            self.commit()
         return blocks
 
     @timer
@@ -150,20 +443,62 @@ class DB:
         """
         Gets all blocks where status==`status`
         """
-        cur = self.con.cursor()
-        cur.execute(f"SELECT url, uuid, status FROM blocks WHERE status = {status}")
+        cur = self.read_con().cursor()
+        cur.execute("SELECT url, uuid, status FROM blocks WHERE status = ?", (int(status),))
         return cur.fetchall()
 
     @timer
-    def clear_timed_out_blocks(self, period=86400):
+    def get_oldest_in_progress(self, n, leased_before):
         """
-        Finds all blocks where status is in progress, and, if they were last updated > 24hrs ago, set status to failed
+        Gets up to n in progress blocks leased before `leased_before`, oldest lease first, as
+        (url, uuid, last_updated, worker_id) rows
+        """
+        cur = self.read_con().cursor()
+        cur.execute(
+            "SELECT url, uuid, last_updated, worker_id FROM blocks WHERE status = ? AND last_updated < ? "
+            "ORDER BY last_updated LIMIT ?",
+            (int(BlockStatus.IN_PROGRESS), leased_before, n),
+        )
+        return cur.fetchall()
+
+    @timer
+    def heartbeat(self, uuids, worker_id, commit=True):
+        """
+        Extends the lease on the in progress blocks in `uuids` held by `worker_id` (or by anyone if `worker_id` is None),
+        returns the number of leases extended
+        """
+        cur = self.con.cursor()
+        lease_expires = self.lease_expiry(BlockStatus.IN_PROGRESS)
+        cur.executemany(
+            "UPDATE blocks SET lease_expires = ? WHERE uuid = ? AND status = ? AND worker_id = coalesce(?, worker_id)",
+            [(lease_expires, uuid, int(BlockStatus.IN_PROGRESS), worker_id) for uuid in uuids],
+        )
+        if commit:
+            self.commit()
+        return cur.rowcount
+
+    @timer
+    def clear_timed_out_blocks(self, commit=True):
+        """
+        Sets all in progress blocks whose lease has expired to failed so they get leased again, returns the number of
+        blocks reclaimed
+
+        Only the expired part of the lease_expires index is visited, so this is cheap enough to run every minute.
         """
         cur = self.con.cursor()
         cur.execute(
-            f"UPDATE blocks SET status = {int(BlockStatus.FAILED)} WHERE status = {int(BlockStatus.IN_PROGRESS)} AND last_updated < {self.now() - period}"
+            "UPDATE blocks SET status = ?, lease_expires = NULL WHERE status = ? AND lease_expires < ? "
+            "RETURNING worker_id, url",
+            (int(BlockStatus.FAILED), int(BlockStatus.IN_PROGRESS), self.now()),
         )
-        self.con.commit()
+        reclaimed = cur.fetchall()
+        for worker_id, url in reclaimed:
+            self._on_commit(
+                self.counters.move, BlockStatus.IN_PROGRESS, BlockStatus.FAILED, worker_id, worker_id, crawl_of(url)
+            )
+        if commit:
+            self.commit()
+        return len(reclaimed)
 
     @timer
     def get_n_rows(self):
@@ -175,11 +510,170 @@ class DB:
         return cur.fetchone()[0]
 
     @timer
+    def reconcile_counters(self):
+        """
+        Recounts the blocks per status, worker and crawl from the table (a full scan, only done at startup)
+        """
+        cur = self.con.cursor()
+        cur.execute("SELECT status, worker_id, crawl_of(url), COUNT(*) FROM blocks GROUP BY 1, 2, 3")
+        self.counters.reconcile(cur.fetchall())
+
     def get_progress(self):
         """
         Gets the number of completed blocks
         """
-        # completed is where status is 2 (COMPLETED)
-        cur = self.con.cursor()
-        cur.execute(f"SELECT COUNT(*) FROM blocks WHERE status = 2")
-        return cur.fetchone()[0]
+        return self.counters.status[BlockStatus.COMPLETED]
+
+    def get_stats(self):
+        """
+        Gets the number of blocks per status, overall and per worker and crawl
+        """
+        return {"total": self.len, **self.counters.stats()}
+
+
+class BlockWriter:
+    """
+    Applies all writes to a DB from one dedicated thread.
+
+    Calls submitted from any thread (or awaited from the event loop with `run`) are queued and applied in batches,
+    each batch in a single transaction: the batch is flushed when it reaches `max_batch` calls, when the oldest call
+    has waited `max_delay` seconds, or straight away if a caller is waiting on a lease. Consecutive status updates
+    with the same status and worker are merged into one executemany.
+    """
+
+    def __init__(self, db, max_batch=1000, max_delay=0.05):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, name="BlockWriter", daemon=True)
+        # how contended the single write connection is: time calls spend queued behind other writes, time spent
+        # applying batches, and transactions that failed because the file was locked by another process
+        self.calls = 0
+        self.batches = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+        self.busy_seconds = 0.0
+        self.locked_errors = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Applies everything already queued and stops the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, fn, *args, urgent=False, **kwargs):
+        """
+        Queues `fn(*args, commit=False, **kwargs)`, where `fn` is a DB method, and returns a Future for its result
+        """
+        future = Future()
+        future.queued_at = time()
+        self.queue.put((fn, args, kwargs, urgent, future))
+        return future
+
+    async def run(self, fn, *args, urgent=False, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, urgent=urgent, **kwargs))
+
+    def update_multiple(self, uuids, status, worker_id=None):
+        return self.run(self.db.update_multiple, list(uuids), status, worker_id=worker_id)
+
+    def heartbeat(self, uuids, worker_id):
+        return self.run(self.db.heartbeat, list(uuids), worker_id)
+
+    def get_available_blocks(self, n, worker_id=None):
+        return self.run(self.db.get_available_blocks, n, worker_id=worker_id, urgent=True)
+
+    def clear_timed_out_blocks(self):
+        return self.run(self.db.clear_timed_out_blocks)
+
+    def _collect(self):
+        # blocks until there's at least one call, then gathers more until the batch is full or due
+        first = self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        urgent = first[3]
+        deadline = time() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                if urgent:
+                    item = self.queue.get_nowait()
+                else:
+                    item = self.queue.get(timeout=max(deadline - time(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+            urgent = urgent or item[3]
+        return batch, False
+
+    def _merge(self, batch):
+        # merges runs of status updates with the same status and worker into a single call
+        merged = []
+        for fn, args, kwargs, urgent, future in batch:
+            if merged and fn == self.db.update_multiple and merged[-1][0] == self.db.update_multiple:
+                prev_fn, prev_args, prev_kwargs, prev_futures = merged[-1]
+                if prev_args[1:] == args[1:] and prev_kwargs == kwargs:
+                    prev_args[0].extend(args[0])
+                    prev_futures.append(future)
+                    continue
+            if fn == self.db.update_multiple:
+                args = (list(args[0]), *args[1:])
+            merged.append((fn, args, kwargs, [future]))
+        return merged
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "batches": self.batches,
+            "queue_seconds": self.queue_seconds,
+            "max_queue_seconds": self.max_queue_seconds,
+            "busy_seconds": self.busy_seconds,
+            "locked_errors": self.locked_errors,
+            "queued": self.queue.qsize(),
+        }
+
+    def _apply(self, batch):
+        start = time()
+        for *_, future in batch:
+            waited = start - future.queued_at
+            self.queue_seconds += waited
+            self.max_queue_seconds = max(self.max_queue_seconds, waited)
+        self.calls += len(batch)
+        self.batches += 1
+        try:
+            self._apply_merged(self._merge(batch))
+        finally:
+            self.busy_seconds += time() - start
+
+    def _apply_merged(self, merged):
+        results = []
+        try:
+            for fn, args, kwargs, futures in merged:
+                results.append(fn(*args, commit=False, **kwargs))
+            self.db.commit()
+        except Exception as e:
+            if isinstance(e, sqlite3.OperationalError) and "locked" in str(e):
+                self.locked_errors += 1
+            # the counter changes of the rolled back writes are dropped with them
+            self.db.rollback()
+            for _, _, _, futures in merged:
+                for future in futures:
+                    future.set_exception(e)
+            return
+        for (_, _, _, futures), result in zip(merged, results):
+            for future in futures:
+                future.set_result(result)
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if batch:
+                self._apply(batch)
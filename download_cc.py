@@ -1,13 +1,22 @@
+import os
 import subprocess
 import multiprocessing
-from multiprocessing import set_start_method, Value
-from functools import partial
+import queue
 import api
 import pathlib
 import time
 import argparse
 import traceback
 import threading
+import json
+import tempfile
+from contextlib import nullcontext
+import dump_urls
+from metrics import REGISTRY, Counter, Histogram
+from autotune import Autotuner
+from spool import Spool
+from shards import Manifest, commit, discard, temp_path
+from filter_server import FILTER_BIN, FilterServer, filter_options
 
 
 def parse_args():
@@ -16,143 +25,445 @@ def parse_args():
     )
     parser.add_argument("host", type=str, help="host to download blocks from")
     parser.add_argument("--port", type=str, default="5000")
-    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=None, help="blocks processed at once (default: cpu count)")
+    parser.add_argument(
+        "--prefetch", type=int, default=None,
+        help="leased blocks kept queued behind the running ones (default: --processes)",
+    )
     parser.add_argument("--warc_urls_path", type=str, default="./warc_urls.txt")
     parser.add_argument("--out_dir", type=str, default="./output")
+    parser.add_argument(
+        "--journal_path", type=str, default="./reports.jsonl",
+        help="block reports not yet acknowledged by the scheduler are kept here and resent after a restart",
+    )
+    parser.add_argument(
+        "--spool_dir", type=str, default=None,
+        help="download blocks into this local cache (resuming stalled downloads) before filtering them",
+    )
+    parser.add_argument("--spool_gb", type=float, default=50, help="size of the spool, least recently used blocks "
+                        "are evicted beyond it")
+    parser.add_argument(
+        "--mirror", type=str, default=None,
+        help="local directory laid out like the bucket (crawl-data/...), blocks found there aren't downloaded",
+    )
+    parser.add_argument(
+        "--spawn_per_block", action="store_true",
+        help="start a new filter process for every block instead of one long-running filter per process",
+    )
+    parser.add_argument(
+        "--filter_threads", type=int, default=1,
+        help="threads each filter parses a block with - e.g halve --processes and use 2 threads to hold fewer blocks",
+    )
+    parser.add_argument(
+        "--filter_unordered", action="store_true",
+        help="with --filter_threads, let the filter write records in the order they're done rather than input order",
+    )
+    parser.add_argument(
+        "--fused", action="store_true",
+        help="write image-level records (as dump_urls.py would) instead of the filter's page-level output, "
+             "aggregating each block as the filter streams it through a pipe",
+    )
+    parser.add_argument(
+        "--fused_max_mb", type=int, default=dump_urls.DEFAULT_MAX_BYTES >> 20,
+        help="with --fused, roughly how much memory a block is aggregated in before spilling to disk. With --autotune "
+             "the --processes blocks' total is shared by however many run at once",
+    )
+    parser.add_argument(
+        "--autotune", action="store_true",
+        help="adjust the number of blocks processed at once (starting from --processes) for the most blocks/hour, "
+             "from network ingress, cpu use and block throughput",
+    )
+    parser.add_argument("--min_processes", type=int, default=1, help="lower bound for --autotune")
+    parser.add_argument("--max_processes", type=int, default=None, help="upper bound for --autotune (default: 4x cpus)")
+    parser.add_argument(
+        "--autotune_interval", type=int, default=300, help="seconds of throughput --autotune judges each setting on"
+    )
+    parser.add_argument("--metrics_port", type=int, default=None, help="serve Prometheus metrics on this port")
+    parser.add_argument("--metrics_file", type=str, default=None, help="write Prometheus metrics to this file")
     args = parser.parse_args()
     if args.processes is None:
         args.processes = multiprocessing.cpu_count()
+    if args.prefetch is None:
+        args.prefetch = args.processes
+    if args.max_processes is None:
+        args.max_processes = max(4 * multiprocessing.cpu_count(), args.processes)
     return args
 
 
 args = parse_args()
-API = api.API(host=args.host, port=args.port)
+API = api.API(host=args.host, port=args.port, journal_path=args.journal_path)
+FILTER_OPTIONS = filter_options(args.filter_threads, not args.filter_unordered, raw=args.fused)
+SPOOL = None
+if args.spool_dir is not None or args.mirror is not None:
+    SPOOL = Spool(args.spool_dir or "./spool", max_bytes=int(args.spool_gb * 2 ** 30), mirror=args.mirror)
 COUNTER = 0
+# seconds between lease heartbeats for leased blocks (the scheduler's lease timeout is 10 minutes)
+HEARTBEAT_INTERVAL = 60
+# seconds before a block is given up on
+BLOCK_TIMEOUT = 1200
+# seconds between checks whether a running block was completed by another worker
+ABORT_POLL_INTERVAL = 5
+# seconds to wait before asking for blocks again when the scheduler has none (or can't be reached)
+NO_BLOCKS_SLEEP = 10
+# seconds between writes of --metrics_file
+METRICS_WRITE_INTERVAL = 10
+# _process_wat results
+BLOCK_OK, BLOCK_FAILED, BLOCK_ABORTED = 0, 1, 2
+BLOCK_RESULTS = {BLOCK_OK: "ok", BLOCK_FAILED: "failed", BLOCK_ABORTED: "aborted"}
+
+BLOCK_SECONDS = Histogram(
+    "worker_block_seconds",
+    "Time taken to download and filter a block",
+    labels=["result"],
+    buckets=(5, 10, 30, 60, 120, 300, 600, 1200),
+)
+BLOCKS = Counter("worker_blocks_total", "Blocks processed", labels=["result"])
+BYTES_IN = Counter("worker_bytes_in_total", "Compressed WAT bytes downloaded")
+BYTES_OUT = Counter("worker_bytes_out_total", "Compressed bytes written")
+RECORDS_SCANNED = Counter("worker_records_scanned_total", "WAT records scanned")
+RECORDS_KEPT = Counter("worker_records_kept_total", "WAT records kept (with CC licensed images)")
+RECORD_ERRORS = Counter("worker_record_errors_total", "WAT records that couldn't be read")
+IMAGES = Counter("worker_images_total", "Image records written (with --fused)")
+PAGE_ERRORS = Counter("worker_page_errors_total", "Filtered page records that couldn't be decoded (with --fused)")
+
+
+def _run_filter(block_id, cmd, aborted):
+    # runs commoncrawl_filter_bin, returns the stats it prints when done (records scanned / kept / unreadable, bytes
+    # in / out), or None if it was killed because the block was completed elsewhere
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    deadline = time.time() + BLOCK_TIMEOUT
+    try:
+        while True:
+            try:
+                # communicate can be retried after a timeout without losing output
+                stdout, _ = proc.communicate(timeout=ABORT_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if block_id in aborted:
+                    return None
+                if time.time() > deadline:
+                    raise
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    stats = {}
+    for line in stdout.decode(errors="replace").splitlines():
+        if line.startswith("{"):
+            stats = json.loads(line)
+    return stats
 
 
-class NoAvailableBlocks(Exception):
-    pass
+def record_metrics(result, duration, stats):
+    BLOCKS.inc(result=BLOCK_RESULTS[result])
+    BLOCK_SECONDS.observe(duration, result=BLOCK_RESULTS[result])
+    BYTES_IN.inc(stats.get("bytes_in", 0))
+    BYTES_OUT.inc(stats.get("bytes_out", 0))
+    RECORDS_SCANNED.inc(stats.get("records", 0))
+    RECORDS_KEPT.inc(stats.get("kept", 0))
+    RECORD_ERRORS.inc(stats.get("errors", 0))
+    IMAGES.inc(stats.get("images", 0))
+    PAGE_ERRORS.inc(stats.get("page_errors", 0))
 
 
-def _mark_complete(block_id, max_retries=5):
-    results = API.mark_block_complete(block_id)
-    if results.get("message", "") == "database error":
-        # retry
-        if max_retries > 0:
-            time.sleep(1)
-            _mark_complete(block_id, max_retries - 1)
-        else:
-            print(f"Failed to mark block {block_id} complete")
-            return
+def _release_pipe(path, images):
+    # the reader blocks opening the pipe until a writer does, so if the filter never opened it (e.g it couldn't fetch
+    # the block) open it ourselves to hand the reader an empty stream, then wait for it to finish
+    while not images.ready():
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+        except OSError:
+            # no reader yet
+            pass
+        images.wait(1)
 
 
-def _mark_failed(block_id, max_retries=5):
-    results = API.mark_block_failed(block_id)
-    if results.get("message", "") == "database error":
-        # retry
-        if max_retries > 0:
-            time.sleep(1)
-            _mark_failed(block_id, max_retries - 1)
-        else:
-            print(f"Failed to mark block {block_id} failed")
-            return
+def _fuse(pool, out_path, manifest, run_filter, max_bytes):
+    # runs `run_filter(pipe_path)` with the filter writing plain page-level records into a pipe, which a `pool` process
+    # aggregates (in about `max_bytes` of memory) into image-level records for `out_path` as they come, returns the
+    # filter's stats
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pipe_path = os.path.join(tmp_dir, "pages.jsonl")
+        os.mkfifo(pipe_path)
+        images = pool.apply_async(dump_urls.dump_urls_from_path, (pipe_path, out_path, max_bytes))
+        try:
+            stats = run_filter(pipe_path)
+        except BaseException:
+            _release_pipe(pipe_path, images)
+            if images.successful():
+                discard(images.get()[0][0])
+            raise
+        _release_pipe(pipe_path, images)
+        (tmp_path, out_path, n_images, size, md5), counts = images.get()
+    if stats is None:
+        # aborted, the records aggregated so far are only part of the block
+        discard(tmp_path)
+        return None
+    commit(tmp_path, out_path, n_images, manifest, size, md5)
+    stats["images"] = n_images
+    stats["page_errors"] = counts["errors"]
+    stats["bytes_out"] = size
+    return stats
 
 
-def mark_complete(block_id, max_retries=5):
-    # can be a single block id or a list of block ids
-    thr = threading.Thread(target=_mark_complete, args=(block_id, max_retries))
-    thr.start()
+def output_path(out_dir, block_url):
+    """
+    Gets the path a block's output is written to
+    """
+    output_name = (
+        block_url.split("/")[3]
+        + "_"
+        + block_url.split("/")[-1].replace(".warc.wat.gz", ".jsonl.wat.gz")
+    )
+    dir_name = block_url.split("/")[1]
+    return str(pathlib.Path(out_dir) / dir_name / output_name).strip()
 
 
-def mark_failed(block_id, max_retries=5):
-    # can be a single block id or a list of block ids
-    thr = threading.Thread(target=_mark_failed, args=(block_id, max_retries))
-    thr.start()
+def _filter_to_shard(out_path, manifest, run_filter):
+    # runs `run_filter(tmp_path)`, moving the output into place and recording it in `manifest` once it's complete
+    tmp_path = temp_path(out_path)
+    try:
+        stats = run_filter(tmp_path)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    if stats is None:
+        discard(tmp_path)
+        return None
+    commit(tmp_path, out_path, stats.get("kept", 0), manifest)
+    return stats
 
 
-def _process_wat(args, out_dir):
-    block_id, block_url = args
+def _process_wat(block, out_dir, aborted, server=None, pool=None, max_bytes=None):
+    # returns (BLOCK_OK, BLOCK_FAILED or BLOCK_ABORTED, seconds taken, bytes written, filter stats), filtering the
+    # (block_id, block_url) `block` with the long-running filter `server` if given, or a new filter process otherwise,
+    # and with a `pool` aggregating the filter's output into image-level records (in about `max_bytes`) on the way to
+    # disk. Output only appears under its final name (and in out_dir's manifest) once the block is complete
+    block_id, block_url = block
+    start = time.time()
     try:
         if not block_url.strip():
-            return block_url
+            return BLOCK_OK, 0.0, 0, {}
         print(f"Processing block {block_id}")
-        output_name = (
-            block_url.split("/")[3]
-            + "_"
-            + block_url.split("/")[-1].replace(".warc.wat.gz", ".jsonl.wat.gz")
-        )
-        dir_name = block_url.split("/")[1]
-        final_out_dir = pathlib.Path(out_dir) / dir_name
-        final_out_dir.mkdir(parents=True, exist_ok=True)
-        start = time.time()
-        subprocess.run(
-            [
-                "./commoncrawl_filter_bin",
-                block_url,
-                str(final_out_dir / output_name).strip(),
-            ],
-            timeout=1200,
-            check=True,
-        )
+        out_path = output_path(out_dir, block_url)
+        pathlib.Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+        manifest = Manifest(out_dir)
+        # without a spool the filter streams the block from S3 itself
+        with SPOOL.open(block_url) if SPOOL is not None else nullcontext(block_url) as block_path:
+
+            def run_filter(filter_out_path):
+                if server is not None:
+                    return server.filter(
+                        block_path, filter_out_path, timeout=BLOCK_TIMEOUT, abort=lambda: block_id in aborted
+                    )
+                return _run_filter(block_id, [FILTER_BIN, *FILTER_OPTIONS, block_path, filter_out_path], aborted)
+
+            if pool is not None:
+                stats = _fuse(pool, out_path, manifest, run_filter, max_bytes)
+            else:
+                stats = _filter_to_shard(out_path, manifest, run_filter)
+        if stats is None:
+            print(f"Aborted block {block_id}, another worker completed it first")
+            return BLOCK_ABORTED, time.time() - start, 0, {}
         print(f"Finished processing block {block_id} in {time.time() - start} seconds")
-        print(
-            f"Saved block to {pathlib.Path(str(final_out_dir / output_name).strip()).resolve()}"
-        )
+        out_path = pathlib.Path(out_path).resolve()
+        print(f"Saved block to {out_path}")
 
-        return 0
+        return BLOCK_OK, time.time() - start, out_path.stat().st_size, stats
     except BaseException as e:
         print(e)
         print(f"Error processing block {block_id}")
         traceback.print_exc()
-        return 1
+        return BLOCK_FAILED, time.time() - start, 0, {}
 
 
-def process_wats(output_path, processes):
-    global COUNTER
-    while True:
-        try:
-            with multiprocessing.Pool(args.processes) as p:
-                print(
-                    f"\rNum blocks processed locally: {COUNTER}", end="",
-                )
-                blocks = API.get_available_blocks(processes * 5)
-                n_blocks = len(blocks)
-                if "message" in blocks:
-                    if blocks["message"] == "no available blocks":
-                        raise NoAvailableBlocks
-                    else:
-                        print(blocks["message"])
-                        print("Sleeping and trying again in 10 seconds")
-                        time.sleep(10)
-                print(f"GOT {len(blocks)} BLOCKS")
-                results = p.map(
-                    partial(_process_wat, out_dir=output_path),
-                    [(block["uuid"], block["url"],) for block in blocks],
-                )
-                COUNTER += sum(results)
-                print(f"\rNum blocks processed locally: {COUNTER}", end="")
-                # mark completed blocks complete and failed blocks failed
-                completed = []
-                failed = []
-                for block, result in zip(blocks, results):
-                    if result == 1:
-                        failed.append(block["uuid"])
-                    else:
-                        completed.append(block["uuid"])
-                if completed:
-                    mark_complete(completed)
-                if failed:
-                    mark_failed(failed)
-        except NoAvailableBlocks:
-            print("No more blocks!")
-        except Exception as e:
-            traceback.print_exc()
-        finally:
-            # wait for all processes to complete
-            p.close()
-            p.join()
-            COUNTER += n_blocks
+class Pipeline:
+    """
+    Long-lived block pipeline: `processes` runner threads each run one filter at a time, a prefetcher thread keeps
+    `prefetch` more leased blocks queued behind them so a runner never waits on the scheduler, and every block is
+    reported as soon as it finishes, in whatever order blocks finish. A heartbeat thread renews the leases on every
+    block held (queued or running) and picks up the blocks the scheduler says were completed by another worker.
+
+    With an `autotuner`, `max_processes` runners are started but only as many run blocks at once as the autotuner
+    allows (`set_limit`).
+    """
+
+    def __init__(self, out_dir, processes, prefetch, max_processes=None, autotuner=None):
+        self.out_dir = out_dir
+        self.processes = processes
+        self.max_processes = max(max_processes or processes, processes)
+        self.prefetch = prefetch
+        self.autotuner = autotuner
+        # blocks allowed to run at once, and blocks running
+        self.limit = processes
+        self.running = 0
+        self.slots = threading.Condition()
+        # leased blocks waiting for a runner, and (block, result) of finished blocks
+        self.todo = queue.Queue()
+        self.results = queue.Queue()
+        # uuid -> block of every block leased but not yet reported
+        self.held = {}
+        self.lock = threading.Lock()
+        # blocks the scheduler told us to abort
+        self.aborted = set()
+        # set whenever a block finishes, so the prefetcher can top up the queue
+        self.freed = threading.Event()
+        # with --fused, processes aggregating the filters' output (processes rather than threads, for the GIL), one per
+        # block that can run. The memory they aggregate in is --processes blocks' worth, shared by the blocks running
+        self.pool = multiprocessing.Pool(self.max_processes) if args.fused else None
+        self.fused_bytes = (args.fused_max_mb << 20) * processes
+        # blocks finished by an earlier run (e.g one that died before reporting them) aren't processed again
+        self.manifest = Manifest(out_dir)
+        self.done = self.manifest.entries()
+
+    def start(self):
+        for i in range(self.max_processes):
+            threading.Thread(target=self._run, name=f"runner-{i}", daemon=True).start()
+        threading.Thread(target=self._prefetch, name="prefetch", daemon=True).start()
+        threading.Thread(target=self._keep_alive, name="heartbeat", daemon=True).start()
+        if self.autotuner is not None:
+            self.autotuner.on_change = self.set_limit
+            self.set_limit(self.autotuner.target)
+            self.autotuner.start()
+        return self
+
+    def set_limit(self, limit):
+        """
+        Changes how many blocks run at once (blocks already running over the new limit are finished first)
+        """
+        with self.slots:
+            self.limit = min(limit, self.max_processes)
+            self.slots.notify_all()
+        self.freed.set()
+
+    def fused_max_bytes(self):
+        """
+        Gets the memory a block starting now aggregates in with --fused: an even share of the budget between the blocks
+        allowed to run at once, and never more than --fused_max_mb
+        """
+        with self.slots:
+            return self.fused_bytes // max(self.limit, self.processes)
+
+    def n_held(self):
+        with self.lock:
+            return len(self.held)
+
+    def _prefetch(self):
+        while True:
+            # top up once half the prefetch queue has drained, rather than leasing one block at a time
+            room = self.limit + self.prefetch - self.n_held()
+            if room < max(1, self.prefetch // 2):
+                self.freed.wait(ABORT_POLL_INTERVAL)
+                self.freed.clear()
+                continue
+            try:
+                blocks = API.get_available_blocks(room, slots=self.limit)
+            except Exception as e:
+                print(f"Failed to lease blocks: {e}")
+                time.sleep(NO_BLOCKS_SLEEP)
+                continue
+            if "message" in blocks:
+                if blocks["message"] == "no blocks available":
+                    print("No more blocks!")
+                else:
+                    print(blocks["message"])
+                    print(f"Sleeping and trying again in {NO_BLOCKS_SLEEP} seconds")
+                time.sleep(NO_BLOCKS_SLEEP)
+                continue
+            print(f"GOT {len(blocks)} BLOCKS")
+            with self.lock:
+                for block in blocks:
+                    self.held[block["uuid"]] = block
+            for block in blocks:
+                self.todo.put(block)
+
+    def _keep_alive(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            with self.lock:
+                block_ids = list(self.held)
+            if not block_ids:
+                continue
+            try:
+                response = API.heartbeat(block_ids)
+                self.aborted.update(response.get("abort", []))
+            except Exception as e:
+                # a missed heartbeat only matters if the scheduler stays unreachable for the whole lease timeout
+                print(f"Heartbeat failed: {e}")
+
+    def _run(self):
+        # each runner keeps its own filter process going, unless told to spawn one per block
+        server = None if args.spawn_per_block else FilterServer(
+            poll_interval=ABORT_POLL_INTERVAL, args=FILTER_OPTIONS
+        )
+        while True:
+            with self.slots:
+                self.slots.wait_for(lambda: self.running < self.limit)
+                self.running += 1
+            try:
+                block = self.todo.get()
+                if block["uuid"] in self.aborted:
+                    # completed elsewhere while it was queued
+                    result = BLOCK_ABORTED, 0.0, 0, {}
+                elif block["url"].strip() and self.manifest.complete(
+                    [output_path(self.out_dir, block["url"])], self.done
+                ):
+                    print(f"Block {block['uuid']} was already processed")
+                    result = BLOCK_OK, 0.0, os.path.getsize(output_path(self.out_dir, block["url"])), {}
+                else:
+                    result = _process_wat(
+                        (block["uuid"], block["url"]), self.out_dir, self.aborted, server, self.pool,
+                        self.fused_max_bytes(),
+                    )
+            finally:
+                with self.slots:
+                    self.running -= 1
+                    self.slots.notify()
+            self.results.put((block, result))
+
+    def run(self):
+        """
+        Reports blocks as they finish, forever
+        """
+        global COUNTER
+        last_metrics_write = 0
+        while True:
+            block, (result, duration, size, stats) = self.results.get()
+            record_metrics(result, duration, stats)
+            # reports are batched and sent (and retried) in the background by API
+            if result == BLOCK_FAILED:
+                API.report_failed(block["uuid"])
+            elif result == BLOCK_OK:
+                API.report_complete(block["uuid"], duration, size)
+                if self.autotuner is not None:
+                    self.autotuner.block_done(duration)
+            with self.lock:
+                del self.held[block["uuid"]]
+            self.aborted.discard(block["uuid"])
+            self.freed.set()
+            COUNTER += 1
+            print(f"\rNum blocks processed locally: {COUNTER}", end="")
+            if args.metrics_file is not None and time.time() - last_metrics_write > METRICS_WRITE_INTERVAL:
+                REGISTRY.write(args.metrics_file)
+                last_metrics_write = time.time()
+
+
+def process_wats(output_path, processes, prefetch):
+    autotuner = None
+    if args.autotune:
+        autotuner = Autotuner(
+            args.min_processes, args.max_processes, start=processes, interval=args.autotune_interval
+        )
+    Pipeline(output_path, processes, prefetch, args.max_processes if args.autotune else None, autotuner).start().run()
 
 
 if __name__ == "__main__":
-    process_wats(args.out_dir, args.processes)
+    if args.metrics_port is not None:
+        REGISTRY.serve(args.metrics_port)
+    try:
+        process_wats(args.out_dir, args.processes, args.prefetch)
+    finally:
+        # send whatever is still queued, the rest is resent from the journal on the next start
+        API.close()
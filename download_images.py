@@ -1,13 +1,16 @@
 # Runs img_dl program across all deduplicated url jsonls
 import subprocess
+import tempfile
 from functools import partial
 from glob import glob
 import sys
 from multiprocessing import Pool, set_start_method
 from pathlib import Path
-import random
 
-from tqdm import tqdm
+from binshard import is_binary, to_jsonl
+from compression import open_reader
+import planner
+from shards import Manifest, commit, complete_inputs, discard, temp_path
 
 
 def process_download(input_file, input_root_dir, output_root_dir, error_root_dir):
@@ -21,12 +24,30 @@ def process_download(input_file, input_root_dir, output_root_dir, error_root_dir
     out_dir = f"{output_root_dir}/{input_dir}"
     Path(out_dir).mkdir(parents=True, exist_ok=True)
 
-    while True:
-        try:
-            subprocess.run(["./img_dl_bin", input_file, out_dir, error_filename], check=True)
-            break
-        except:
-            pass
+    # the errors file is written under a temporary name and recorded in the error dir's manifest once img_dl is done
+    # with the whole input, which is how a restart knows to skip it
+    tmp_error_filename = temp_path(error_filename)
+    with tempfile.TemporaryDirectory(prefix=".urls_", dir=out_dir) as tmp_dir:
+        if is_binary(input_file):
+            # img_dl reads jsonl.gz
+            urls_file = f"{tmp_dir}/urls.jsonl.gz"
+            to_jsonl(input_file, urls_file)
+        else:
+            urls_file = input_file
+        while True:
+            try:
+                subprocess.run(["./img_dl_bin", urls_file, out_dir, tmp_error_filename], check=True)
+                break
+            except:
+                discard(tmp_error_filename)
+    with open_reader(tmp_error_filename) as f:
+        records = sum(1 for _ in f)
+    commit(tmp_error_filename, error_filename, records, Manifest(error_root_dir))
+
+
+def error_path(input_file, input_root_dir, error_root_dir):
+    input_dir = "/".join(input_file.replace(input_root_dir, "", 1).split("/")[:-1])
+    return f"{error_root_dir}/{input_dir}/errors.jsonl.gz"
 
 
 if __name__ == "__main__":
@@ -41,10 +62,13 @@ if __name__ == "__main__":
 
     p = Pool(threads)
 
-    input_files = glob(f"{input_dir}/*/*/*")[:1]
-    random.shuffle(input_files)
+    # only complete url shards, and only those img_dl hasn't finished in an earlier run
+    input_files = complete_inputs(input_dir, glob(f"{input_dir}/*/*/*")[:1])
+    done = set(Manifest(errors_dir).complete([error_path(i, input_dir, errors_dir) for i in input_files]))
+    input_files = [i for i in input_files if error_path(i, input_dir, errors_dir) not in done]
 
     process = partial(process_download, input_root_dir=input_dir, output_root_dir=out_dir, error_root_dir=errors_dir)
 
-    list(tqdm(p.imap_unordered(process, input_files), total=len(input_files), desc="Download images"))
+    # biggest shards first, one img_dl run per shard
+    planner.run(p, process, input_files, [planner.input_size(i) for i in input_files], desc="Download images")
 
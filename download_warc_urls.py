@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 from tqdm import tqdm
 import requests
 import zlib
@@ -6,35 +8,94 @@ import os
 WARC_URLS = None
 WARC_URLS_PATH = "warc_urls.txt"
 INDEX_PATH = "indexes.txt"
+WARC_URL_PREFIX = "http://commoncrawl.s3.amazonaws.com/"
 
 
-def download_warc_urls():
-    print("Downloading warc urls...")
-    ret = []
-    with open(INDEX_PATH) as ind:
-        inds = list(ind.readlines())
-        for url in tqdm(inds):
-            response = requests.get(url.strip(), stream=True)
-            data = zlib.decompress(response.content, zlib.MAX_WBITS | 32)
-            for warc in data.decode("utf-8").split("\n"):
-                if warc.strip():
-                    ret.append(f"http://commoncrawl.s3.amazonaws.com/{warc}")
+def read_manifest(manifest):
+    """
+    Gets the block urls listed in a crawl's wat.paths(.gz) manifest, which can be a url or a local file
+    """
+    if manifest.startswith("http://") or manifest.startswith("https://"):
+        response = requests.get(manifest)
+        response.raise_for_status()
+        data = response.content
+    else:
+        with open(manifest, "rb") as f:
+            data = f.read()
+    if data[:2] == b"\x1f\x8b":
+        data = zlib.decompress(data, zlib.MAX_WBITS | 32)
+    urls = []
+    for warc in data.decode("utf-8").split("\n"):
+        warc = warc.strip()
+        if warc:
+            urls.append(warc if "://" in warc else f"{WARC_URL_PREFIX}{warc}")
+    return urls
+
+
+def read_indexes(index_path=INDEX_PATH):
+    with open(index_path) as ind:
+        return [i.strip() for i in ind if i.strip()]
+
+
+def iter_warc_urls(manifests, threads=8):
+    """
+    Yields the block urls of all `manifests` in order, fetching up to `threads` manifests concurrently
+    """
+    with ThreadPoolExecutor(threads) as executor:
+        # map keeps the manifest order while the fetches run in the background
+        for urls in tqdm(executor.map(read_manifest, manifests), total=len(manifests), desc="Reading manifests"):
+            yield from urls
+
 
+def download_warc_urls(manifests=None, threads=8):
+    print("Downloading warc urls...")
+    if manifests is None:
+        manifests = read_indexes()
+    n = 0
     with open(WARC_URLS_PATH, "w") as fh:
-        fh.write("\n".join(ret))
-    return ret
+        for url in iter_warc_urls(manifests, threads):
+            fh.write(url + "\n")
+            n += 1
+    print(f"{n} warc urls written to {WARC_URLS_PATH}")
 
 
 def get_warc_urls():
     global WARC_URLS
     if WARC_URLS is not None:
         return WARC_URLS
-    elif os.path.isfile(WARC_URLS_PATH):
-        with open(WARC_URLS_PATH, "r") as f:
-            WARC_URLS = f.readlines()
-    else:
-        WARC_URLS = download_warc_urls()
+    if not os.path.isfile(WARC_URLS_PATH):
+        download_warc_urls()
+    with open(WARC_URLS_PATH, "r") as f:
+        WARC_URLS = f.readlines()
+    return WARC_URLS
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        "Get the WAT urls of the crawls in indexes.txt (or the given manifests) into warc_urls.txt or a block DB"
+    )
+    parser.add_argument("manifests", nargs="*", help="wat.paths(.gz) urls or local files (default: indexes.txt)")
+    parser.add_argument("--threads", type=int, default=8, help="manifests fetched concurrently")
+    parser.add_argument("--db", type=str, default=None, help="append the blocks to this block DB directly")
+    parser.add_argument("--scheduler", type=str, default=None, help="append the blocks through a running scheduler")
+    parser.add_argument("--port", type=str, default="5000")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="blocks inserted per transaction")
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
-    get_warc_urls()
+    args = parse_args()
+    manifests = args.manifests or read_indexes()
+    if args.scheduler is not None:
+        # the scheduler fetches the manifests itself, so local paths have to exist on the scheduler's machine
+        from api import API
+
+        print(API(host=args.scheduler, port=args.port).ingest_crawls(manifests))
+    elif args.db is None:
+        download_warc_urls(manifests, args.threads)
+    else:
+        from db import DB
+
+        db = DB(path=args.db, warc_urls_path=None)
+        inserted = db.ingest(iter_warc_urls(manifests, args.threads), chunk_size=args.chunk_size)
+        print(f"{inserted} new blocks added, {len(db)} blocks in total")
@@ -1,194 +1,402 @@
-import gzip
+import argparse
 import hashlib
-import json
-import sys
 from glob import glob
+from itertools import repeat
+from operator import itemgetter
 from multiprocessing import Pool, set_start_method
 from pathlib import Path
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse
+
+from binshard import BinaryShardWriter, binary_path
+from canonicalize import CANONICALIZER
+from codec import Codec, summarize
+from compression import READ_ERRORS, open_reader
+from extsort import Runs, group_sorted
+from partitions import PartitionWriter, chunk_key, partition_paths, write_layout
+import planner
+from shards import Manifest, ShardWriter, complete_inputs
+
+
+def page_images(p):
+    """
+    Extracts the images (with alt text) linked from one decoded page-level record (a line of the filter's output).
+    Returns (images, page metadata, licenses, page url), each image being (url, alt text, the link's fields as
+    (key, value) pairs in link order, with None in place of the url and alt text)
+    """
+    page_meta = []
+    licenses = set()
+    images = []
+    html_meta = p["Envelope"]["Payload-Metadata"]["HTTP-Response-Metadata"]["HTML-Metadata"]
+    links = html_meta["Links"]
+    target_url = urlparse(p['Envelope']['WARC-Header-Metadata']['WARC-Target-URI'])
+    target_path = target_url._replace(query="").geturl()
 
-from tqdm import tqdm
-
-
-def canonicalize_wikimedia(url):
-    path = url.path.split("/")
-
-    if "thumb" in path:
-        path = path[:-1]
-        path.remove("thumb")
-
-    path = "/".join(path)
-
-    return url._replace(path=path, scheme="http", params='', query='', fragment='')
-
-
-def canonicalize_wp(url):
-    target_url = url.path[1:]
-    return urlparse(target_url)
-
-
-def canonicalize_ytimg(url):
-    path = url.path
-    larger_suffixes = {"sddefault",  # 640
-                       "maxresdefault",  # original
-                       }
-
-    *path, fname = path.split("/")
-    option, _ = fname.split(".")
-
-    if option not in larger_suffixes:
-        option = "0"
-
-    fname = f"{option}.jpg"
-    path = "/".join(path + [fname])
-
-    return url._replace(path=path, netloc="i.ytimg.com", scheme="http", params='', query='', fragment='')
-
-
-# replace all suffixes with default (500x500) unless its larger
-def canonicalize_flickr(url):
-    path = url.path
-
-    larger_suffixes = {"z",  # 640
-                       "c",  # 800
-                       "b",  # 1024
-                       }
-
-    path, ext = path.split(".")
-    if path[-2] == "_":
-        if path[-1] not in larger_suffixes:
-            path = path[:-2]
-
-    return url._replace(path=f"{path}.{ext}", scheme="http", params='', query='', fragment='')
-
-
-# replace thumbnails, try to get full res images, skip proxies etc
-def canonicalize_url(url):
-    parsed = urlparse(url)
-    hostname = parsed.netloc
-
-    special_cases = {
-        "flickr.com": canonicalize_flickr,
-        "img.youtube.com": canonicalize_ytimg,
-        "ytimg.com": canonicalize_ytimg,
-        "wp.com": canonicalize_wp,
-        "upload.wikimedia.org": canonicalize_wikimedia
-    }
-
-    for name, fn in special_cases.items():
-        if name in hostname:
-            return fn(parsed).geturl()
-
-    return parsed.geturl()
-
-
-def dump_url_from_file(fname, oname):
     try:
-        f = gzip.open(fname, 'rb')
-        fo = gzip.open(oname, 'wb', compresslevel=6)
-        all_images = []
-
-        for i in f:
-            page_meta = []
-            licenses = set()
-            images = []
-            try:
-                p = json.loads(i)
-            except:
-                continue
-            html_meta = p["Envelope"]["Payload-Metadata"]["HTTP-Response-Metadata"]["HTML-Metadata"]
-            links = html_meta["Links"]
-            target_url = urlparse(p['Envelope']['WARC-Header-Metadata']['WARC-Target-URI'])
-            target_path = target_url._replace(query="").geturl()
+        if "Head" in html_meta:
+            if "Title" in html_meta["Head"]:
+                page_meta.append(html_meta["Head"]["Title"])
+            if "Metas" in html_meta["Head"]:
+                for m in html_meta["Head"]["Metas"]:
+                    if "content" in m:
+                        page_meta.append(m["content"])
+    except:
+        pass
 
+    # (link index, url) of the license links and (link index, link) of the images with alt text, in link order
+    license_links = []
+    candidates = []
+    for i, img in enumerate(links):
+        try:
+            if "creativecommons" in img["url"]:
+                license_links.append((i, img["url"]))
+            else:
+                if "alt" in img and len(img["alt"]) > 10 and img["url"].startswith("http"):
+                    candidates.append((i, img))
+        except:
+            pass
+
+    # the page's image links are canonicalized together, links that fail are skipped. Pages stop being read after
+    # their 101st image, including license links that come after it
+    urls = CANONICALIZER.resolve_links(target_path, [img["url"] for _, img in candidates])
+    end = len(links)
+    for (i, img), url in zip(candidates, urls):
+        if url is None:
+            continue
+        fields = tuple((key, None if key in ("url", "alt") else value) for key, value in img.items())
+        images.append((url, img["alt"], fields))
+        if len(images) > 100:
+            end = i + 1
+            break
+    licenses.update(url for i, url in license_links if i < end)
+
+    return images, page_meta, licenses, target_path
+
+
+# rough sizes (bytes) of the objects an ImageAggregator keeps, for its memory cap
+ENTRY_BYTES = 400
+SET_BYTES = 250
+STR_BYTES = 50
+DEFAULT_MAX_BYTES = 1 << 30
+
+
+def _union(current, new):
+    # alt text, page metadata, licenses and page urls are kept as a single string or a shared (interned) frozenset
+    # until an image's second occurrence adds to them - only then does the image get a set of its own
+    if current is new:
+        return current
+    if not isinstance(current, set):
+        current = {current} if isinstance(current, str) else set(current)
+    if isinstance(new, str):
+        current.add(new)
+    else:
+        current.update(new)
+    return current
+
+
+def _values(value):
+    return {value} if isinstance(value, str) else value
+
+
+def _combine(first, other):
+    # merges two (hash, url, entry) of the same url, keeping the link fields of the first
+    h, url, (fields, alt, page_meta, licenses, page_url, count) = first
+    _, _, (_, other_alt, other_page_meta, other_licenses, other_page_url, other_count) = other
+    return h, url, [
+        fields, _union(alt, other_alt), _union(page_meta, other_page_meta), _union(licenses, other_licenses),
+        _union(page_url, other_page_url), count + other_count,
+    ]
+
+
+class ImageAggregator:
+    """
+    Merges the images of one block by url in a single pass as its pages come in, so a block can be aggregated from a
+    stream of pages (e.g straight from the filter) as well as from a file.
+
+    Each url is one compact entry: [link fields, alt text, page metadata, licenses, page urls, count]. Strings, link
+    fields and the per-page metadata and license sets are interned, so the images of a page (and pages of a site) share
+    them. Once the entries take roughly `max_bytes`, they're spilled to disk as a run sorted by hash under `tmp_dir`,
+    and the runs are merged back when the records are written.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None):
+        self.max_bytes = max_bytes
+        self.tmp_dir = tmp_dir
+        self.runs = None
+        self._reset()
+
+    def _reset(self):
+        # url -> entry
+        self.images = {}
+        # value -> the one copy of it kept
+        self.interned = {}
+        self.approx_bytes = 0
+
+    def _intern(self, value):
+        interned = self.interned.setdefault(value, value)
+        if interned is value:
+            self.approx_bytes += STR_BYTES + len(value) if isinstance(value, str) else SET_BYTES
+        return interned
+
+    def add_page(self, page):
+        images, page_meta, licenses, page_url = page_images(page)
+        if not images:
+            return
+        page_meta = self._intern(frozenset(self._intern(m) for m in page_meta))
+        licenses = self._intern(frozenset(self._intern(l) for l in licenses))
+        page_url = self._intern(page_url)
+        for url, alt, fields in images:
+            self.add(url, self._intern(alt), fields, page_meta, licenses, page_url)
+        if self.approx_bytes > self.max_bytes:
+            self.spill()
+
+    def add(self, url, alt, fields, page_meta, licenses, page_url):
+        entry = self.images.get(url)
+        if entry is None:
             try:
-                if "Head" in html_meta:
-                    if "Title" in html_meta["Head"]:
-                        page_meta.append(html_meta["Head"]["Title"])
-                    if "Metas" in html_meta["Head"]:
-                        for m in html_meta["Head"]["Metas"]:
-                            if "content" in m:
-                                page_meta.append(m["content"])
-            except:
+                fields = self._intern(fields)
+            except TypeError:
+                # unhashable link fields, not worth sharing
                 pass
+            self.images[url] = [fields, alt, page_meta, licenses, page_url, 1]
+            self.approx_bytes += ENTRY_BYTES + len(url)
+            return
+        for i, value in ((1, alt), (2, page_meta), (3, licenses), (4, page_url)):
+            if not isinstance(entry[i], set) and entry[i] is not value:
+                self.approx_bytes += SET_BYTES
+            entry[i] = _union(entry[i], value)
+        entry[5] += 1
+
+    def _sorted_entries(self):
+        return sorted((hashlib.md5(url.encode('utf-8')).hexdigest(), url, entry) for url, entry in self.images.items())
+
+    def spill(self):
+        """
+        Moves every entry to a run on disk
+        """
+        if self.runs is None:
+            self.runs = Runs(self.tmp_dir)
+        self.runs.spill(self._sorted_entries())
+        self._reset()
+
+    def records(self):
+        """
+        Yields (hash, image record) for every image, ordered by hash, with sorted lists - so the output only depends
+        on the pages seen, not on the order they came in, on set iteration order or on how often entries were spilled
+        """
+        entries = self._sorted_entries()
+        self._reset()
+        if self.runs is not None:
+            # runs are merged in the order they were spilled, so an image keeps the link fields of its first occurrence
+            key = itemgetter(0, 1)
+            entries = group_sorted(self.runs.merge(entries, key=key), key, _combine)
+        try:
+            for h, url, (fields, alt, page_meta, licenses, page_url, count) in entries:
+                alt = sorted(_values(alt))
+                img = {}
+                for key, value in fields:
+                    img[key] = url if key == "url" else alt if key == "alt" else value
+                img["page_meta"] = sorted(_values(page_meta).difference(alt))
+                img["licenses"] = sorted(_values(licenses))
+                img["page_url"] = sorted(_values(page_url))
+                img["count"] = count
+                img["hash"] = h
+                yield h, img
+        finally:
+            if self.runs is not None:
+                self.runs.close()
+                self.runs = None
+
+
+def write_images(aggregator, writer, codec):
+    """
+    Writes a block's image records to the shard `writer`, as `<hash> <json>` lines or binary records
+    """
+    if isinstance(writer, BinaryShardWriter):
+        for h, img in aggregator.records():
+            del img["hash"]
+            writer.write_record(bytes.fromhex(h), codec.dumps(img))
+        codec.counts["encoded"] += writer.records
+        return
+    for h, img in aggregator.records():
+        writer.write(h.encode() + b" " + codec.dump_line(img))
+
+
+def aggregate_lines(f, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None, codec=None):
+    """
+    Aggregates the page-level records of the binary jsonl file `f`, decoded with `codec`
+    """
+    codec = Codec() if codec is None else codec
+    aggregator = ImageAggregator(max_bytes, tmp_dir)
+    for page in codec.records(f):
+        aggregator.add_page(page)
+    return aggregator
+
+
+def dump_urls_from_lines(
+    f, oname, manifest=None, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None, codec=None, binary=False
+):
+    """
+    Aggregates the page-level records of the binary jsonl file `f` into image-level records in the shard `oname`
+    (a binary shard if `binary`), returns how many images were written
+    """
+    codec = Codec() if codec is None else codec
+    aggregator = aggregate_lines(f, max_bytes, tmp_dir, codec)
+    with (BinaryShardWriter if binary else ShardWriter)(oname, manifest) as writer:
+        write_images(aggregator, writer, codec)
+    return writer.records
+
+
+def dump_urls_from_path(fname, oname, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None):
+    """
+    Aggregates the plain page-level records in `fname` (e.g a named pipe the filter writes to) into a temporary shard
+    for `oname`, which is left for the caller to commit (or discard). Returns (`ShardWriter.close()`, codec counts)
+    """
+    codec = Codec()
+    with open(fname, 'rb') as f:
+        aggregator = aggregate_lines(f, max_bytes, tmp_dir, codec)
+    writer = ShardWriter(oname)
+    try:
+        write_images(aggregator, writer, codec)
+    except BaseException:
+        writer.discard()
+        raise
+    return writer.close(), codec.counts
+
+
+def dump_url_from_file(fname, oname, manifest=None, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None, binary=False):
+    """
+    Dumps the block `fname` to the shard `oname`, returns its codec counts (and whether it failed)
+    """
+    codec = Codec()
+    try:
+        with open_reader(fname) as f:
+            dump_urls_from_lines(f, oname, manifest, max_bytes, tmp_dir, codec, binary)
+    except (*READ_ERRORS, OSError, KeyError, TypeError, ValueError) as e:
+        # unreadable input, or page records without the fields the filter writes
+        print(f"\rfile {fname} failed to process: {e!r}")
+        codec.counts["failed_blocks"] += 1
+    return codec.counts
+
+
+def write_partitioned(aggregator, writer, codec):
+    """
+    Writes a block's image records to the partitions of a PartitionWriter, as `<hash> <json>` lines (like sort_dedup's
+    scatter files) or binary records
+    """
+    for h, img in aggregator.records():
+        if writer.binary:
+            del img["hash"]
+            writer.write_record(bytes.fromhex(h), codec.dumps(img))
+            codec.counts["encoded"] += 1
+        else:
+            writer.write(h, h.encode() + b" " + codec.dump_line(img))
+
+
+def dump_urls_partitioned(flist, key, output_dir, out_levels, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None, binary=False):
+    """
+    Dumps a chunk of blocks straight into hash partitions of `output_dir`, the way sort_dedup.py's scatter stage
+    would, one shard per partition for the chunk. Returns the codec counts
+    """
+    codec = Codec()
+    with PartitionWriter(key, output_dir, out_levels, binary) as writer:
+        for fname in flist:
+            try:
+                with open_reader(fname) as f:
+                    aggregator = aggregate_lines(f, max_bytes, tmp_dir, codec)
+            except (*READ_ERRORS, OSError, KeyError, TypeError, ValueError) as e:
+                print(f"\rfile {fname} failed to process: {e!r}")
+                codec.counts["failed_blocks"] += 1
+                continue
+            write_partitioned(aggregator, writer, codec)
+    return codec.counts
 
-            for img in links:
-                try:
-                    if len(images) > 100:
-                        break
-                    if "creativecommons" in img["url"]:
-                        licenses.add(img["url"])
-                    else:
-                        if "alt" in img and len(img["alt"]) > 10 and img["url"].startswith("http"):
-                            img["url"] = canonicalize_url(urljoin(target_path, img["url"]))
-                            images.append(img)
-                except:
-                    pass
-
-            for img in images:
-                img["page_meta"] = set([img["alt"]] + page_meta)
-                img["licenses"] = licenses
-                img["alt"] = {img["alt"]}
-                img["page_url"] = {target_path}
-                all_images.append(img)
-
-        deduped_images = {}
-        for img in all_images:
-            existing = deduped_images.get(img["url"], img)
-
-            def get_or_update(key):
-                e = existing.get(key, set())
-                e.update(img[key])
-                return e
-
-            existing["alt"] = get_or_update("alt")
-            existing["page_meta"] = get_or_update("page_meta")
-            existing["licenses"] = get_or_update("licenses")
-            existing["page_url"] = get_or_update("page_url")
-            existing["count"] = existing.get("count", 0) + 1
-
-            existing["page_meta"].difference_update(existing["alt"])
-
-            deduped_images[img["url"]] = existing
-
-        for img in deduped_images.values():
-            img["alt"] = list(img["alt"])
-            img["page_meta"] = list(img["page_meta"])
-            img["licenses"] = list(img["licenses"])
-            img["page_url"] = list(img["page_url"])
-
-            h = hashlib.md5(img["url"].encode('utf-8')).hexdigest()
-            img["hash"] = h
-            fo.write(h.encode())
-            fo.write(b" ")
-
-            fo.write(json.dumps(img).encode())
-            fo.write(b"\n")
-        fo.close()
 
-    except:
-        print(f"\rfile {fname} failed to process")
-        pass
+def process_partitioned(x):
+    (key, chunk), output_dir, out_levels, max_bytes, tmp_dir, binary = x
+    return dump_urls_partitioned(
+        [piece.path for piece in chunk], key, output_dir, out_levels, max_bytes, tmp_dir, binary
+    )
 
 
 def process(x):
-    in_file, out_file = x
+    in_file, out_file, output_dir, max_bytes, tmp_dir, binary = x
     Path("/".join(out_file.split("/")[:-1])).mkdir(parents=True, exist_ok=True)
-    return dump_url_from_file(in_file, out_file)
+    return dump_url_from_file(in_file, out_file, Manifest(output_dir), max_bytes, tmp_dir, binary)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Aggregate page-level records into image-level records, one shard per block")
+    parser.add_argument("threads", type=int)
+    parser.add_argument("input_dir", type=str)
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument(
+        "--max_mb", type=int, default=DEFAULT_MAX_BYTES >> 20,
+        help="roughly how much memory each process aggregates in before spilling sorted runs to disk",
+    )
+    parser.add_argument("--tmp_dir", type=str, default=None, help="where runs are spilled (default: the system's)")
+    parser.add_argument(
+        "--format", choices=["jsonl", "bin"], default="jsonl",
+        help="write jsonl.gz shards, or binary ones (see binshard.py) that the later stages read and write in turn",
+    )
+    parser.add_argument(
+        "--partition_levels", type=int, default=0,
+        help="write the records partitioned by the first hex digits of their hash into 16 ** levels directories (2 "
+             "is sort_dedup.py's 256), in shards per chunk of blocks rather than per block, so sort_dedup.py can skip "
+             "its scatter stage. 0 (the default) writes a shard per block",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
     set_start_method("spawn")
 
-    assert len(sys.argv) == 4
-
-    input_dir = sys.argv[2]
-    output_dir = sys.argv[3]
-    thread = int(sys.argv[1])
-
-    input_files = glob(f"{input_dir}/**/*")
-
-    output_files = [i.replace(input_dir, output_dir, 1) for i in input_files]
-    p = Pool(thread)
-
-    urls = list(tqdm(p.imap_unordered(process, zip(input_files, output_files)), total=len(input_files)))
+    args = parse_args()
+    input_dir = args.input_dir
+    output_dir = args.output_dir
+    thread = args.threads
+
+    binary = args.format == "bin"
+
+    if args.partition_levels:
+        p = Pool(thread)
+
+        # like sort_dedup.py's scatter stage: chunks of blocks of about the same bytes, each written to a shard per
+        # partition, and skipped if an earlier run wrote its shards from the same blocks
+        input_files = sorted(complete_inputs(input_dir, glob(f"{input_dir}/**/*")))
+        chunks = planner.balance(input_files, thread * 4)
+        chunked_input = [(chunk_key([piece.path for piece in chunk]), chunk) for chunk in chunks]
+        paths = {key: partition_paths(key, output_dir, args.partition_levels, binary) for key, _ in chunked_input}
+        names = {Path(p[0]).name for p in paths.values()}
+        manifest = Manifest(output_dir)
+        entries = manifest.entries()
+        todo = [
+            (key, chunk) for key, chunk in chunked_input
+            if len(manifest.complete(paths[key], entries)) < len(paths[key])
+        ]
+
+        tasks = [(c, output_dir, args.partition_levels, args.max_mb << 20, args.tmp_dir, binary) for c in todo]
+        sizes = [sum(piece.size for piece in chunk) for _, chunk in todo]
+        counts = planner.run(p, process_partitioned, tasks, sizes, desc="dump urls (partitioned)")
+        # sort_dedup.py reads this run's shards as its scatter files, once they're all written
+        write_layout(output_dir, args.partition_levels, names, binary)
+        print(summarize(counts))
+    else:
+        def output_file(input_file):
+            output_file = input_file.replace(input_dir, output_dir, 1)
+            return binary_path(output_file) if binary else output_file
+
+        # only blocks the download stage finished, and only those not already dumped by an earlier run
+        input_files = complete_inputs(input_dir, glob(f"{input_dir}/**/*"))
+        done = set(Manifest(output_dir).complete([output_file(i) for i in input_files]))
+
+        input_files = [i for i in input_files if output_file(i) not in done]
+        output_files = [output_file(i) for i in input_files]
+        p = Pool(thread)
+
+        # biggest blocks first, a block's filter output can't be split (it's one compressed stream)
+        tasks = list(zip(
+            input_files, output_files, repeat(output_dir), repeat(args.max_mb << 20), repeat(args.tmp_dir),
+            repeat(binary),
+        ))
+        counts = planner.run(p, process, tasks, [planner.input_size(i) for i in input_files], desc="dump urls")
+        print(summarize(counts))
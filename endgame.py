@@ -0,0 +1,87 @@
+# speculative re-execution of the last in progress blocks of a crawl
+from collections import defaultdict
+
+
+class EndGame:
+    """
+    Once there are no available blocks left, idle workers are handed duplicate (speculative) leases on the oldest in
+    progress blocks. Whichever copy of a block completes first wins, and every other holder of the block is told to
+    abort it with its next heartbeat.
+
+    Speculative copies only live here - the block's row keeps pointing at its original holder - so failures and
+    heartbeats of a copy are routed through this class rather than straight to the DB.
+    """
+
+    def __init__(self, max_copies=1, min_age=60 * 5):
+        # speculative copies per block (on top of the original lease)
+        self.max_copies = max_copies
+        # seconds a block has to be in progress for before it is duplicated
+        self.min_age = min_age
+        # uuid -> {worker_id: original holder (False) or speculative copy (True)}
+        self.holders = {}
+        # worker_id -> uuids the worker should stop working on
+        self.aborts = defaultdict(set)
+
+    def pick(self, candidates, worker_id, n):
+        """
+        Picks up to `n` of the in progress `candidates` (url, uuid, last_updated, holder) rows to duplicate for
+        `worker_id`, oldest first
+        """
+        picked = []
+        for url, uuid, last_updated, holder in candidates:
+            if len(picked) >= n:
+                break
+            holders = self.holders.get(uuid, {holder: False})
+            if holder == worker_id or worker_id in holders or sum(holders.values()) >= self.max_copies:
+                continue
+            holders[worker_id] = True
+            self.holders[uuid] = holders
+            picked.append((url, uuid, last_updated))
+        return picked
+
+    def leased(self, uuids, worker_id):
+        """
+        Records a regular lease of `uuids` (blocks that failed and were leased again) so their new holder is told to
+        abort too if a copy wins
+        """
+        for uuid in uuids:
+            if uuid in self.holders:
+                self.holders[uuid][worker_id] = False
+
+    def is_copy(self, uuid, worker_id):
+        return self.holders.get(uuid, {}).get(worker_id, False)
+
+    def completed(self, uuids, worker_id):
+        """
+        Settles the race for `uuids`, completed by `worker_id`: every other holder is told to abort
+        """
+        for uuid in uuids:
+            holders = self.holders.pop(uuid, None)
+            if holders is None:
+                continue
+            for holder in holders:
+                if holder != worker_id:
+                    self.aborts[holder].add(uuid)
+
+    def failed(self, uuids, worker_id):
+        """
+        Drops the speculative copies `worker_id` held among the failed `uuids`, returns the uuids that were not
+        speculative copies (and should be marked failed in the DB)
+        """
+        not_copies = []
+        for uuid in uuids:
+            if self.is_copy(uuid, worker_id):
+                del self.holders[uuid][worker_id]
+            else:
+                not_copies.append(uuid)
+        return not_copies
+
+    def take_aborts(self, worker_id):
+        return sorted(self.aborts.pop(worker_id, set()))
+
+    def stats(self):
+        return {
+            "speculative_blocks": len(self.holders),
+            "speculative_copies": sum(sum(holders.values()) for holders in self.holders.values()),
+            "pending_aborts": sum(len(uuids) for uuids in self.aborts.values()),
+        }
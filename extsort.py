@@ -0,0 +1,101 @@
+# external sorting: spill sorted runs of items to disk when they don't fit in memory, then merge them back in order
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+
+# items pickled together, so reading a run back isn't one unpickle call per item
+BATCH_ITEMS = 1024
+# runs merged at once (each is an open file), more runs are first merged in passes
+FANOUT = 128
+
+
+class Runs:
+    """
+    Sorted runs spilled to files in a temporary directory (under `tmp_dir`, or the system's), removed on `close()`.
+    Each run is a sequence of pickled batches of items.
+    """
+
+    def __init__(self, tmp_dir=None, fanout=FANOUT):
+        self.dir = tempfile.mkdtemp(prefix="runs_", dir=tmp_dir)
+        self.fanout = max(2, fanout)
+        self.paths = []
+        self.n_spilled = 0
+
+    def __len__(self):
+        return len(self.paths)
+
+    def spill(self, items):
+        """
+        Writes the already sorted `items` as a new run, returns its path
+        """
+        path = os.path.join(self.dir, f"run_{self.n_spilled}")
+        self.n_spilled += 1
+        with open(path, "wb") as f:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == BATCH_ITEMS:
+                    pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+                    batch = []
+            if batch:
+                pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+        self.paths.append(path)
+        return path
+
+    @staticmethod
+    def read(path):
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    batch = pickle.load(f)
+                except EOFError:
+                    return
+                yield from batch
+
+    def _merge_pass(self, key):
+        # merges the first `fanout` runs into one, which takes their place at the front so run order is kept
+        first, rest = self.paths[:self.fanout], self.paths[self.fanout:]
+        self.paths = list(first)
+        path = self.spill(heapq.merge(*[self.read(path) for path in first], key=key))
+        for merged in first:
+            os.remove(merged)
+        self.paths = [path] + rest
+
+    def merge(self, *extra, key=None):
+        """
+        Yields the items of every run (and of the sorted iterables `extra`, which come after the runs) in order. Equal
+        items come out in run order - runs spilled earlier first
+        """
+        while len(self.paths) + len(extra) > self.fanout:
+            self._merge_pass(key)
+        return heapq.merge(*[self.read(path) for path in self.paths], *extra, key=key)
+
+    def close(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.paths = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def group_sorted(items, key, combine):
+    """
+    Combines consecutive items with the same `key` with `combine(first, other)`, which returns the combined item
+    """
+    current = None
+    current_key = None
+    for item in items:
+        item_key = key(item)
+        if current is not None and item_key == current_key:
+            current = combine(current, item)
+        else:
+            if current is not None:
+                yield current
+            current, current_key = item, item_key
+    if current is not None:
+        yield current
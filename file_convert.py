@@ -1,6 +1,4 @@
 # Attempt decompression, compute metadata and (maybe) resize/reencode image
-import gzip
-import json
 import os
 import shutil
 import sys
@@ -8,20 +6,14 @@ from functools import partial
 from glob import glob
 from multiprocessing import Pool, set_start_method, Process
 from pathlib import Path
-import random
 
 import cv2
 import filetype
-from tqdm import tqdm
 
-
-def jsonl_generator(fname):
-    f = gzip.open(fname, 'rb')
-    for i in f:
-        try:
-            yield json.loads(i)
-        except:
-            pass
+from binshard import BinaryShardWriter, is_binary, read_records
+from codec import Codec, summarize
+import planner
+from shards import Manifest, ShardWriter, complete_inputs
 
 
 def convert_file(input_file, output_file):
@@ -89,25 +81,36 @@ def process_jsonl(file, img_in_root_dir, label_in_root_dir, img_out_root_dir, la
     Path(img_out_root_dir + leaf_dir).mkdir(parents=True, exist_ok=True)
     Path(label_out_root_dir + leaf_dir).mkdir(parents=True, exist_ok=True)
 
-    f = gzip.open(label_out_root_dir + leaf_dir + "/" + file.split("/")[-1], 'wb')
-
-    for record in jsonl_generator(file):
-        try:
-            image_in = img_in_root_dir + leaf_dir + "/" + record['hash']
-            image_out = img_out_root_dir + leaf_dir + "/" + record['hash']
-
-            additional_meta = convert_file(image_in, image_out)
-
-            if additional_meta:
-                f.write(json.dumps({
-                    **record,
-                    **additional_meta
-                }).encode())
-                f.write(b"\n")
-        except:
-            pass
-
-    f.close()
+    codec = Codec()
+    # labels are written in the format of the deduped shard they come from
+    binary = is_binary(file)
+    out_file = label_out_root_dir + leaf_dir + "/" + file.split("/")[-1]
+    with (BinaryShardWriter(out_file, Manifest(label_out_root_dir), level=9) if binary else
+          ShardWriter(out_file, Manifest(label_out_root_dir), compresslevel=9)) as f:
+        for record in read_records(file, codec):
+            try:
+                image_in = img_in_root_dir + leaf_dir + "/" + record['hash']
+                image_out = img_out_root_dir + leaf_dir + "/" + record['hash']
+
+                additional_meta = convert_file(image_in, image_out)
+
+                if additional_meta and binary:
+                    h = bytes.fromhex(record.pop('hash'))
+                    f.write_record(h, codec.dumps({
+                        **record,
+                        **additional_meta
+                    }))
+                elif additional_meta:
+                    f.write(codec.dump_line({
+                        **record,
+                        **additional_meta
+                    }))
+                else:
+                    codec.counts["invalid_images"] += 1
+            except Exception:
+                # e.g the image wasn't downloaded, or isn't one cv2 can read
+                codec.counts["convert_errors"] += 1
+    return codec.counts
 
 
 if __name__ == "__main__":
@@ -123,8 +126,10 @@ if __name__ == "__main__":
 
     p = Pool(threads)
 
-    input_files = glob(f"{label_in_dir}/*/*/*")
-    random.shuffle(input_files)
+    # only complete label shards, and only those not converted by an earlier run
+    input_files = complete_inputs(label_in_dir, glob(f"{label_in_dir}/*/*/*"))
+    done = set(Manifest(label_out_dir).complete([i.replace(label_in_dir, label_out_dir, 1) for i in input_files]))
+    input_files = [i for i in input_files if i.replace(label_in_dir, label_out_dir, 1) not in done]
 
     process = partial(process_jsonl,
                       img_in_root_dir=image_in_dir,
@@ -132,6 +137,9 @@ if __name__ == "__main__":
                       img_out_root_dir=image_out_dir,
                       label_out_root_dir=label_out_dir)
 
-    list(tqdm(p.imap_unordered(process, input_files), total=len(input_files), desc="Convert images", file=sys.stdout))
+    # biggest shards first, each converted into its own label shard
+    counts = planner.run(p, process, input_files, [planner.input_size(i) for i in input_files], desc="Convert images",
+                         file=sys.stdout)
+    print(summarize(counts))
 
     # process_jsonl("deduped_urls/0/0/deduped.jsonl.gz", "images", "deduped_urls", "converted_images", "labels")
@@ -0,0 +1,87 @@
+# drives a long-running `commoncrawl_filter_bin --server` process
+import json
+import select
+import subprocess
+import time
+
+FILTER_BIN = "./commoncrawl_filter_bin"
+
+
+class FilterError(Exception):
+    pass
+
+
+def filter_options(threads=1, ordered=True, raw=False):
+    """
+    Gets the filter's command line options for parsing each block with `threads` threads, writing plain jsonl instead
+    of gzip if `raw`
+    """
+    options = []
+    if threads > 1:
+        options += ["--threads", str(threads)]
+        if not ordered:
+            options.append("--unordered")
+    if raw:
+        options.append("--raw")
+    return options
+
+
+class FilterServer:
+    """
+    One filter process that takes blocks one at a time over stdin and answers each with a json line of stats, so the
+    process, its http connections and its buffers are reused across blocks instead of spawning the filter per block.
+    The process is (re)started on demand, and killed if a block is aborted or times out.
+    """
+
+    def __init__(self, binary=FILTER_BIN, poll_interval=5, args=()):
+        self.binary = binary
+        # extra filter options, e.g ["--threads", "4"]
+        self.args = list(args)
+        # seconds between checks whether the running block should be aborted
+        self.poll_interval = poll_interval
+        self.proc = None
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [self.binary, "--server", *self.args], stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        return self
+
+    def kill(self):
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc = None
+
+    close = kill
+
+    def filter(self, input, output, timeout=None, abort=None):
+        """
+        Filters the block at `input` (url or local path) into `output`, returns the filter's stats (records, kept,
+        errors, bytes_in, bytes_out), or None if `abort()` became true while it was running
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+        self.proc.stdin.write(f"{input}\t{output}\n".encode())
+        self.proc.stdin.flush()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            ready, _, _ = select.select([self.proc.stdout], [], [], self.poll_interval)
+            if ready:
+                line = self.proc.stdout.readline()
+                if not line:
+                    code = self.proc.wait()
+                    self.proc = None
+                    raise FilterError(f"filter server exited with code {code} while filtering {input}")
+                break
+            if abort is not None and abort():
+                self.kill()
+                return None
+            if deadline is not None and time.time() > deadline:
+                self.kill()
+                raise subprocess.TimeoutExpired([self.binary, "--server", input], timeout)
+        result = json.loads(line)
+        if not result.pop("ok"):
+            raise FilterError(result["error"])
+        result.pop("input", None)
+        return result
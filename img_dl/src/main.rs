@@ -1,6 +1,6 @@
 use std::str;
 use std::fs::OpenOptions;
-use std::io::{BufReader, Write};
+use std::io::{BufReader, Read, Seek, SeekFrom, Write};
 use std::io::BufRead;
 use std::time::Duration;
 use std::env;
@@ -11,7 +11,7 @@ use tokio::fs::File;
 use tokio::io::AsyncWriteExt;
 use tokio::time::timeout;
 
-use flate2::read::GzDecoder;
+use flate2::read::MultiGzDecoder;
 use flate2::write::GzEncoder;
 use flate2::Compression;
 
@@ -29,9 +29,45 @@ struct ImageRecord {
     error: Option<String>,
 }
 
+const ZSTD_MAGIC: [u8; 4] = [0x28, 0xb5, 0x2f, 0xfd];
+
+// the url shards are gzip (possibly several members, e.g from pgzip) or zstd, told apart by their magic bytes
+fn open_shard(fname: &str) -> Box<dyn Read> {
+    let mut file = OpenOptions::new().read(true).open(fname).unwrap();
+    let mut magic = [0u8; 4];
+    let is_zstd = file.read_exact(&mut magic).is_ok() && magic == ZSTD_MAGIC;
+    file.seek(SeekFrom::Start(0)).unwrap();
+    if is_zstd {
+        Box::new(zstd::Decoder::new(file).unwrap())
+    } else {
+        Box::new(MultiGzDecoder::new(file))
+    }
+}
+
+// writes the errors file with the pipeline's SHARD_COMPRESSION setting ("gzip[:level]", "pgzip[:level]" or
+// "zstd[:level]"), gzip level 3 if it's unset
+fn create_shard(fname: &str) -> Result<Box<dyn Write>> {
+    let outfile = OpenOptions::new().create(true).write(true).truncate(true).open(fname)?;
+    let spec = env::var("SHARD_COMPRESSION").unwrap_or_default();
+    let mut parts = spec.trim().split(':');
+    let name = parts.next().unwrap_or("");
+    let level = parts.next().filter(|l| !l.is_empty());
+    match name {
+        "" => Ok(Box::new(GzEncoder::new(outfile, Compression::new(3)))),
+        "gzip" | "pgzip" => {
+            let level = level.map_or(Ok(6), |l| l.parse())?;
+            Ok(Box::new(GzEncoder::new(outfile, Compression::new(level))))
+        },
+        "zstd" => {
+            let level = level.map_or(Ok(3), |l| l.parse())?;
+            Ok(Box::new(zstd::Encoder::new(outfile, level)?.auto_finish()))
+        },
+        _ => Err(anyhow!("SHARD_COMPRESSION should be gzip, pgzip or zstd[:level], not {}", spec))
+    }
+}
+
 fn get_image_records(fname: &str) -> Vec<ImageRecord> {
-    let file = OpenOptions::new().read(true).open(fname).unwrap();
-    let file = GzDecoder::new(file);
+    let file = open_shard(fname);
     let file = BufReader::new(file);
 
     let mut ret = Vec::new();
@@ -112,8 +148,7 @@ async fn main() -> Result<(), Error> {
     // records.truncate(100);
     // println!("records {}", records.len());
 
-    let outfile = OpenOptions::new().create(true).write(true).truncate(true).open(&args[3])?;
-    let mut outfile_writer = GzEncoder::new(outfile, Compression::new(3));
+    let mut outfile_writer = create_shard(&args[3])?;
 
     let futures: Vec<_> = records.iter().map(|record| {
         retry_download(record.url.clone(), format!("{}/{}", &args[2], &record.hash)).then(move |result| {
@@ -0,0 +1,133 @@
+# hash-partitioned url shards: image records routed by the first hex digits of their url hash into 16 ** levels
+# directories ({root}/x/y/ for 2 levels), with one shard per chunk of inputs in each. sort_dedup.py's scatter stage
+# writes them, and so does dump_urls.py --partition_levels, after which sort_dedup.py goes straight to its dedup stage
+import hashlib
+import json
+import os
+from itertools import product
+from pathlib import Path
+
+from binshard import BinaryShardWriter, binary_path, hash_bucket
+from shards import Manifest, ShardWriter, temp_path
+
+# written once a run's partitions are all complete: their levels, format and the shard names of the run's chunks
+LAYOUT_NAME = "partitions.json"
+# bytes of lines buffered per partition before they're handed to its compressor
+BUFFER_BYTES = 1 << 16
+# input bytes aimed for per partition when the fanout is picked from the input size, and the most levels picked
+PARTITION_BYTES = 1 << 30
+MAX_LEVELS = 3
+
+
+def partition_names(out_levels):
+    # the partitions' directories, relative to the root: "0/0", "0/1" ... "f/f" for 2 levels
+    return ["/".join(d) for d in product("0123456789abcdef", repeat=out_levels)]
+
+
+def auto_levels(total_bytes, partition_bytes=PARTITION_BYTES):
+    """
+    Gets the fewest levels (1 to MAX_LEVELS) that split `total_bytes` of input into partitions of at most about
+    `partition_bytes` - 2 (256 partitions) for a full crawl's ~250GB of urls
+    """
+    levels = 1
+    while levels < MAX_LEVELS and total_bytes > partition_bytes * 16 ** levels:
+        levels += 1
+    return levels
+
+
+def get_dirs(out_dir, out_levels):
+    return [Path(f"{out_dir}/{name}") for name in partition_names(out_levels)]
+
+
+def chunk_key(flist):
+    # names a chunk's partition shards by the inputs in it, so a restart (with other inputs, or another number of
+    # threads) only skips a chunk whose shards were written from exactly the same inputs
+    return hashlib.sha1("\n".join(sorted(flist)).encode()).hexdigest()[:16]
+
+
+def partition_paths(key, out_dir, out_levels, binary=False):
+    name = f"scatter_{key}.jsonl.gz"
+    if binary:
+        name = binary_path(name)
+    return [str(i/name) for i in get_dirs(out_dir, out_levels)]
+
+
+class PartitionWriter:
+    """
+    Writes a chunk's records into one shard per partition, buffering jsonl lines per partition so the compressors
+    get them in batches. Like a ShardWriter it's committed (all of its shards, added to the manifest in `out_dir`) when
+    used as a context manager and the block exits normally, and discarded on an exception
+    """
+
+    def __init__(self, key, out_dir, out_levels, binary=False):
+        self.out_levels = out_levels
+        self.binary = binary
+        for d in get_dirs(out_dir, out_levels):
+            d.mkdir(parents=True, exist_ok=True)
+        manifest = Manifest(out_dir)
+        writer = BinaryShardWriter if binary else ShardWriter
+        self.files = [writer(i, manifest) for i in partition_paths(key, out_dir, out_levels, binary)]
+        self.buffers = [[] for _ in self.files]
+        self.buffered = [0] * len(self.files)
+
+    def write(self, h, line):
+        """
+        Adds the `line` (`<hash> <json>`) of the record with the hex hash `h` (str or bytes)
+        """
+        i = int(h[:self.out_levels], 16)
+        self.buffers[i].append(line)
+        self.buffered[i] += len(line)
+        if self.buffered[i] >= BUFFER_BYTES:
+            self._flush(i)
+
+    def write_record(self, h, payload):
+        """
+        Adds a binary record with the 16 byte hash `h` (binary shards buffer a block of records themselves)
+        """
+        self.files[hash_bucket(h, self.out_levels)].write_record(h, payload)
+
+    def _flush(self, i):
+        if self.buffers[i]:
+            self.files[i].write(b"".join(self.buffers[i]))
+            self.buffers[i] = []
+            self.buffered[i] = 0
+
+    @property
+    def records(self):
+        return sum(f.records for f in self.files)
+
+    def commit(self):
+        # a chunk's shards only appear once all of them are written
+        for i in range(len(self.files)):
+            self._flush(i)
+        [f.commit() for f in self.files]
+
+    def discard(self):
+        [f.discard() for f in self.files]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+
+
+def write_layout(root, out_levels, names, binary):
+    path = os.path.join(root, LAYOUT_NAME)
+    with open(temp_path(path), "w") as f:
+        json.dump({"levels": out_levels, "binary": binary, "names": sorted(names)}, f)
+    os.replace(temp_path(path), path)
+
+
+def read_layout(root):
+    """
+    Gets the layout of the partitioned shards in `root` (levels, binary and names), None if it has none
+    """
+    try:
+        with open(os.path.join(root, LAYOUT_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
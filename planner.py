@@ -0,0 +1,93 @@
+# plans the batch stages' pool tasks by the size of their inputs rather than their number: biggest first (inputs vary by
+# more than 100x, and one started last holds up the end of a run on a single process), binary shards too big for one
+# task split into ranges of their blocks, and progress and ETA reported in bytes
+import heapq
+import os
+from collections import namedtuple
+
+from tqdm import tqdm
+
+from binshard import BinaryShard, is_binary
+
+# a binary shard's pieces are at least this big, so small shards are never split
+MIN_SPLIT_BYTES = 64 << 20
+
+# `path`, with `blocks` (a range of a binary shard's blocks, or None for all of the file) and the bytes they take
+Piece = namedtuple("Piece", ["path", "blocks", "size"])
+
+
+def input_size(path):
+    """
+    Gets the bytes of `path`, 0 if it's gone (it'll fail, or be skipped, when its task runs)
+    """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def piece_name(piece):
+    return piece.path if piece.blocks is None else f"{piece.path}:{piece.blocks.start}-{piece.blocks.stop}"
+
+
+def split(path, max_bytes):
+    """
+    Splits the file at `path` into pieces of up to about `max_bytes`. Only binary shards can be read from part way
+    through, by ranges of their blocks; other files (gzip or zstd compressed jsonl) are a single piece
+    """
+    size = input_size(path)
+    if size <= max(max_bytes, MIN_SPLIT_BYTES) or not is_binary(path):
+        return [Piece(path, None, size)]
+    with BinaryShard(path) as shard:
+        index = shard.index
+    pieces = []
+    start = 0
+    piece_bytes = 0
+    for i, (_, block_bytes, _, _, _, _) in enumerate(index):
+        if piece_bytes and piece_bytes + block_bytes > max(max_bytes, MIN_SPLIT_BYTES):
+            pieces.append(Piece(path, range(start, i), piece_bytes))
+            start, piece_bytes = i, 0
+        piece_bytes += block_bytes
+    pieces.append(Piece(path, range(start, len(index)), piece_bytes))
+    return pieces
+
+
+def balance(paths, n):
+    """
+    Groups the files at `paths` into at most `n` lists of pieces with about the same bytes each, biggest first (the
+    longest processing time first rule). A file bigger than an even share is split if it can be
+    """
+    sizes = [input_size(p) for p in paths]
+    share = sum(sizes) // max(n, 1)
+    pieces = [piece for p in paths for piece in split(p, share)]
+    pieces.sort(key=lambda piece: (piece.size, piece_name(piece)), reverse=True)
+
+    chunks = [[] for _ in range(n)]
+    loads = [(0, i) for i in range(n)]
+    for piece in pieces:
+        load, i = heapq.heappop(loads)
+        chunks[i].append(piece)
+        heapq.heappush(loads, (load + piece.size, i))
+    chunks = [c for c in chunks if c]
+    chunks.sort(key=lambda c: sum(piece.size for piece in c), reverse=True)
+    return chunks
+
+
+def _sized(x):
+    fn, size, task = x
+    return size, fn(task)
+
+
+def run(pool, fn, tasks, sizes, desc=None, **kwargs):
+    """
+    Runs `fn` on each of `tasks` (with `sizes`, in bytes) on the pool, biggest first and one at a time per process, with
+    a progress bar of bytes done (so its ETA isn't thrown off by a few huge tasks). Returns the results as they finish
+    """
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
+    results = []
+    with tqdm(total=sum(sizes), desc=desc, unit="B", unit_scale=True, unit_divisor=1024, **kwargs) as bar:
+        for size, result in pool.imap_unordered(_sized, [(fn, sizes[i], tasks[i]) for i in order]):
+            results.append(result)
+            bar.set_postfix_str(f"{len(results)}/{len(tasks)} tasks", refresh=False)
+            bar.update(size)
+    return results
@@ -1,3 +1,5 @@
+import time
+
 from tqdm import tqdm
 from api import API
 
@@ -10,4 +12,5 @@ while True:
     count = api.get_global_progress()
     pbar.update(count - last_count)
     last_count = count
+    time.sleep(5)
 
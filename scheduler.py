@@ -1,21 +1,85 @@
+import asyncio
 from enum import Enum
-from typing import Optional, List
-from fastapi import FastAPI
-import os
-from download_warc_urls import WARC_URLS_PATH
+from typing import Optional, List, Union
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from download_warc_urls import WARC_URLS_PATH, iter_warc_urls
 import uvicorn
-from db import DB
+from db import DB, BlockWriter
+from endgame import EndGame
+from throughput import ThroughputEstimator
+from metrics import REGISTRY, CONTENT_TYPE, Counter, Gauge, Histogram
 from fastapi_utils.tasks import repeat_every
 import sqlite3
 from pydantic import BaseModel
 
 app = FastAPI()
 DATABASE = None
+# all writes to DATABASE go through WRITER, which group commits them from its own thread
+WRITER = None
 GLOBAL_PROGRESS = 0
+# a worker that hasn't sent a heartbeat for a block in this many seconds loses its lease
+LEASE_TIMEOUT = 60 * 10
+# how often expired leases are put back into the pool
+RECLAIM_INTERVAL = 60
+# blocks added per write transaction when ingesting a crawl
+INGEST_CHUNK_SIZE = 10000
+# leases are sized so each worker holds about this many seconds of work at its measured throughput
+TARGET_LEASE_SECONDS = 60 * 20
+THROUGHPUT = ThroughputEstimator(target_seconds=TARGET_LEASE_SECONDS)
+# once no blocks are left to lease, idle workers get speculative copies of blocks in progress for this long
+ENDGAME_MIN_AGE = 60 * 5
+ENDGAME = EndGame(max_copies=1, min_age=ENDGAME_MIN_AGE)
+
+# metrics served at /metrics (the DB query histogram lives in db.py)
+REQUEST_SECONDS = Histogram("scheduler_request_seconds", "Time spent handling requests", labels=["path"])
+LEASE_REQUESTS = Counter("scheduler_lease_requests_total", "Lease requests by outcome", labels=["result"])
+BLOCKS_LEASED = Counter("scheduler_blocks_leased_total", "Blocks handed out to workers", labels=["kind"])
+BLOCKS_REPORTED = Counter("scheduler_blocks_reported_total", "Blocks reported by workers", labels=["status"])
+HEARTBEAT_BLOCKS = Counter("scheduler_heartbeat_blocks_total", "Block leases extended by heartbeats")
+BLOCKS_RECLAIMED = Counter("scheduler_blocks_reclaimed_total", "Blocks put back into the pool after their lease expired")
+BLOCKS = Gauge("scheduler_blocks", "Blocks per status", labels=["status"]).set_function(
+    lambda: {(status,): n for status, n in DATABASE.counters.stats().items() if status in STATUS_NAMES}
+)
+CRAWL_BLOCKS = Gauge("scheduler_crawl_blocks", "Blocks per crawl and status", labels=["crawl", "status"]).set_function(
+    lambda: {
+        (crawl, status): n
+        for crawl, counts in DATABASE.counters.stats()["crawls"].items()
+        for status, n in counts.items()
+    }
+)
+WORKERS = Gauge("scheduler_workers", "Workers holding at least one block").set_function(
+    lambda: sum(1 for counts in DATABASE.counters.stats()["workers"].values() if counts["in_progress"])
+)
+WRITER_CALLS = Counter("scheduler_writer_calls_total", "Calls applied by the DB writer").set_function(
+    lambda: WRITER.calls
+)
+WRITER_TRANSACTIONS = Counter("scheduler_writer_transactions_total", "DB writer transactions").set_function(
+    lambda: WRITER.batches
+)
+WRITER_QUEUE_SECONDS = Counter(
+    "scheduler_writer_queue_seconds_total", "Time calls spent queued for the DB writer"
+).set_function(lambda: WRITER.queue_seconds)
+WRITER_BUSY_SECONDS = Counter(
+    "scheduler_writer_busy_seconds_total", "Time the DB writer spent applying transactions"
+).set_function(lambda: WRITER.busy_seconds)
+WRITER_LOCKED_ERRORS = Counter(
+    "scheduler_writer_locked_errors_total", "DB writer transactions that failed on a locked database"
+).set_function(lambda: WRITER.locked_errors)
+WRITER_QUEUED = Gauge("scheduler_writer_queued", "Calls waiting for the DB writer").set_function(
+    lambda: WRITER.queue.qsize()
+)
 
 
 class BlockIds(BaseModel):
     ids: List[str]
+    # seconds each block took and its size in bytes, reported with completed blocks
+    durations: Optional[List[float]] = None
+    bytes: Optional[List[int]] = None
+
+
+class Manifests(BaseModel):
+    manifests: List[str]
 
 
 # Enum class describing the status of a block
@@ -26,14 +90,22 @@ class BlockStatus(int, Enum):
     FAILED = 3
 
 
+STATUS_NAMES = [status.name.lower() for status in BlockStatus]
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    with REQUEST_SECONDS.time(path=request.url.path):
+        return await call_next(request)
+
+
 @app.on_event("startup")
 async def startup():
     global DATABASE
+    global WRITER
     global GLOBAL_PROGRESS
-    if not os.path.exists(WARC_URLS_PATH):
-        print("No warc urls found - run download_warc_urls.py")
-        exit(1)
-    DATABASE = DB(path="blocks.sql")
+    DATABASE = DB(path="blocks.sql", warc_urls_path=WARC_URLS_PATH, lease_timeout=LEASE_TIMEOUT)
+    WRITER = BlockWriter(DATABASE).start()
     GLOBAL_PROGRESS = DATABASE.get_progress()
     print(f"{len(DATABASE)} blocks loaded")
     print(f"global progress = {GLOBAL_PROGRESS}")
@@ -42,30 +114,48 @@ async def startup():
 @app.on_event("shutdown")
 async def shutdown():
     print("saving progress")
-    DATABASE.con.commit()
+    WRITER.stop()
 
 
 # get an available block (or N)
 @app.get("/blocks/get")
-async def get_blocks(worker_id: str, n: Optional[int] = 1) -> List[dict]:
+async def get_blocks(worker_id: str, n: Optional[int] = 1, slots: Optional[int] = None) -> Union[List[dict], dict]:
+    # `n` is the most blocks the worker wants, `slots` how many it processes at once
+    n = THROUGHPUT.lease_size(worker_id, n, slots=slots, held=DATABASE.counters.held(worker_id))
     # get first index where status is AVAILABLE or FAILED
     try:
-        blocks = DATABASE.get_available_blocks(n, worker_id=worker_id)
-    except IndexError as e:
-        print(e)
-        return {"message": "no blocks available"}
+        blocks = await WRITER.get_available_blocks(n, worker_id=worker_id)
+        speculative = []
+        if blocks:
+            ENDGAME.leased([uuid for _, uuid, _ in blocks], worker_id)
+        else:
+            # end game: duplicate the oldest blocks still in progress elsewhere. The query runs on a thread (with its
+            # own read connection), not on the event loop
+            candidates = await asyncio.get_running_loop().run_in_executor(
+                None, DATABASE.get_oldest_in_progress, n + len(ENDGAME.holders), DATABASE.now() - ENDGAME.min_age
+            )
+            speculative = ENDGAME.pick(candidates, worker_id, n)
     except sqlite3.OperationalError as e:
         print(e)
         return {"message": "database error"}
+    BLOCKS_LEASED.inc(len(blocks), kind="regular")
+    BLOCKS_LEASED.inc(len(speculative), kind="speculative")
+    if not blocks and not speculative:
+        LEASE_REQUESTS.inc(result="empty")
+        return {"message": "no blocks available"}
+    LEASE_REQUESTS.inc(result="leased" if blocks else "speculative")
     return [
         {"url": url, "uuid": uuid, "last_updated": last_updated}
         for (url, uuid, last_updated) in blocks
+    ] + [
+        {"url": url, "uuid": uuid, "last_updated": last_updated, "speculative": True}
+        for (url, uuid, last_updated) in speculative
     ]
 
 
 # get total number of blocks
 @app.get("/blocks/count")
-async def get_block_count() -> int:
+async def get_block_count() -> dict:
     try:
         return {"count": len(DATABASE)}
     except sqlite3.OperationalError as e:
@@ -75,15 +165,27 @@ async def get_block_count() -> int:
 
 # get global progress
 @app.get("/blocks/progress")
-async def get_progress() -> int:
+async def get_progress() -> dict:
     global GLOBAL_PROGRESS
-    try:
-        GLOBAL_PROGRESS = DATABASE.get_progress()
-        print(f"Global Progress: {GLOBAL_PROGRESS}")
-        return {"progress": GLOBAL_PROGRESS}
-    except sqlite3.OperationalError as e:
-        print(e)
-        return {"message": "database error"}
+    GLOBAL_PROGRESS = DATABASE.get_progress()
+    return {"progress": GLOBAL_PROGRESS}
+
+
+# get the number of blocks per status, overall and per worker and crawl
+@app.get("/blocks/stats")
+async def get_stats() -> dict:
+    return {
+        **DATABASE.get_stats(),
+        "throughput": THROUGHPUT.stats(),
+        "endgame": ENDGAME.stats(),
+        "writer": WRITER.stats(),
+    }
+
+
+# Prometheus metrics
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
 
 
 # mark a block as in progress
@@ -93,7 +195,7 @@ async def mark_block_in_progress(block_ids: BlockIds) -> dict:
         block_ids = block_ids.ids
         print(f"Marking {len(block_ids)} blocks as in progress")
         # we've received a list of block ids
-        DATABASE.update_multiple(block_ids, int(BlockStatus.IN_PROGRESS))
+        await WRITER.update_multiple(block_ids, int(BlockStatus.IN_PROGRESS))
         return {"message": "success"}
     except sqlite3.OperationalError as e:
         print(e)
@@ -102,12 +204,19 @@ async def mark_block_in_progress(block_ids: BlockIds) -> dict:
 
 # mark a block as completed
 @app.put("/blocks/complete/")
-async def mark_block_completed(block_ids: BlockIds) -> dict:
+async def mark_block_completed(block_ids: BlockIds, worker_id: Optional[str] = None) -> dict:
+    if worker_id is not None and block_ids.durations:
+        THROUGHPUT.record(worker_id, block_ids.durations, block_ids.bytes)
+    # first completion wins, any other holders of these blocks are told to abort them. A report without a worker id
+    # can't say which holder won (it may be one of them), so it settles nothing and the copies run on
+    if worker_id is not None:
+        ENDGAME.completed(block_ids.ids, worker_id)
     try:
         block_ids = block_ids.ids
         print(f"Marking {len(block_ids)} blocks as complete")
         # we've received a list of block ids
-        DATABASE.update_multiple(block_ids, int(BlockStatus.COMPLETED))
+        await WRITER.update_multiple(block_ids, int(BlockStatus.COMPLETED))
+        BLOCKS_REPORTED.inc(len(block_ids), status="completed")
         return {"message": "success"}
     except sqlite3.OperationalError as e:
         print(e)
@@ -116,26 +225,66 @@ async def mark_block_completed(block_ids: BlockIds) -> dict:
 
 # mark a block as failed
 @app.put("/blocks/failed/")
-async def mark_block_failed(block_ids: BlockIds) -> dict:
+async def mark_block_failed(block_ids: BlockIds, worker_id: Optional[str] = None) -> dict:
     try:
-        block_ids = block_ids.ids
+        # a failed speculative copy leaves the original lease alone
+        block_ids = ENDGAME.failed(block_ids.ids, worker_id)
         print(f"Marking {len(block_ids)} blocks as failed")
         # we've received a list of block ids
-        DATABASE.update_multiple(block_ids, int(BlockStatus.FAILED))
+        await WRITER.update_multiple(block_ids, int(BlockStatus.FAILED))
+        BLOCKS_REPORTED.inc(len(block_ids), status="failed")
         return {"message": "success"}
     except sqlite3.OperationalError as e:
         print(e)
         return {"message": "database error"}
 
 
-# clear out blocks marked in progress that haven't been marked as completed or failed in 24h
+# extend the leases on blocks a worker is still processing, and tell it which blocks were completed elsewhere
+@app.put("/blocks/heartbeat/")
+async def heartbeat(worker_id: str, block_ids: BlockIds) -> dict:
+    try:
+        copies = [uuid for uuid in block_ids.ids if ENDGAME.is_copy(uuid, worker_id)]
+        held = [uuid for uuid in block_ids.ids if not ENDGAME.is_copy(uuid, worker_id)]
+        extended = await WRITER.heartbeat(held, worker_id)
+        if copies:
+            # a live speculative copy keeps the block's lease alive even if the original holder died
+            extended += await WRITER.heartbeat(copies, None)
+        HEARTBEAT_BLOCKS.inc(extended)
+        return {"message": "success", "extended": extended, "abort": ENDGAME.take_aborts(worker_id)}
+    except sqlite3.OperationalError as e:
+        print(e)
+        return {"message": "database error"}
+
+
+# add the blocks of new crawls (wat.paths.gz manifest urls) to the pool - blocks that are already there are skipped
+@app.put("/crawls/ingest/")
+async def ingest_crawls(manifests: Manifests) -> dict:
+    loop = asyncio.get_running_loop()
+    try:
+        urls = await loop.run_in_executor(None, lambda: list(iter_warc_urls(manifests.manifests)))
+    except Exception as e:
+        print(e)
+        return {"message": "manifest error"}
+    try:
+        inserted = 0
+        for i in range(0, len(urls), INGEST_CHUNK_SIZE):
+            inserted += await WRITER.run(DATABASE.insert_blocks, urls[i:i + INGEST_CHUNK_SIZE])
+    except sqlite3.OperationalError as e:
+        print(e)
+        return {"message": "database error"}
+    print(f"Ingested {inserted} new blocks from {len(manifests.manifests)} manifests")
+    return {"message": "success", "inserted": inserted, "count": len(DATABASE)}
+
+
+# put blocks whose lease expired (worker died or stopped sending heartbeats) back into the pool
 @app.on_event("startup")
-@repeat_every(seconds=60 * 60 * 3)  # every 3 hours
+@repeat_every(seconds=RECLAIM_INTERVAL)
 async def remove_expired_tokens_task():
     try:
-        print(f"BEFORE: {len(DATABASE.get_blocks_with_status(1))}")
-        DATABASE.clear_timed_out_blocks(period=60 * 60 * 24)
-        print(f"AFTER: {len(DATABASE.get_blocks_with_status(1))}")
+        reclaimed = await WRITER.clear_timed_out_blocks()
+        BLOCKS_RECLAIMED.inc(reclaimed)
+        if reclaimed:
+            print(f"Reclaimed {reclaimed} blocks with expired leases")
         return {"message": "success"}
     except sqlite3.OperationalError as e:
         print(e)
@@ -0,0 +1,183 @@
+# atomic shard writes, and a manifest of the shards a stage has finished, so a crash never leaves a truncated shard
+# behind for the next stage to read and a restarted stage can skip the shards it already has
+import hashlib
+import json
+import os
+
+from compression import Compression
+
+MANIFEST_NAME = "manifest.jsonl"
+CHUNK_SIZE = 1 << 20
+
+
+def temp_path(path):
+    """
+    Gets the name a shard is written under until it's complete - hidden, so the `*` globs stages find their inputs
+    with never pick it up
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class Manifest:
+    """
+    Append-only jsonl of the complete shards under `root`, one {"path", "records", "bytes", "md5"} line per shard
+    (paths relative to `root`). Lines are appended with a single O_APPEND write, so processes can share one manifest.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, MANIFEST_NAME)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _key(self, path):
+        return os.path.relpath(path, self.root)
+
+    def entries(self):
+        """
+        Gets relative path -> entry of every shard recorded (the latest entry wins)
+        """
+        entries = {}
+        if not self.exists():
+            return entries
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                entries[entry["path"]] = entry
+        return entries
+
+    def add(self, path, records, size, md5):
+        os.makedirs(self.root, exist_ok=True)
+        entry = {"path": self._key(path), "records": records, "bytes": size, "md5": md5}
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + "\n").encode())
+        finally:
+            os.close(fd)
+        return entry
+
+    def complete(self, paths, entries=None):
+        """
+        Gets the shards of `paths` that are recorded and still on disk at the recorded size
+        """
+        entries = self.entries() if entries is None else entries
+        done = []
+        for path in paths:
+            entry = entries.get(self._key(path))
+            if entry is not None and os.path.exists(path) and os.path.getsize(path) == entry["bytes"]:
+                done.append(path)
+        return done
+
+    def is_complete(self, path):
+        return bool(self.complete([path]))
+
+
+def complete_inputs(root, paths):
+    """
+    Filters a stage's input shards down to the complete ones, per the previous stage's manifest in `root`. Inputs
+    written before stages kept manifests (no manifest at all) are all taken as they are.
+    """
+    manifest = Manifest(root)
+    if not manifest.exists():
+        return list(paths)
+    return manifest.complete(paths)
+
+
+def commit(tmp_path, path, records, manifest=None, size=None, md5=None):
+    """
+    Moves the finished shard at `tmp_path` to `path` and records it in `manifest`
+    """
+    size = os.path.getsize(tmp_path) if size is None else size
+    md5 = file_md5(tmp_path) if md5 is None else md5
+    os.replace(tmp_path, path)
+    if manifest is not None:
+        return manifest.add(path, records, size, md5)
+    return {"path": path, "records": records, "bytes": size, "md5": md5}
+
+
+def discard(tmp_path):
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+class _HashingFile:
+    # counts and hashes the bytes written through it, so a shard's md5 is known without reading it back
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+class ShardWriter:
+    """
+    Writes a compressed jsonl shard under a temporary name, counting its records (lines). It's compressed with
+    `compression`, or the run's SHARD_COMPRESSION setting (gzip at `compresslevel`, or 6, if that's unset).
+
+    Used as a context manager it's committed (renamed into place and added to `manifest`) when the block exits
+    normally and discarded on an exception. Otherwise `close()` finishes the temporary file and returns what `commit`
+    needs, so the commit can happen elsewhere (e.g in the process that knows whether the shard is wanted).
+    """
+
+    def __init__(self, path, manifest=None, compresslevel=None, compression=None):
+        self.path = path
+        self.manifest = manifest
+        self.tmp_path = temp_path(path)
+        self.records = 0
+        self.raw = open(self.tmp_path, "wb")
+        self.hashing = _HashingFile(self.raw)
+        self.compression = Compression.from_env(compresslevel) if compression is None else compression
+        self.gz = self.compression.writer(self.hashing)
+
+    def write(self, data):
+        self.records += data.count(b"\n")
+        self.gz.write(data)
+
+    def close(self):
+        """
+        Finishes the temporary file, returns (tmp path, path, records, bytes, md5)
+        """
+        if not self.gz.closed:
+            self.gz.close()
+            self.raw.close()
+        return self.tmp_path, self.path, self.records, self.hashing.size, self.hashing.md5.hexdigest()
+
+    def commit(self):
+        tmp_path, path, records, size, md5 = self.close()
+        return commit(tmp_path, path, records, self.manifest, size, md5)
+
+    def discard(self):
+        self.close()
+        discard(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
@@ -1,146 +1,294 @@
 # use a parallel radix sort of url hashes to deduplicate urls
-import itertools
-import json
+import argparse
 from glob import glob
-import gzip
-import sys
-from itertools import product
+import zlib
 from multiprocessing import Pool, set_start_method
+from operator import itemgetter
 from pathlib import Path
-import random
 
-from tqdm import tqdm
+from binshard import BinaryShardWriter, binary_path, is_binary, read_hashed
+from codec import Codec, summarize
+from compression import open_reader
+from extsort import Runs, group_sorted
+from partitions import PartitionWriter, auto_levels, chunk_key, partition_names, partition_paths, read_layout
+import planner
+from shards import Manifest, ShardWriter, complete_inputs
 
-
-def parse_jsonl(fname):
-    f = gzip.open(fname, 'rb')
-    records = []
-    try:
-        for i in f:
-            records.append(json.loads(i))
-    except:
-        pass
-    return records
+# rough sizes (bytes) of what a Deduper keeps, for its memory cap: per record on top of its json, and a decoded record
+# (dict of sets) per byte of its json
+RECORD_BYTES = 100
+DECODED_FACTOR = 5
+DEFAULT_MAX_BYTES = 1 << 30
 
 
-def read_with_hash(fname):
+def read_with_hash(fname, codec):
+    # (hex hash, json line) of `<hash> <json>` lines, without decoding them. Plain json lines (scatter files from
+    # before they kept the hash in front) are decoded for their hash
     try:
-        f = gzip.open(fname, 'rb')
-        records = []
-        for i in f:
-            h, r = i.split(b" ", maxsplit=1)
-
-            records.append((h, r))
-        return records
-    except:
-        return []
-
-
-def get_dirs(out_dir, out_levels):
-    hex_characters = list("0123456789abcdef")
-    directories = list(product(hex_characters, repeat=out_levels))
-    out = []
-    for d in directories:
-        out.append(Path(f"{out_dir}/{'/'.join(d)}"))
-    return out
-
-
-def scatter_files(flist, thread_index, out_dir, out_levels):
-    dirs = get_dirs(out_dir, out_levels)
-    files = [i/f"scatter_{thread_index}.jsonl.gz" for i in dirs]
-    [Path(i).mkdir(parents=True, exist_ok=True) for i in dirs]
-    files = [gzip.open(i, "wb", compresslevel=6) for i in files]
-
-    for i in flist:
-        parsed = read_with_hash(i)
-        for h, r in parsed:
-            hash_prefix = h[:out_levels]
-            file = files[int(hash_prefix, 16)]
-            file.write(r)
-
-    [i.close() for i in files]
+        with open_reader(fname) as f:
+            for lines in codec.batches(f, partial=True):
+                for i in lines:
+                    if i.startswith(b"{"):
+                        try:
+                            h = codec.loads(i)["hash"].encode()
+                        except (ValueError, KeyError, TypeError, AttributeError):
+                            codec.counts["errors"] += 1
+                            continue
+                        r = i
+                    else:
+                        h, sep, r = i.partition(b" ")
+                        if not sep:
+                            codec.counts["errors"] += 1
+                            continue
+                    codec.counts["records"] += 1
+                    yield h, r
+    except OSError:
+        codec.counts["truncated"] += 1
+
+
+def read_binary_with_hash(fname, codec, blocks=None):
+    # (16 byte hash, json) of the records of a binary (or jsonl) shard, or a range of its blocks, without decoding them
+    try:
+        for h, r in read_hashed(fname, blocks):
+            codec.counts["records"] += 1
+            yield h, r
+    except (OSError, ValueError, zlib.error):
+        codec.counts["truncated"] += 1
+
+
+def scatter_files(flist, key, out_dir, out_levels, binary=False):
+    codec = Codec()
+    with PartitionWriter(key, out_dir, out_levels, binary) as writer:
+        for piece in flist:
+            if binary:
+                # records are routed by their binary hash and copied as they are
+                for h, r in read_binary_with_hash(piece.path, codec, piece.blocks):
+                    writer.write_record(h, r)
+                continue
+            # the hash stays in front of each line, so the dedup stage needn't decode records to find it
+            for h, r in read_with_hash(piece.path, codec):
+                writer.write(h, h + b" " + r)
+    return codec.counts
 
 
 def scatter_process(x):
-    (idx, file_chunks), out_dir, out_levels = x
-    scatter_files(file_chunks, idx, out_dir, out_levels)
-
-
-def dedup(input_dir, out_file):
-    images = {}
-
-    for f in glob(f"{input_dir}/*"):
-        records = parse_jsonl(f)
-
-        for i in records:
-            if i["hash"] in images:
-                new = images[i["hash"]]
-
-                new["alt"].update(i["alt"])
-                new["page_meta"].update(i["page_meta"])
-                new["licenses"].update(i["licenses"])
-                new["page_url"].update(i["page_url"])
-            else:
-                i["alt"] = set(i["alt"])
-                i["page_meta"] = set(i["page_meta"])
-                i["licenses"] = set(i["licenses"])
-                i["page_url"] = set(i["page_url"])
-
-                new = i
-
-            images[i["hash"]] = new
-
-    of = gzip.open(out_file, "w", compresslevel=6)
-    for i in images.values():
-        i["alt"] = list(i["alt"])
-        i["page_meta"] = list(i["page_meta"])
-        i["page_url"] = list(i["page_url"])
-        i["licenses"] = list(i["licenses"])
-
-        of.write(json.dumps(i).encode())
-        of.write(b"\n")
-
-    of.close()
+    (key, file_chunks), out_dir, out_levels, binary = x
+    return scatter_files(file_chunks, key, out_dir, out_levels, binary)
+
+
+def _as_sets(i):
+    i["alt"] = set(i["alt"])
+    i["page_meta"] = set(i["page_meta"])
+    i["licenses"] = set(i["licenses"])
+    i["page_url"] = set(i["page_url"])
+    return i
+
+
+def _merge(new, i):
+    new["alt"].update(i["alt"])
+    new["page_meta"].update(i["page_meta"])
+    new["licenses"].update(i["licenses"])
+    new["page_url"].update(i["page_url"])
+
+
+def _as_lists(i):
+    # sorted, so the output doesn't depend on set iteration order
+    i["alt"] = sorted(i["alt"])
+    i["page_meta"] = sorted(i["page_meta"])
+    i["page_url"] = sorted(i["page_url"])
+    i["licenses"] = sorted(i["licenses"])
+    return i
+
+
+def scatter_inputs(input_dir, cluster_dir, names):
+    # the complete scatter files of this run's chunks, not those left from earlier runs' chunks of other inputs
+    return [f for f in complete_inputs(cluster_dir, glob(f"{input_dir}/*")) if Path(f).name in names]
+
+
+class Deduper:
+    """
+    Merges the records of a partition by hash in bounded memory. Records are kept as the json they came in until a
+    second one with the same hash turns up, so only duplicated urls are ever decoded (and encoded again). Once they
+    take roughly `max_bytes`, they're spilled to disk as a run sorted by hash under `tmp_dir`, and the runs are merged
+    back when the records are written, unioning alt, page_meta, licenses and page_url across runs. The other fields
+    are those of a url's first record, as read
+    """
+
+    def __init__(self, codec, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None):
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.tmp_dir = tmp_dir
+        self.runs = None
+        self.runs_spilled = 0
+        self._reset()
+
+    def _reset(self):
+        # hash -> json, or decoded record with sets once it's been merged
+        self.images = {}
+        self.approx_bytes = 0
+
+    def add(self, h, r):
+        new = self.images.get(h)
+        if new is None:
+            self.images[h] = r
+            self.approx_bytes += RECORD_BYTES + len(r)
+        else:
+            if isinstance(new, bytes):
+                new = self.images[h] = _as_sets(self.codec.loads(new))
+                self.approx_bytes += DECODED_FACTOR * len(r)
+            _merge(new, self.codec.loads(r))
+        if self.approx_bytes > self.max_bytes:
+            self.spill()
+
+    def _combine(self, first, other):
+        h, new = first
+        if isinstance(new, bytes):
+            new = _as_sets(self.codec.loads(new))
+        other = other[1]
+        _merge(new, self.codec.loads(other) if isinstance(other, bytes) else other)
+        return h, new
+
+    def spill(self):
+        if self.runs is None:
+            self.runs = Runs(self.tmp_dir)
+        self.runs.spill(sorted(self.images.items(), key=itemgetter(0)))
+        self.runs_spilled += 1
+        self._reset()
+
+    def records(self):
+        """
+        Yields (hash, json or merged record) for every url, ordered by hash
+        """
+        entries = sorted(self.images.items(), key=itemgetter(0))
+        self._reset()
+        try:
+            if self.runs is not None:
+                # runs are merged in the order they were spilled, so a url keeps the fields of its first record
+                key = itemgetter(0)
+                entries = group_sorted(self.runs.merge(entries, key=key), key, self._combine)
+            yield from entries
+        finally:
+            if self.runs is not None:
+                self.runs.close()
+                self.runs = None
+
+
+def dedup(input_dir, out_file, cluster_dir, out_dir, names, binary=False, max_bytes=DEFAULT_MAX_BYTES, tmp_dir=None):
+    codec = Codec()
+    deduper = Deduper(codec, max_bytes, tmp_dir)
+    read = read_binary_with_hash if binary else read_with_hash
+    for f in scatter_inputs(input_dir, cluster_dir, names):
+        for h, r in read(f, codec):
+            deduper.add(h, r)
+
+    if binary:
+        with BinaryShardWriter(out_file, Manifest(out_dir)) as of:
+            for h, i in deduper.records():
+                of.write_record(h, i if isinstance(i, bytes) else codec.dumps(_as_lists(i)))
+        codec.counts["encoded"] += of.records
+    else:
+        with ShardWriter(out_file, Manifest(out_dir)) as of:
+            for h, i in deduper.records():
+                if isinstance(i, bytes):
+                    of.write(i)
+                    codec.counts["encoded"] += 1
+                else:
+                    of.write(codec.dump_line(_as_lists(i)))
+    if deduper.runs_spilled:
+        codec.counts["spilled_runs"] += deduper.runs_spilled
+    return codec.counts
 
 
 def dedup_process(x):
-    input_dir, out_file = x
+    input_dir, out_file, cluster_dir, out_dir, binary, names, max_bytes, tmp_dir = x
     Path("/".join(out_file.split("/")[:-1])).mkdir(parents=True, exist_ok=True)
-    dedup(input_dir, out_file)
+    return dedup(input_dir, out_file, cluster_dir, out_dir, names, binary, max_bytes, tmp_dir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Deduplicate image-level records by url hash")
+    parser.add_argument("threads", type=int)
+    parser.add_argument("input_dir", type=str)
+    parser.add_argument("cluster_dir", type=str, help="where the scatter stage partitions the records by hash")
+    parser.add_argument("out_dir", type=str)
+    parser.add_argument(
+        "--max_mb", type=int, default=DEFAULT_MAX_BYTES >> 20,
+        help="roughly how much memory each dedup process holds records in before spilling sorted runs to disk",
+    )
+    parser.add_argument("--tmp_dir", type=str, default=None, help="where runs are spilled (default: the system's)")
+    parser.add_argument(
+        "--levels", type=int, default=None,
+        help="partition into 16 ** levels directories by hash (default: picked from the input size, 2 for a full "
+             "crawl)",
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
     set_start_method("spawn")
 
-    assert len(sys.argv) == 5
-
-    input_dir = sys.argv[2]
-    cluster_dir = sys.argv[3]
-    out_dir = sys.argv[4]
-    threads = int(sys.argv[1])
+    args = parse_args()
+    input_dir = args.input_dir
+    cluster_dir = args.cluster_dir
+    out_dir = args.out_dir
+    threads = args.threads
+    max_bytes = args.max_mb << 20
 
     p = Pool(threads)
 
-    input_files = glob(f"{input_dir}/**/*")
-    random.shuffle(input_files)
-
-    output_chunks = threads * 4
-
-    chunked_input = list(enumerate([input_files[i::output_chunks] for i in range(output_chunks)]))
-
-    list(tqdm(p.imap_unordered(scatter_process,
-                               zip(chunked_input,
-                                   itertools.cycle([cluster_dir]),  # infinite iterators
-                                   itertools.cycle([2]))
-                               ), total=len(chunked_input), desc="hash scatter stage"))
-
-    shard_dirs = glob(f"{cluster_dir}/*/*/")
+    layout = read_layout(input_dir)
+    if layout is not None:
+        # dump_urls --partition_levels already wrote its records hash-partitioned, they're deduped where they are
+        cluster_dir = input_dir
+        out_levels, binary, names = layout["levels"], layout["binary"], set(layout["names"])
+        print(f"{input_dir} is already partitioned by hash ({16 ** out_levels} partitions), skipping the scatter stage")
+    else:
+        # only shards dump_urls finished
+        input_files = sorted(complete_inputs(input_dir, glob(f"{input_dir}/**/*")))
+        # enough partitions for each to be about PARTITION_BYTES, unless set
+        total_bytes = sum(planner.input_size(i) for i in input_files)
+        out_levels = args.levels or auto_levels(total_bytes)
+        print(f"{total_bytes / 2 ** 30:.1f} GB of input into {16 ** out_levels} partitions")
+        # binary shards from dump_urls --format bin (any, inputs in both formats are read) make binary scatter files and
+        # deduped shards
+        binary = any(is_binary(i) for i in input_files)
+
+        output_chunks = threads * 4
+
+        # chunks of about the same bytes, the same for the same inputs every run, with binary shards bigger than a
+        # chunk's share split into ranges of their blocks
+        chunks = planner.balance(input_files, output_chunks)
+        chunked_input = [(chunk_key([planner.piece_name(piece) for piece in chunk]), chunk) for chunk in chunks]
+        # the scatter file names of this run's chunks, the only ones the dedup stage reads
+        names = {Path(partition_paths(key, cluster_dir, out_levels, binary)[0]).name for key, _ in chunked_input}
+        # skip chunks whose scatter files were all written from the same inputs by an earlier run
+        cluster_manifest = Manifest(cluster_dir)
+        cluster_entries = cluster_manifest.entries()
+        chunked_input = [
+            (key, chunk) for key, chunk in chunked_input
+            if len(cluster_manifest.complete(partition_paths(key, cluster_dir, out_levels, binary), cluster_entries))
+            < 16 ** out_levels
+        ]
+
+        counts = planner.run(
+            p, scatter_process, [(chunk, cluster_dir, out_levels, binary) for chunk in chunked_input],
+            [sum(piece.size for piece in chunk) for _, chunk in chunked_input], desc="hash scatter stage",
+        )
+        print(f"hash scatter stage: {summarize(counts)}")
+
+    shard_dirs = [f"{cluster_dir}/{name}/" for name in partition_names(out_levels)]
 
     [Path(i.replace(cluster_dir, out_dir, 1)).mkdir(parents=True, exist_ok=True) for i in shard_dirs]
 
-    output_files = [i.replace(cluster_dir, out_dir, 1) + "deduped.jsonl.gz" for i in shard_dirs]
-
-    list(tqdm(p.imap_unordered(dedup_process,
-                               zip(shard_dirs, output_files)),
-              total=len(shard_dirs), desc="gather dedup stage"))
+    output_name = binary_path("deduped.jsonl.gz") if binary else "deduped.jsonl.gz"
+    output_files = [i.replace(cluster_dir, out_dir, 1) + output_name for i in shard_dirs]
+    done = set(Manifest(out_dir).complete(output_files))
+    todo = [(i, o) for i, o in zip(shard_dirs, output_files) if o not in done]
+
+    sizes = [sum(planner.input_size(f) for f in glob(f"{i}/*") if Path(f).name in names) for i, _ in todo]
+    counts = planner.run(
+        p, dedup_process, [(i, o, cluster_dir, out_dir, binary, names, max_bytes, args.tmp_dir) for i, o in todo], sizes,
+        desc="gather dedup stage",
+    )
+    print(f"gather dedup stage: {summarize(counts)}")
 
@@ -0,0 +1,220 @@
+# worker-side local cache of WAT files, so the filter reads blocks from disk
+import hashlib
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+import requests
+
+CHUNK_SIZE = 1 << 20
+# an S3 ETag is the object's md5 unless it was a multipart upload (then it has a -<parts> suffix)
+MD5_ETAG_RE = re.compile(r'^"?([0-9a-f]{32})"?$')
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def url_path(url):
+    """
+    Gets the path part of a block url, relative (e.g crawl-data/CC-MAIN-2021-04/.../x.warc.wat.gz)
+    """
+    return unquote(urlparse(url).path).lstrip("/")
+
+
+def local_path(url):
+    """
+    Gets the local file a file:// url (or plain path) points to, or None for remote urls
+    """
+    if url.startswith("file://"):
+        return unquote(urlparse(url).path)
+    if "://" not in url:
+        return url
+    return None
+
+
+class Spool:
+    """
+    Size-bounded local cache of downloaded blocks.
+
+    Blocks are downloaded to `cache_dir` (mirroring the url path) with ranged requests, so a stalled or dropped
+    transfer resumes where it left off instead of starting over, and checked against the size and md5 ETag S3 sends.
+    Once the cache holds more than `max_bytes`, the least recently used blocks that aren't being read are evicted.
+
+    file:// urls and local paths are read in place, and with a `mirror` directory (laid out like the bucket, e.g a
+    previous spool or an `aws s3 sync` of the crawl) blocks found there are never downloaded.
+    """
+
+    def __init__(self, cache_dir, max_bytes=50 * 2 ** 30, mirror=None, retries=5, timeout=60):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mirror = mirror
+        self.retries = retries
+        # seconds without receiving any data before a transfer is considered stalled (and resumed)
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        # path -> number of readers, pinned paths are never evicted
+        self.pinned = {}
+        # url -> [lock, threads using it], so two threads never download the same block at once
+        self.downloading = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def open(self, url):
+        """
+        Yields a local path for the block at `url`, downloading it into the cache first if needed
+        """
+        path = local_path(url)
+        if path is not None:
+            yield path
+            return
+        if self.mirror is not None:
+            path = os.path.join(self.mirror, url_path(url))
+            if os.path.exists(path):
+                yield path
+                return
+        path = os.path.join(self.cache_dir, url_path(url))
+        self._pin(path)
+        try:
+            with self._download_lock(url):
+                if os.path.exists(path):
+                    # a hit - bump it to most recently used
+                    os.utime(path)
+                else:
+                    self.download(url, path)
+            self.evict()
+            yield path
+        finally:
+            self._unpin(path)
+
+    def _pin(self, path):
+        with self.lock:
+            self.pinned[path] = self.pinned.get(path, 0) + 1
+
+    def _unpin(self, path):
+        with self.lock:
+            self.pinned[path] -= 1
+            if not self.pinned[path]:
+                del self.pinned[path]
+
+    @contextmanager
+    def _download_lock(self, url):
+        # the url's entry goes once no thread is waiting on it, so the dict only holds blocks being fetched
+        with self.lock:
+            entry = self.downloading.setdefault(url, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.downloading[url]
+
+    def download(self, url, path):
+        """
+        Downloads `url` to `path`, resuming from a partial download (`path`.part) if there is one
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.part"
+        etag = None
+        for attempt in range(self.retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                    if response.status_code == 416:
+                        # the part file is already complete
+                        total = offset
+                    else:
+                        response.raise_for_status()
+                        if response.status_code == 200:
+                            # the server ignored the range, start over
+                            offset = 0
+                        total = self._total_size(response, offset)
+                        if response.headers.get("ETag") is not None:
+                            etag = response.headers["ETag"]
+                        with open(part_path, "r+b" if offset else "wb") as f:
+                            f.seek(offset)
+                            f.truncate()
+                            for chunk in response.iter_content(CHUNK_SIZE):
+                                f.write(chunk)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Download of {url} interrupted ({e}), resuming")
+                time.sleep(min(2 ** attempt, 30))
+        self._check(url, part_path, total, etag)
+        os.replace(part_path, path)
+
+    @staticmethod
+    def _total_size(response, offset):
+        match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+        if match and match.group(3) != "*":
+            return int(match.group(3))
+        if response.headers.get("Content-Length") is not None:
+            return offset + int(response.headers["Content-Length"])
+        return None
+
+    @staticmethod
+    def _check(url, part_path, total, etag):
+        size = os.path.getsize(part_path)
+        try:
+            if total is not None and size != total:
+                raise ChecksumError(f"{url}: got {size} bytes, expected {total}")
+            match = MD5_ETAG_RE.match(etag or "")
+            if match:
+                md5 = hashlib.md5()
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        md5.update(chunk)
+                if md5.hexdigest() != match.group(1):
+                    raise ChecksumError(f"{url}: md5 {md5.hexdigest()} doesn't match ETag {etag}")
+        except ChecksumError:
+            # don't resume from a corrupt download
+            os.remove(part_path)
+            raise
+
+    def cached(self):
+        """
+        Gets (last used, size, path) of every block in the cache, and of partial downloads (`.part` files, e.g left by
+        a worker that was stopped part way through a block), which take up the cache's space as well
+        """
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """
+        Removes the least recently used blocks (and partial downloads) that aren't being read or downloaded until the
+        cache fits in `max_bytes`
+        """
+        with self.lock:
+            files = sorted(self.cached())
+            size = sum(file_size for _, file_size, _ in files)
+            for _, file_size, path in files:
+                if size <= self.max_bytes:
+                    break
+                # a block being downloaded is pinned under its final path
+                if path in self.pinned or path.endswith(".part") and path[:-len(".part")] in self.pinned:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    # e.g a partial download that was just completed and renamed
+                    pass
+                size -= file_size
@@ -0,0 +1,91 @@
+# per-worker throughput estimates used to size block leases
+import math
+from time import time
+
+
+class WorkerThroughput:
+    """
+    Moving (exponentially weighted) averages of how long a worker takes per block and how many bytes per second it
+    gets through, from the durations and sizes it reports with its completed blocks.
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.block_seconds = None
+        self.bytes_per_second = None
+        self.slots = None
+        self.completed = 0
+        self.last_report = None
+
+    def _ewma(self, old, new):
+        return new if old is None else self.alpha * new + (1 - self.alpha) * old
+
+    def record(self, duration, size=None):
+        if duration <= 0:
+            # blocks skipped without any work say nothing about throughput
+            return
+        self.block_seconds = self._ewma(self.block_seconds, duration)
+        if size is not None:
+            self.bytes_per_second = self._ewma(self.bytes_per_second, size / duration)
+        self.completed += 1
+        self.last_report = time()
+
+    def blocks_per_second(self):
+        """
+        Gets the estimated number of blocks per second the worker finishes across all its slots (None if unknown)
+        """
+        if not self.block_seconds:
+            return None
+        return (self.slots or 1) / self.block_seconds
+
+    def stats(self):
+        blocks_per_second = self.blocks_per_second()
+        return {
+            "block_seconds": self.block_seconds,
+            "bytes_per_second": self.bytes_per_second,
+            "slots": self.slots,
+            "blocks_per_hour": None if blocks_per_second is None else blocks_per_second * 3600,
+            "completed": self.completed,
+            "last_report": self.last_report,
+        }
+
+
+class ThroughputEstimator:
+    """
+    Sizes each lease so that every worker holds about `target_seconds` of wall-clock work, based on its measured
+    throughput. Workers without any completed blocks yet get what they ask for.
+    """
+
+    def __init__(self, target_seconds=60 * 20, alpha=0.2):
+        self.target_seconds = target_seconds
+        self.alpha = alpha
+        self.workers = {}
+
+    def worker(self, worker_id):
+        if worker_id not in self.workers:
+            self.workers[worker_id] = WorkerThroughput(self.alpha)
+        return self.workers[worker_id]
+
+    def record(self, worker_id, durations, sizes=None):
+        worker = self.worker(worker_id)
+        sizes = sizes or [None] * len(durations)
+        for duration, size in zip(durations, sizes):
+            worker.record(duration, size)
+
+    def lease_size(self, worker_id, requested, slots=None, held=0):
+        """
+        Gets the number of blocks to lease to `worker_id`, which asked for `requested` blocks, runs `slots` blocks at
+        once and already holds `held` blocks
+        """
+        worker = self.worker(worker_id)
+        if slots:
+            worker.slots = slots
+        blocks_per_second = worker.blocks_per_second()
+        if blocks_per_second is None:
+            return requested
+        target = math.ceil(self.target_seconds * blocks_per_second)
+        # always hand out at least one block so a worker can't be starved by a stale estimate
+        return max(1, min(requested, target - held))
+
+    def stats(self):
+        return {worker_id: worker.stats() for worker_id, worker in self.workers.items()}